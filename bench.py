@@ -0,0 +1,556 @@
+"""Load test for the viewer tier.
+
+Starts the app in a subprocess (one uvicorn worker) per storage backend and drives
+simulated viewers against it while a simulated admin mutates targets:
+
+  * SSE subscribers on /api/events (fan-out time of each admin write),
+  * pollers on /api/targets?since=<rev> and /api/launchsites?since=<rev>,
+  * presence pingers on /api/presence.
+
+Backends: the JSON fallback and SQLite (temp DATA_DIR), and Postgres. For Postgres a throwaway
+cluster is created with initdb/pg_ctl when they are on PATH; alternatively point
+BENCH_DATABASE_URL (or --database-url) at a disposable database. It gets written to.
+Admission control is off in those runs (every simulated client shares 127.0.0.1).
+
+The "admission" scenario runs the JSON backend with admission on, as if behind one
+reverse proxy: each simulated viewer gets its own X-Forwarded-For address, and
+--abusers extra clients poll /api/targets back to back. 429/503 answers are
+reported per endpoint under "rejected".
+
+Results are printed as JSON (and written with --out). --baseline compares p95/p99
+against an earlier result file and exits non-zero on regressions.
+
+    python bench.py --duration 30 --pollers 200 --sse 200 --out bench.json
+    python bench.py --backend json --baseline bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+ADMIN_USER = "bench"
+ADMIN_PASSWORD = "bench-" + uuid.uuid4().hex[:8]
+
+
+# -----------------------------
+# Minimal HTTP/1.1 client (keep-alive, no dependencies)
+# -----------------------------
+class HttpConn:
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+        self.cookies: dict[str, str] = {}
+        self.headers: dict[str, str] = {}  # sent with every request
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=1 << 22)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def send(self, method: str, path: str, body: bytes | None = None, headers: dict | None = None):
+        if self.writer is None:
+            await self._connect()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        if self.cookies:
+            lines.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+        for k, v in {**self.headers, **(headers or {})}.items():
+            lines.append(f"{k}: {v}")
+        if body is not None:
+            lines.append("Content-Type: application/json")
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b""))
+        await self.writer.drain()
+
+    async def read_head(self) -> tuple[int, dict]:
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        headers: dict[str, str] = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            k, _, v = line.partition(":")
+            k = k.strip().lower()
+            if k == "set-cookie":
+                name, _, rest = v.strip().partition("=")
+                self.cookies[name] = rest.split(";", 1)[0]
+            headers[k] = v.strip()
+        return status, headers
+
+    async def read_chunk(self) -> bytes:
+        size = int((await self.reader.readline()).split(b";")[0].strip() or b"0", 16)
+        data = await self.reader.readexactly(size) if size else b""
+        await self.reader.readline()
+        return data
+
+    async def request(self, method: str, path: str, body=None, headers: dict | None = None) -> tuple[int, bytes]:
+        payload = json.dumps(body).encode() if body is not None else None
+        for attempt in (0, 1):
+            try:
+                await self.send(method, path, payload, headers)
+                status, h = await self.read_head()
+                break
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                self.close()
+                if attempt:
+                    raise
+        if "content-length" in h:
+            data = await self.reader.readexactly(int(h["content-length"]))
+        elif h.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                chunk = await self.read_chunk()
+                if not chunk:
+                    break
+                parts.append(chunk)
+            data = b"".join(parts)
+        else:
+            data = b""
+        if h.get("connection", "").lower() == "close":
+            self.close()
+        return status, data
+
+
+# -----------------------------
+# Stats
+# -----------------------------
+def _pct(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    s = sorted(values)
+    k = max(0, min(len(s) - 1, int(round(p / 100.0 * len(s) + 0.5)) - 1))
+    return round(s[k], 3)
+
+
+def _summary(samples: list[float], errors: int, seconds: float) -> dict:
+    return {
+        "count": len(samples),
+        "errors": errors,
+        "rps": round(len(samples) / seconds, 1) if seconds else None,
+        "p50_ms": _pct(samples, 50),
+        "p95_ms": _pct(samples, 95),
+        "p99_ms": _pct(samples, 99),
+        "max_ms": round(max(samples), 3) if samples else None,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.lat: dict[str, list[float]] = {}
+        self.err: dict[str, int] = {}
+        self.rejected: dict[str, dict[str, int]] = {}  # admission control: 429 / 503
+
+    async def timed(self, name: str, conn: HttpConn, method: str, path: str, body=None):
+        t0 = time.perf_counter()
+        try:
+            status, data = await conn.request(method, path, body)
+        except Exception:
+            self.err[name] = self.err.get(name, 0) + 1
+            conn.close()
+            return None
+        if status in (429, 503):
+            by_status = self.rejected.setdefault(name, {})
+            by_status[str(status)] = by_status.get(str(status), 0) + 1
+            return None
+        if status >= 400:
+            self.err[name] = self.err.get(name, 0) + 1
+            return None
+        self.lat.setdefault(name, []).append((time.perf_counter() - t0) * 1000.0)
+        return data
+
+
+def _rss_mb(pid: int) -> float | None:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024.0, 1)
+    except Exception:
+        return None
+    return None
+
+
+# -----------------------------
+# Simulated clients
+# -----------------------------
+def _client_conn(host, port, ip: str | None) -> HttpConn:
+    """Connection for one simulated client; `ip` poses as the address our proxy saw."""
+    conn = HttpConn(host, port)
+    if ip:
+        conn.headers["X-Forwarded-For"] = ip
+    return conn
+
+
+async def poller(host, port, rec: Recorder, stop: asyncio.Event, interval: float, launch_every: int, ip=None):
+    conn = _client_conn(host, port, ip)
+    rev = lrev = ""
+    n = 0
+    await asyncio.sleep(interval * (uuid.uuid4().int % 1000) / 1000.0)  # spread the herd
+    while not stop.is_set():
+        data = await rec.timed("targets_since", conn, "GET", f"/api/targets?since={rev}" if rev else "/api/targets")
+        if data:
+            rev = str(json.loads(data).get("rev") or rev)
+        if n % launch_every == 0:
+            data = await rec.timed("launchsites_since", conn, "GET", f"/api/launchsites?since={lrev}" if lrev else "/api/launchsites")
+            if data:
+                lrev = str(json.loads(data).get("rev") or lrev)
+        n += 1
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+    conn.close()
+
+
+async def pinger(host, port, rec: Recorder, stop: asyncio.Event, interval: float, ip=None):
+    conn = _client_conn(host, port, ip)
+    sid = uuid.uuid4().hex
+    await asyncio.sleep(interval * (uuid.uuid4().int % 1000) / 1000.0)
+    while not stop.is_set():
+        await rec.timed("presence", conn, "POST", "/api/presence", {"sid": sid})
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+    conn.close()
+
+
+async def sse_subscriber(host, port, sent: dict, received: dict, state: dict, stop: asyncio.Event, ip=None):
+    conn = _client_conn(host, port, ip)
+    try:
+        await conn.send("GET", "/api/events", headers={"Accept": "text/event-stream"})
+        status, h = await conn.read_head()
+        if status in (429, 503):
+            state["rejected"] += 1
+            return
+        if status != 200:
+            state["errors"] += 1
+            return
+        state["connected"] += 1
+        buf = b""
+        while not stop.is_set():
+            chunk = await conn.read_chunk() if h.get("transfer-encoding") == "chunked" else await conn.reader.read(65536)
+            if not chunk:
+                break
+            now = time.perf_counter()
+            buf += chunk
+            while b"\n\n" in buf:
+                frame, buf = buf.split(b"\n\n", 1)
+                event, data = "", ""
+                for line in frame.decode("utf-8", "replace").split("\n"):
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data += line[5:].strip()
+                if event != "targets_changed" or not data:
+                    continue
+                state["events"] += 1
+                msg = json.loads(data)
+                rows = [msg["target"]] if msg.get("target") else (msg.get("targets") or [])
+                for t in rows:
+                    token = t.get("note") or ""
+                    if token in sent:
+                        received.setdefault(token, []).append(now)
+    except (asyncio.CancelledError, ConnectionError, asyncio.IncompleteReadError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+async def abuser(host, port, rec: Recorder, stop: asyncio.Event, ip: str):
+    """Polls the full target list back to back, ignoring ?since= and Retry-After."""
+    conn = _client_conn(host, port, ip)
+    while not stop.is_set():
+        await rec.timed("abuser_targets", conn, "GET", "/api/targets")
+        await asyncio.sleep(0)
+    conn.close()
+
+
+async def admin(host, port, rec: Recorder, stop: asyncio.Event, rate: float, seed: int, sent: dict):
+    """Moves targets around at `rate` writes/s; every write carries a token in `note`."""
+    conn = HttpConn(host, port)
+    status, _ = await conn.request("POST", "/admin/login", {"username": ADMIN_USER, "password": ADMIN_PASSWORD})
+    if status != 200:
+        raise RuntimeError(f"admin login failed: {status}")
+    await conn.request("DELETE", "/api/targets")
+    ops = [{"op": "create", "target": {"type": "shahed", "lat": 48.5, "lng": 35.9, "note": "seed"}}] * seed
+    ids = []
+    if ops:
+        _, data = await conn.request("POST", "/api/targets/batch", {"ops": ops})
+        ids = json.loads(data)["created"]
+    n = 0
+    while not stop.is_set():
+        n += 1
+        token = f"b{n}"
+        body = {"type": "shahed", "lat": 48.5 + (n % 100) / 1000.0, "lng": 35.9, "direction": n % 360, "note": token}
+        sent[token] = time.perf_counter()
+        if ids and n % 10:
+            await rec.timed("admin_update", conn, "POST", f"/api/targets/{ids[n % len(ids)]}", body)
+        else:
+            data = await rec.timed("admin_create", conn, "POST", "/api/targets", body)
+            if data:
+                ids.append(json.loads(data)["id"])
+            if len(ids) > seed + 20:
+                await rec.timed("admin_delete", conn, "DELETE", f"/api/targets/{ids.pop(0)}")
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), timeout=1.0 / rate)
+    conn.close()
+
+
+# -----------------------------
+# Scenario
+# -----------------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_ready(host: str, port: int, proc, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        conn = HttpConn(host, port)
+        try:
+            status, _ = await conn.request("GET", "/api/stats")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            conn.close()
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def _fake_ips():
+    """Distinct client addresses for scenarios behind a (simulated) proxy."""
+    n = 0
+    while True:
+        n += 1
+        yield f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+async def run_scenario(name: str, env: dict, args, distinct_ips: bool = False, abusers: int = 0) -> dict:
+    host, port = "127.0.0.1", _free_port()
+    log = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", host, "--port", str(port), "--log-level", "warning"],
+        cwd=str(APP_DIR),
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        try:
+            await _wait_ready(host, port, proc)
+        except RuntimeError:
+            log.seek(0)
+            print(log.read().decode(errors="replace")[-2000:], file=sys.stderr)
+            raise
+        rss = {"start": _rss_mb(proc.pid), "max": 0.0}
+        rec, sent, received = Recorder(), {}, {}
+        sse_state = {"connected": 0, "errors": 0, "rejected": 0, "events": 0}
+        stop = asyncio.Event()
+        ips = _fake_ips() if distinct_ips else None
+
+        def ip():
+            return next(ips) if ips else None
+
+        tasks = [asyncio.create_task(sse_subscriber(host, port, sent, received, sse_state, stop, ip())) for _ in range(args.sse)]
+        await asyncio.sleep(1.0)  # let subscribers attach before writes start
+        tasks += [asyncio.create_task(poller(host, port, rec, stop, args.poll_interval, args.launch_every, ip())) for _ in range(args.pollers)]
+        tasks += [asyncio.create_task(pinger(host, port, rec, stop, args.presence_interval, ip())) for _ in range(args.pingers)]
+        tasks += [asyncio.create_task(abuser(host, port, rec, stop, ip() or "127.0.0.1")) for _ in range(abusers)]
+        tasks.append(asyncio.create_task(admin(host, port, rec, stop, args.admin_rate, args.targets, sent)))
+
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < args.duration:
+            await asyncio.sleep(0.5)
+            rss["max"] = max(rss["max"], _rss_mb(proc.pid) or 0.0)
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await asyncio.sleep(min(2.0, args.poll_interval))  # let in-flight events land
+        for t in tasks:
+            t.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        crashed = [repr(r) for r in results if isinstance(r, Exception) and not isinstance(r, asyncio.CancelledError)]
+        rss["end"] = _rss_mb(proc.pid)
+
+        deliveries, complete, missed = [], [], 0
+        for token, t_sent in sent.items():
+            got = [(t - t_sent) * 1000.0 for t in received.get(token, [])]
+            deliveries += got
+            if len(got) >= sse_state["connected"] and got:
+                complete.append(max(got))
+            else:
+                missed += 1
+        return {
+            "duration_s": round(elapsed, 2),
+            "endpoints": {k: _summary(v, rec.err.get(k, 0), elapsed) for k, v in sorted(rec.lat.items())},
+            "errors": {k: v for k, v in rec.err.items() if k not in rec.lat},
+            "rejected": rec.rejected,
+            "sse": {
+                "subscribers": sse_state["connected"],
+                "connect_errors": sse_state["errors"],
+                "rejected": sse_state["rejected"],
+                "events_received": sse_state["events"],
+                "writes": len(sent),
+                "writes_not_fully_delivered": missed,
+                "delivery_ms": _summary(deliveries, 0, elapsed),
+                "fanout_complete_ms": _summary(complete, 0, elapsed),
+            },
+            "rss_mb": rss,
+            "client_errors": crashed[:5],
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+
+@contextlib.contextmanager
+def throwaway_postgres():
+    """Yield a DSN for a temporary local cluster, or None if initdb/pg_ctl are unavailable."""
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if not (initdb and pg_ctl):
+        yield None
+        return
+    root = Path(tempfile.mkdtemp(prefix="pvls-bench-pg-"))
+    data = root / "data"
+    started = False
+    try:
+        subprocess.run([initdb, "-D", str(data), "-U", "postgres", "-A", "trust", "--no-sync"],
+                       check=True, capture_output=True)
+        subprocess.run(
+            [pg_ctl, "-D", str(data), "-w", "-l", str(root / "pg.log"),
+             "-o", f"-k {root} -c listen_addresses='' -c fsync=off -c max_connections=200", "start"],
+            check=True, capture_output=True,
+        )
+        started = True
+        yield f"postgresql://postgres@/postgres?host={root}"
+    except subprocess.CalledProcessError as e:
+        print(f"[bench] throwaway postgres failed: {e.stderr.decode(errors='replace').strip()[:300]}", file=sys.stderr)
+        yield None
+    finally:
+        if started:
+            subprocess.run([pg_ctl, "-D", str(data), "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _base_env(args) -> dict:
+    env = {k: v for k, v in os.environ.items() if k not in {"DATABASE_URL", "STORAGE", "ADMIN_SALT", "ADMIN_PWHASH"}}
+    env.update(ADMIN_USER=ADMIN_USER, ADMIN_PASSWORD=ADMIN_PASSWORD, MAINT_ENABLED="0", PYTHONUNBUFFERED="1",
+               ADMISSION_ENABLED="0")
+    return env
+
+
+async def _run_backend(backend: str, args) -> dict:
+    env = _base_env(args)
+    if backend == "admission":
+        with tempfile.TemporaryDirectory(prefix="pvls-bench-") as d:
+            env.update(DATA_DIR=d, STORAGE="json", ADMISSION_ENABLED="1", TRUSTED_PROXY_HOPS="1")
+            return await run_scenario(backend, env, args, distinct_ips=True, abusers=args.abusers)
+    if backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory(prefix="pvls-bench-") as d:
+            env.update(DATA_DIR=d, STORAGE=backend)
+            return await run_scenario(backend, env, args)
+    dsn = args.database_url or os.getenv("BENCH_DATABASE_URL")
+    if dsn:
+        env.update(DATABASE_URL=dsn, STORAGE="postgres", DB_SSLMODE=os.getenv("BENCH_DB_SSLMODE", "disable"))
+        return await run_scenario(backend, env, args)
+    with throwaway_postgres() as dsn:
+        if dsn is None:
+            return {"skipped": "no throwaway cluster (initdb/pg_ctl missing or failed) and no BENCH_DATABASE_URL"}
+        env.update(DATABASE_URL=dsn, STORAGE="postgres", DB_SSLMODE="disable")
+        return await run_scenario(backend, env, args)
+
+
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """p95/p99 that got worse than baseline * (1 + tolerance), ignoring sub-millisecond noise."""
+    out = []
+    for backend, cur in result["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(backend) or {}
+        pairs = [(f"{backend}.{k}", v, (base.get("endpoints") or {}).get(k)) for k, v in (cur.get("endpoints") or {}).items()]
+        for k in ("delivery_ms", "fanout_complete_ms"):
+            pairs.append((f"{backend}.sse.{k}", (cur.get("sse") or {}).get(k), (base.get("sse") or {}).get(k)))
+        for name, c, b in pairs:
+            if not c or not b:
+                continue
+            for q in ("p95_ms", "p99_ms"):
+                if c.get(q) is not None and b.get(q) is not None and c[q] > max(b[q] * (1 + tolerance), b[q] + 1.0):
+                    out.append(f"{name}.{q}: {b[q]} -> {c[q]}")
+    return out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--backend", choices=["json", "sqlite", "postgres", "admission", "all"], default="all")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load per backend")
+    ap.add_argument("--pollers", type=int, default=100, help="viewers polling ?since=")
+    ap.add_argument("--poll-interval", type=float, default=2.0)
+    ap.add_argument("--launch-every", type=int, default=5, help="poll launch sites every N target polls")
+    ap.add_argument("--sse", type=int, default=100, help="SSE subscribers")
+    ap.add_argument("--pingers", type=int, default=100, help="presence pingers")
+    ap.add_argument("--presence-interval", type=float, default=15.0)
+    ap.add_argument("--admin-rate", type=float, default=5.0, help="admin writes per second")
+    ap.add_argument("--abusers", type=int, default=10, help="back-to-back pollers in the admission scenario")
+    ap.add_argument("--targets", type=int, default=50, help="targets seeded before the run")
+    ap.add_argument("--database-url", default=None, help="disposable Postgres DSN (default: throwaway cluster)")
+    ap.add_argument("--out", default=None, help="write the JSON result here")
+    ap.add_argument("--baseline", default=None, help="earlier result to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed p95/p99 growth vs baseline")
+    args = ap.parse_args()
+
+    backends = ["json", "sqlite", "postgres", "admission"] if args.backend == "all" else [args.backend]
+    result = {
+        "build": _git_rev(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in {"database_url", "out", "baseline"}},
+        "scenarios": {},
+    }
+    for backend in backends:
+        print(f"[bench] {backend}: {args.duration:g}s, {args.pollers} pollers, {args.sse} sse, "
+              f"{args.pingers} pingers, {args.admin_rate:g} writes/s", file=sys.stderr)
+        result["scenarios"][backend] = asyncio.run(_run_backend(backend, args))
+
+    regressions = []
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.tolerance)
+        result["regressions"] = regressions
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    print(text)
+    for r in regressions:
+        print(f"[bench] regression {r}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,12 @@
 import json
+import math
 import os
 import hashlib
 import hmac
 import base64
-from datetime import datetime
+import gzip
+import re
+from datetime import datetime, timezone
 try:
     from zoneinfo import ZoneInfo
 except Exception:
@@ -11,32 +14,114 @@ except Exception:
 from pathlib import Path
 from typing import Optional
 import uuid
+import random
 import time
 import asyncio
+import anyio
+import anyio.to_thread
+import select
+import sqlite3
+import bisect
+import functools
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
 # Optional Postgres (Render/Supabase)
 try:
     import psycopg2  # type: ignore
-    from psycopg2.extras import RealDictCursor  # type: ignore
+    import psycopg2.pool  # type: ignore
+    import psycopg2.sql  # type: ignore
+    from psycopg2.extras import RealDictCursor, execute_values  # type: ignore
 except Exception:
     psycopg2 = None
     RealDictCursor = None
+    execute_values = None
+
+# Optional asyncpg (native async reads for the viewer routes)
+try:
+    import asyncpg  # type: ignore
+except Exception:
+    asyncpg = None
+
+# Optional numpy (vectorized trajectory math)
+try:
+    import numpy as np  # type: ignore
+except Exception:
+    np = None
+
+# Optional brotli for pre-compressed static assets.
+try:
+    import brotli  # type: ignore
+except Exception:
+    brotli = None
+
+# Optional orjson (faster serialization of API bodies and SSE frames)
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
 
 APP_DIR = Path(__file__).resolve().parent
-DATA_PATH = APP_DIR / "targets.json"
-LAUNCH_PATH = APP_DIR / "launch_sites.json"
+# JSON storage location (defaults to the app dir; bench.py points it at a temp dir).
+DATA_DIR = Path(os.getenv("DATA_DIR") or APP_DIR)
+DATA_PATH = DATA_DIR / "targets.json"
+LAUNCH_PATH = DATA_DIR / "launch_sites.json"
 
 # Build/version string for cache-busting. Render provides RENDER_GIT_COMMIT; fall back to startup timestamp.
 BUILD_ID = os.getenv("RENDER_GIT_COMMIT") or os.getenv("GIT_COMMIT") or str(int(time.time()))
 
 def _read_template(name: str) -> str:
     p = APP_DIR / "templates" / name
-    return p.read_text(encoding="utf-8").replace("__BUILD__", BUILD_ID)
+    return _static_rewrite(p.read_text(encoding="utf-8").replace("__BUILD__", BUILD_ID))
+
+
+# Rendered pages are fixed for a given build, so each template is rendered once
+# and kept with its compressed variants and an ETag.
+_TEMPLATES: dict[str, dict] = {}
+
+
+def _template_entry(name: str) -> dict:
+    entry = _TEMPLATES.get(name)
+    if entry is None:
+        body = _read_template(name).encode("utf-8")
+        entry = {
+            "body": body,
+            "encoded": _compress_variants(body),
+            "etag": f'"{hashlib.sha256(body).hexdigest()[:16]}"',
+        }
+        _TEMPLATES[name] = entry
+    return entry
+
+
+def _preload_templates():
+    tdir = APP_DIR / "templates"
+    if tdir.exists():
+        for p in sorted(tdir.glob("*.html")):
+            _template_entry(p.name)
+
+
+def _template_response(request: Request, name: str) -> Response:
+    entry = _template_entry(name)
+    body, etag = entry["body"], entry["etag"]
+    # The same URL serves different pages depending on auth cookies; each page
+    # has its own ETag, so revalidation stays correct.
+    headers = {"Cache-Control": "no-cache, private", "Vary": "Accept-Encoding, Cookie"}
+    for enc in ("br", "gzip"):
+        if enc in entry["encoded"] and _accepts_encoding(request, enc):
+            body = entry["encoded"][enc]
+            etag = f'{etag[:-1]}-{enc}"'
+            headers["Content-Encoding"] = enc
+            break
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, headers=headers, media_type="text/html; charset=utf-8")
 
 DEFAULT_LAUNCH_NAMES = [
     "Шаталово",
@@ -156,113 +241,539 @@ def _require_admin(request: Request) -> None:
 
 
 
+# -----------------------------
+# Metrics (Prometheus text format)
+# -----------------------------
+# In-process counters and fixed-bucket histograms, rendered by GET /metrics.
+# Recording is a bisect plus a few list updates under one lock; gauges are read
+# from the existing stats dicts at scrape time.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_LOOP_LAG_S = float(os.getenv("METRICS_LOOP_LAG_S", "0.5"))
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_METRICS_LOCK = threading.Lock()
+_METRICS: list = []
+_LOOP_LAG: dict = {"task": None, "last_s": 0.0}
+
+
+def _metric_labels(names: tuple, values: tuple) -> str:
+    parts = []
+    for k, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return ",".join(parts)
+
+
+class _Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.series: dict[tuple, float] = {}
+        _METRICS.append(self)
+
+    def inc(self, *labels, n: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        with _METRICS_LOCK:
+            self.series[labels] = self.series.get(labels, 0) + n
+
+    def render(self, out: list) -> None:
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        with _METRICS_LOCK:
+            items = sorted(self.series.items())
+        for labels, v in items:
+            lbl = _metric_labels(self.labels, labels)
+            out.append(f"{self.name}{{{lbl}}} {v}" if lbl else f"{self.name} {v}")
+
+
+class _Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = _LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.series: dict[tuple, list] = {}  # labels -> per-bucket counts (+Inf last), then sum
+        _METRICS.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with _METRICS_LOCK:
+            row = self.series.get(labels)
+            if row is None:
+                row = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def render(self, out: list) -> None:
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        with _METRICS_LOCK:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        for labels, row in items:
+            lbl = _metric_labels(self.labels, labels)
+            sep = "," if lbl else ""
+            cum = 0
+            for le, c in zip(self.buckets + ("+Inf",), row[:-1]):
+                cum += c
+                out.append(f'{self.name}_bucket{{{lbl}{sep}le="{le}"}} {cum}')
+            tail = f"{{{lbl}}}" if lbl else ""
+            out.append(f"{self.name}_sum{tail} {row[-1]:.6f}")
+            out.append(f"{self.name}_count{tail} {cum}")
+
+
+_M_HTTP_REQUESTS = _Counter("pvls_http_requests_total", "HTTP requests by route template, method and status.", ("route", "method", "status"))
+_M_HTTP_LATENCY = _Histogram("pvls_http_request_duration_seconds", "Time to response headers by route template.", ("route", "method"))
+_M_DB_QUERY = _Histogram("pvls_db_query_duration_seconds", "Storage helper duration (including connection checkout).", ("helper",))
+_M_DB_ERRORS = _Counter("pvls_db_query_errors_total", "Storage helper calls that raised.", ("helper",))
+_M_DB_ACQUIRE = _Histogram("pvls_db_pool_acquire_seconds", "Time to obtain a pooled connection.", ("driver",))
+_M_JSON_CACHE = _Counter("pvls_json_cache_total", "_json_load_cached lookups.", ("file", "result"))
+_M_LOOP_LAG = _Histogram("pvls_event_loop_lag_seconds", "How late the event loop ran a timer scheduled every METRICS_LOOP_LAG_S.")
+
+
+def _timed(fn):
+    """Record duration/errors of a storage helper under its function name."""
+    name = fn.__name__.lstrip("_")
+
+    if asyncio.iscoroutinefunction(fn):
+        async def awrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                _M_DB_ERRORS.inc(name)
+                raise
+            finally:
+                _M_DB_QUERY.observe(time.perf_counter() - t0, name)
+
+        return functools.wraps(fn)(awrapper)
+
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            _M_DB_ERRORS.inc(name)
+            raise
+        finally:
+            _M_DB_QUERY.observe(time.perf_counter() - t0, name)
+
+    return functools.wraps(fn)(wrapper)
+
+
 # -----------------------------
 # DB helpers
 # -----------------------------
-def _db_conn():
-    db_url = os.getenv("DATABASE_URL")
+# Storage backend: STORAGE=postgres|sqlite|json. Unset means Postgres when DATABASE_URL
+# is configured (and psycopg2 importable), else the JSON files.
+def _storage() -> str:
+    choice = (os.getenv("STORAGE") or "").strip().lower()
+    if choice in ("sqlite", "json"):
+        return choice
+    if os.getenv("DATABASE_URL") and psycopg2 is not None:
+        return "postgres"
+    return "json"
+
+
+# Connection pool: one TLS handshake per pooled connection instead of one per query.
+# Sized by DB_POOL_MIN / DB_POOL_MAX; DB_POOL_TIMEOUT bounds how long a request waits
+# for a free connection; connections idle longer than DB_POOL_PING_S are health-checked
+# with `select 1` before being handed out.
+DB_POOL_MIN = max(0, int(os.getenv("DB_POOL_MIN", "1")))
+DB_POOL_MAX = max(1, int(os.getenv("DB_POOL_MAX", "10")))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_PING_S = float(os.getenv("DB_POOL_PING_S", "30"))
+# Optional read replicas for viewer reads (see "Read replicas" below).
+DB_REPLICA_URLS = [u.strip() for u in (os.getenv("DATABASE_REPLICA_URLS") or "").split(",") if u.strip()]
+
+_DB_POOLS: dict = {}
+_DB_POOLS_LOCK = threading.Lock()
+
+
+class _DbPool:
+    """Blocking, health-checked wrapper around psycopg2's ThreadedConnectionPool."""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self._sslmode = os.getenv("DB_SSLMODE", "require")
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            min(minconn, maxconn), maxconn, dsn, sslmode=self._sslmode
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used: dict[int, float] = {}
+        self.stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "waits": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "timeouts": 0,
+            "pings": 0,
+            "discarded": 0,
+            "errors": 0,
+        }
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last = self._last_used.get(id(conn))
+        if last is None or time.monotonic() - last < DB_POOL_PING_S:
+            return True
+        self.stats["pings"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn) -> None:
+        with self._lock:
+            self.stats["discarded"] += 1
+            self._last_used.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except Exception:
+            pass
+
+    def getconn(self):
+        t0 = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.stats["waits"] += 1
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                raise RuntimeError("DB pool exhausted")
+        try:
+            conn = None
+            for _ in range(3):
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    break
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                raise RuntimeError("DB pool could not obtain a healthy connection")
+        except Exception:
+            self._slots.release()
+            raise
+        waited = (time.monotonic() - t0) * 1000.0
+        _M_DB_ACQUIRE.observe(waited / 1000.0, "psycopg2")
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_ms_total"] += waited
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], waited)
+        return conn
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = dict(self.stats)
+            out["idle"] = len(getattr(self._pool, "_pool", []))
+            out["open"] = len(getattr(self._pool, "_used", {})) + out["idle"]
+        out["max"] = self.maxconn
+        out["wait_ms_total"] = round(out["wait_ms_total"], 2)
+        out["wait_ms_max"] = round(out["wait_ms_max"], 2)
+        return out
+
+    def closeall(self) -> None:
+        try:
+            self._pool.closeall()
+        except Exception:
+            pass
+
+
+def _db_pool(dsn: str) -> _DbPool:
+    pool = _DB_POOLS.get(dsn)
+    if pool is not None:
+        return pool
+    with _DB_POOLS_LOCK:
+        pool = _DB_POOLS.get(dsn)
+        if pool is None:
+            pool = _DbPool(dsn, DB_POOL_MIN, DB_POOL_MAX)
+            _DB_POOLS[dsn] = pool
+        return pool
+
+
+def _db_pool_stats() -> dict:
+    primary = os.getenv("DATABASE_URL")
+
+    def label(i: int, dsn: str) -> str:
+        if dsn == primary:
+            return "primary"
+        return f"replica{DB_REPLICA_URLS.index(dsn)}" if dsn in DB_REPLICA_URLS else f"pool{i}"
+
+    return {label(i, dsn): p.snapshot() for i, (dsn, p) in enumerate(list(_DB_POOLS.items()))}
+
+
+@contextmanager
+def _db_conn(migrate: bool = True, dsn: str | None = None):
+    """Borrow a pooled connection for one transaction (commit on success, rollback on error).
+
+    `dsn` selects a read replica; the default is the primary (DATABASE_URL)."""
+    db_url = dsn or os.getenv("DATABASE_URL")
     if not db_url:
         raise RuntimeError("DATABASE_URL is not set")
     if psycopg2 is None:
         raise RuntimeError("psycopg2 is not installed")
-    sslmode = os.getenv("DB_SSLMODE", "require")
-    return psycopg2.connect(db_url, sslmode=sslmode)
+    if migrate and _DB_SCHEMA["version"] is None:
+        _db_init()
+    pool = _db_pool(db_url)
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            with pool._lock:
+                pool.stats["errors"] += 1
+        raise
+    finally:
+        pool.putconn(conn, broken=broken)
+
+
+# Schema migrations: ordered, append-only steps. Pending steps are applied once per
+# process (at startup, or by the first query if the database was down then) under an
+# advisory lock, so workers starting together do not race; the applied version is
+# recorded in pvls_schema_version. Step 1 is the complete schema as of versioning
+# (including the rev/tombstone, track, zones and meta tables added before it), written
+# idempotently (if not exists, guarded backfills) so both fresh databases and every
+# pre-versioning one converge on it. Never edit an applied step; append a new one.
+_DB_MIGRATE_LOCK_KEY = 0x70766C73  # "pvls"
+_DB_SCHEMA = {"version": None, "lock": threading.Lock()}
+_DB_MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "baseline", """
+        create table if not exists pvls_targets (
+            id text primary key,
+            type text not null,
+            lat double precision not null,
+            lng double precision not null,
+            direction integer not null,
+            note text,
+            speed_kmh double precision,
+            dest_lat double precision,
+            dest_lng double precision,
+            active boolean default true,
+            created_at timestamptz default now(),
+            updated_at timestamptz default now()
+        );
+        alter table pvls_targets add column if not exists speed_kmh double precision;
+        alter table pvls_targets add column if not exists dest_lat double precision;
+        alter table pvls_targets add column if not exists dest_lng double precision;
+        alter table pvls_targets add column if not exists active boolean;
+        create table if not exists pvls_launchsites (
+            name text primary key,
+            lat double precision,
+            lng double precision,
+            active boolean default false,
+            updated_at timestamptz default now()
+        );
+        create table if not exists pvls_presence (
+            sid text primary key,
+            last_seen timestamptz not null
+        );
+        create sequence if not exists pvls_rev_seq;
+        alter table pvls_targets add column if not exists rev bigint;
+        alter table pvls_launchsites add column if not exists rev bigint;
+        update pvls_targets set rev = nextval('pvls_rev_seq') where rev is null;
+        update pvls_launchsites set rev = nextval('pvls_rev_seq') where rev is null;
+        create index if not exists pvls_targets_rev_idx on pvls_targets (rev);
+        create table if not exists pvls_tombstones (
+            entity text not null,
+            id text not null,
+            rev bigint not null,
+            deleted_at timestamptz default now(),
+            primary key (entity, id)
+        );
+        create index if not exists pvls_tombstones_rev_idx on pvls_tombstones (rev);
+        create table if not exists pvls_track (
+            id bigserial primary key,
+            target_id text not null,
+            ts timestamptz not null,
+            lat double precision not null,
+            lng double precision not null,
+            direction integer,
+            speed_kmh double precision,
+            type text
+        );
+        create index if not exists pvls_track_ts_idx on pvls_track (ts);
+        create table if not exists pvls_zones (
+            id text primary key,
+            zone jsonb not null,
+            updated_at timestamptz default now()
+        );
+        create table if not exists pvls_meta (
+            key text primary key,
+            value bigint not null
+        );
+    """),
+    (2, "read-path indexes", """
+        create index if not exists pvls_targets_updated_at_idx on pvls_targets (updated_at desc nulls last);
+        create index if not exists pvls_launchsites_rev_idx on pvls_launchsites (rev);
+        create index if not exists pvls_track_target_ts_idx on pvls_track (target_id, ts);
+    """),
+]
 
 
 def _db_init() -> None:
-    """Create tables + ensure columns exist. Safe to call multiple times."""
-    if not os.getenv("DATABASE_URL") or psycopg2 is None:
+    """Apply pending schema migrations. A no-op (no round trip) once done in this process."""
+    if _storage() != "postgres" or _DB_SCHEMA["version"] is not None:
         return
-    with _db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                create table if not exists pvls_targets (
-                    id text primary key,
-                    type text not null,
-                    lat double precision not null,
-                    lng double precision not null,
-                    direction integer not null,
-                    note text,
-                    speed_kmh double precision,
-                    dest_lat double precision,
-                    dest_lng double precision,
-                    active boolean default true,
-                    created_at timestamptz default now(),
-                    updated_at timestamptz default now()
-                );
-                """
-            )
-            # ensure columns exist for older deployments
-            cur.execute("alter table pvls_targets add column if not exists speed_kmh double precision;")
-            cur.execute("alter table pvls_targets add column if not exists dest_lat double precision;")
-            cur.execute("alter table pvls_targets add column if not exists dest_lng double precision;")
-            cur.execute("alter table pvls_targets add column if not exists active boolean;")
+    with _DB_SCHEMA["lock"]:
+        if _DB_SCHEMA["version"] is not None:
+            return
+        with _db_conn(migrate=False) as conn:
+            with conn.cursor() as cur:
+                # Transaction-scoped: released by the commit below.
+                cur.execute("select pg_advisory_xact_lock(%s);", (_DB_MIGRATE_LOCK_KEY,))
+                cur.execute(
+                    """
+                    create table if not exists pvls_schema_version (
+                        version integer primary key,
+                        name text not null,
+                        applied_at timestamptz default now()
+                    );
+                    """
+                )
+                cur.execute("select coalesce(max(version), 0) from pvls_schema_version;")
+                version = cur.fetchone()[0]
+                for step, name, ddl in _DB_MIGRATIONS:
+                    if step <= version:
+                        continue
+                    cur.execute(ddl)
+                    cur.execute("insert into pvls_schema_version (version, name) values (%s, %s);", (step, name))
+                    print(f"[INFO] schema migration {step} ({name}) applied")
+                    version = step
+        _DB_SCHEMA["version"] = version
+
+
+_TARGET_COLS = """id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, rev,
+                       to_char(created_at, 'YYYY-MM-DD"T"HH24:MI:SS') as created_at,
+                       to_char(updated_at, 'YYYY-MM-DD"T"HH24:MI:SS') as updated_at"""
+
+_LAUNCH_COLS = """name, lat, lng, active, rev,
+                       to_char(updated_at, 'YYYY-MM-DD"T"HH24:MI:SS') as updated_at"""
+
+
+# Read queries shared by the psycopg2 helpers and the asyncpg path (%s placeholders;
+# the async side converts them with _adb_sql).
+_SQL_TARGETS_ALL = f"select {_TARGET_COLS} from pvls_targets order by updated_at desc nulls last;"
+_SQL_TARGETS_SINCE = f"select {_TARGET_COLS} from pvls_targets where rev > %s order by rev asc;"
+_SQL_TOMBSTONES_ALL = "select id, rev from pvls_tombstones where entity='target';"
+_SQL_TOMBSTONES_SINCE = "select id, rev from pvls_tombstones where entity='target' and rev > %s order by rev asc;"
+_SQL_TOMBSTONE_HORIZON = "select value from pvls_meta where key='tombstone_horizon';"
+_SQL_MAX_REV = """
+    select greatest(
+        coalesce((select max(rev) from pvls_targets), 0),
+        coalesce((select max(rev) from pvls_tombstones), 0),
+        coalesce((select max(rev) from pvls_launchsites), 0)
+    ) as rev;
+"""
+_SQL_LAUNCH_ALL = f"select {_LAUNCH_COLS} from pvls_launchsites order by name asc;"
+
+
+def _db_target_row(r) -> dict:
+    return {
+        "id": r["id"],
+        "type": r["type"],
+        "lat": float(r["lat"]),
+        "lng": float(r["lng"]),
+        "direction": int(r["direction"]),
+        "note": (r.get("note") or ""),
+        "speed_kmh": float(r["speed_kmh"]) if r.get("speed_kmh") is not None else 0,
+        "dest_lat": float(r["dest_lat"]) if r.get("dest_lat") is not None else None,
+        "dest_lng": float(r["dest_lng"]) if r.get("dest_lng") is not None else None,
+        "active": bool(r.get("active")) if r.get("active") is not None else True,
+        "created_at": r.get("created_at") or _now_iso(),
+        "updated_at": r.get("updated_at") or _now_iso(),
+        "rev": int(r.get("rev") or 0),
+    }
 
-            cur.execute(
-                """
-                create table if not exists pvls_launchsites (
-                    name text primary key,
-                    lat double precision,
-                    lng double precision,
-                    active boolean default false,
-                    updated_at timestamptz default now()
-                );
-                """
-            )
-            cur.execute(
-                """
-                create table if not exists pvls_presence (
-                    sid text primary key,
-                    last_seen timestamptz not null
-                );
-                """
-            )
+
+def _db_launch_row(r) -> dict:
+    return {
+        "name": r["name"],
+        "lat": float(r["lat"]) if r.get("lat") is not None else None,
+        "lng": float(r["lng"]) if r.get("lng") is not None else None,
+        "active": bool(r.get("active")),
+        "updated_at": r.get("updated_at") or _now_iso(),
+        "rev": int(r.get("rev") or 0),
+    }
 
 
-def _db_fetch_targets() -> list[dict]:
-    _db_init()
-    with _db_conn() as conn:
+def _db_now(cur) -> str:
+    cur.execute("select to_char(now(), 'YYYY-MM-DD\"T\"HH24:MI:SS');")
+    return cur.fetchone()[0]
+
+
+# Cross-process change feed: writers NOTIFY inside their transaction (delivered on
+# commit); every worker LISTENs and applies the change to its own snapshot/SSE hub.
+NOTIFY_CHANNEL = os.getenv("DB_NOTIFY_CHANNEL", "pvls_changes")
+WORKER_ID = uuid.uuid4().hex[:12]
+
+
+def _db_notify(cur, entity: str, op: str, rev: int, **change) -> None:
+    payload = {"origin": WORKER_ID, "entity": entity, "op": op, "rev": rev, **change}
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    if len(body.encode("utf-8")) > 7900:
+        # pg_notify payloads are capped at 8000 bytes; listeners resync instead.
+        body = json.dumps({"origin": WORKER_ID, "entity": entity, "op": "resync", "rev": rev})
+    cur.execute("select pg_notify(%s, %s);", (NOTIFY_CHANNEL, body))
+
+
+# nextval() hands out revisions at call time, not in commit order: with two writers,
+# rev N+1 could commit (and be served to `?since=`) while rev N is still in flight,
+# and a client advancing to N+1 would never see N. Every writer that takes a revision
+# holds this transaction-scoped lock from before nextval() until its commit, so
+# revisions become visible strictly in order. Admin writes are few; the wait is short.
+_DB_REV_LOCK_KEY = 0x70766C72  # "pvlr"
+
+
+def _db_lock_revs(cur) -> None:
+    """Take the revision lock; call first in the transaction (before any row locks)."""
+    cur.execute("select pg_advisory_xact_lock(%s);", (_DB_REV_LOCK_KEY,))
+
+
+@_timed
+def _db_fetch_targets(dsn: str | None = None) -> list[dict]:
+    with _db_conn(dsn=dsn) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                select id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active,
-                       to_char(created_at, 'YYYY-MM-DD"T"HH24:MI:SS') as created_at,
-                       to_char(updated_at, 'YYYY-MM-DD"T"HH24:MI:SS') as updated_at
-                from pvls_targets
-                order by updated_at desc nulls last;
-                """
-            )
-            rows = cur.fetchall()
-            out: list[dict] = []
-            for r in rows:
-                out.append(
-                    {
-                        "id": r["id"],
-                        "type": r["type"],
-                        "lat": float(r["lat"]),
-                        "lng": float(r["lng"]),
-                        "direction": int(r["direction"]),
-                        "note": (r.get("note") or ""),
-                        "speed_kmh": float(r["speed_kmh"]) if r.get("speed_kmh") is not None else 0,
-                        "dest_lat": float(r["dest_lat"]) if r.get("dest_lat") is not None else None,
-                        "dest_lng": float(r["dest_lng"]) if r.get("dest_lng") is not None else None,
-                        "active": bool(r.get("active")) if r.get("active") is not None else True,
-                        "created_at": r.get("created_at") or _now_iso(),
-                        "updated_at": r.get("updated_at") or _now_iso(),
-                    }
-                )
-            return out
+            cur.execute(_SQL_TARGETS_ALL)
+            return [_db_target_row(r) for r in cur.fetchall()]
 
 
-def _db_upsert_target(t: dict) -> None:
-    _db_init()
+@_timed
+def _db_upsert_target(t: dict) -> dict:
+    """Insert/update one target and return the stored row (DB timestamps)."""
     with _db_conn() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            _db_lock_revs(cur)
             cur.execute(
-                """
-                insert into pvls_targets (id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, updated_at)
-                values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s, now())
+                f"""
+                insert into pvls_targets (id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, updated_at, rev)
+                values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s, now(), nextval('pvls_rev_seq'))
                 on conflict (id) do update set
                     type=excluded.type,
                     lat=excluded.lat,
@@ -273,7 +784,9 @@ def _db_upsert_target(t: dict) -> None:
                     dest_lat=excluded.dest_lat,
                     dest_lng=excluded.dest_lng,
                     active=excluded.active,
-                    updated_at=now();
+                    updated_at=now(),
+                    rev=excluded.rev
+                returning {_TARGET_COLS};
                 """,
                 (
                     t.get("id"),
@@ -288,54 +801,202 @@ def _db_upsert_target(t: dict) -> None:
                     bool(t.get("active")) if t.get("active") is not None else True,
                 ),
             )
+            row = _db_target_row(cur.fetchone())
+            cur.execute("delete from pvls_tombstones where entity='target' and id=%s;", (row["id"],))
+            _db_notify(cur, "targets", "upsert", row["rev"], target=row)
+            return row
+
+
+TOMBSTONE_RETENTION_H = float(os.getenv("TOMBSTONE_RETENTION_H", "48"))
+
+
+def _db_prune_tombstones(cur) -> None:
+    """Drop old tombstones and raise the horizon below which deltas are unreliable."""
+    cur.execute(
+        """
+        with p as (
+            delete from pvls_tombstones
+            where deleted_at < now() - make_interval(secs => %s)
+            returning rev
+        )
+        insert into pvls_meta (key, value)
+        select 'tombstone_horizon', max(rev) from p having max(rev) is not null
+        on conflict (key) do update set value = greatest(pvls_meta.value, excluded.value);
+        """,
+        (TOMBSTONE_RETENTION_H * 3600.0,),
+    )
 
 
-def _db_delete_target(target_id: str) -> None:
-    _db_init()
+@_timed
+def _db_delete_target(target_id: str) -> tuple[str, int]:
+    """Delete one target, leaving a tombstone; returns (DB time, rev) of the change."""
     with _db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("delete from pvls_targets where id=%s;", (target_id,))
+            _db_lock_revs(cur)
+            cur.execute(
+                """
+                with d as (delete from pvls_targets where id=%s returning id)
+                insert into pvls_tombstones (entity, id, rev, deleted_at)
+                select 'target', id, nextval('pvls_rev_seq'), now() from d
+                on conflict (entity, id) do update set rev=excluded.rev, deleted_at=excluded.deleted_at
+                returning rev;
+                """,
+                (target_id,),
+            )
+            r = cur.fetchone()
+            rev = int(r[0]) if r else 0
+            _db_prune_tombstones(cur)
+            changed_at = _db_now(cur)
+            if rev:
+                _db_notify(cur, "targets", "delete", rev, id=target_id, updated_at=changed_at)
+            return changed_at, rev
 
 
-def _db_clear_targets() -> None:
-    _db_init()
+@_timed
+def _db_clear_targets() -> tuple[str, int]:
     with _db_conn() as conn:
         with conn.cursor() as cur:
+            _db_lock_revs(cur)
+            cur.execute("select nextval('pvls_rev_seq');")
+            rev = int(cur.fetchone()[0])
+            cur.execute(
+                """
+                insert into pvls_tombstones (entity, id, rev, deleted_at)
+                select 'target', id, %s, now() from pvls_targets
+                on conflict (entity, id) do update set rev=excluded.rev, deleted_at=excluded.deleted_at;
+                """,
+                (rev,),
+            )
             cur.execute("delete from pvls_targets;")
+            _db_prune_tombstones(cur)
+            changed_at = _db_now(cur)
+            _db_notify(cur, "targets", "clear", rev, updated_at=changed_at)
+            return changed_at, rev
+
 
+@_timed
+def _db_apply_target_batch(upserts: list[dict], deletes: list[str], must_exist: set[str]) -> tuple[list[dict], dict[str, int], str]:
+    """Apply many upserts/deletes in one transaction; returns (rows, {deleted id: rev}, DB time).
 
-def _db_fetch_launchsites() -> list[dict]:
-    _db_init()
+    Ids in `must_exist` (updates) must already be stored, otherwise KeyError and nothing is written.
+    """
     with _db_conn() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                select name, lat, lng, active,
-                       to_char(updated_at, 'YYYY-MM-DD"T"HH24:MI:SS') as updated_at
-                from pvls_launchsites
-                order by name asc;
-                """
-            )
-            rows = cur.fetchall()
-            out: list[dict] = []
-            for r in rows:
-                out.append(
-                    {
-                        "name": r["name"],
-                        "lat": float(r["lat"]) if r.get("lat") is not None else None,
-                        "lng": float(r["lng"]) if r.get("lng") is not None else None,
-                        "active": bool(r.get("active")),
-                        "updated_at": r.get("updated_at") or _now_iso(),
-                    }
+            _db_lock_revs(cur)
+            if must_exist:
+                cur.execute("select id from pvls_targets where id = any(%s) for update;", (list(must_exist),))
+                missing = must_exist - {r["id"] for r in cur.fetchall()}
+                if missing:
+                    raise KeyError(sorted(missing))
+            rows: list[dict] = []
+            if upserts:
+                fetched = execute_values(
+                    cur,
+                    f"""
+                    insert into pvls_targets (id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, updated_at, rev)
+                    values %s
+                    on conflict (id) do update set
+                        type=excluded.type,
+                        lat=excluded.lat,
+                        lng=excluded.lng,
+                        direction=excluded.direction,
+                        note=excluded.note,
+                        speed_kmh=excluded.speed_kmh,
+                        dest_lat=excluded.dest_lat,
+                        dest_lng=excluded.dest_lng,
+                        active=excluded.active,
+                        updated_at=now(),
+                        rev=excluded.rev
+                    returning {_TARGET_COLS};
+                    """,
+                    [
+                        (
+                            t.get("id"),
+                            t.get("type"),
+                            t.get("lat"),
+                            t.get("lng"),
+                            t.get("direction"),
+                            t.get("note") or "",
+                            t.get("speed_kmh") or 0,
+                            t.get("dest_lat"),
+                            t.get("dest_lng"),
+                            bool(t.get("active")) if t.get("active") is not None else True,
+                        )
+                        for t in upserts
+                    ],
+                    template="(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s, now(), nextval('pvls_rev_seq'))",
+                    page_size=max(len(upserts), 1),
+                    fetch=True,
                 )
-            return out
+                rows = [_db_target_row(r) for r in fetched]
+                cur.execute(
+                    "delete from pvls_tombstones where entity='target' and id = any(%s);",
+                    ([r["id"] for r in rows],),
+                )
+            deleted: dict[str, int] = {}
+            if deletes:
+                cur.execute(
+                    """
+                    with d as (delete from pvls_targets where id = any(%s) returning id)
+                    insert into pvls_tombstones (entity, id, rev, deleted_at)
+                    select 'target', id, nextval('pvls_rev_seq'), now() from d
+                    on conflict (entity, id) do update set rev=excluded.rev, deleted_at=excluded.deleted_at
+                    returning id, rev;
+                    """,
+                    (list(deletes),),
+                )
+                deleted = {str(r["id"]): int(r["rev"]) for r in cur.fetchall()}
+                _db_prune_tombstones(cur)
+            cur.execute("select to_char(now(), 'YYYY-MM-DD\"T\"HH24:MI:SS') as now;")
+            changed_at = cur.fetchone()["now"]
+            rev = max([r["rev"] for r in rows] + list(deleted.values()) + [0])
+            if rev:
+                _db_notify(cur, "targets", "batch", rev, targets=rows, deleted=deleted, updated_at=changed_at)
+            return rows, deleted, changed_at
+
+
+@_timed
+def _db_fetch_tombstones(dsn: str | None = None) -> tuple[dict[str, int], int]:
+    """Return ({target_id: rev}, horizon) for the retained target tombstones."""
+    with _db_conn(dsn=dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute(_SQL_TOMBSTONES_ALL)
+            tombs = {str(r[0]): int(r[1]) for r in cur.fetchall()}
+            cur.execute(_SQL_TOMBSTONE_HORIZON)
+            r = cur.fetchone()
+            return tombs, (int(r[0]) if r else 0)
 
 
+@_timed
+def _db_fetch_targets_since(rev: int, dsn: str | None = None) -> dict | None:
+    """Rows changed and ids deleted after `rev`; None if `rev` predates the tombstone horizon."""
+    with _db_conn(dsn=dsn) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(_SQL_TOMBSTONE_HORIZON)
+            r = cur.fetchone()
+            if r and rev < int(r["value"]):
+                return None
+            cur.execute(_SQL_TARGETS_SINCE, (rev,))
+            changed = [_db_target_row(x) for x in cur.fetchall()]
+            cur.execute(_SQL_TOMBSTONES_SINCE, (rev,))
+            deleted = {str(x["id"]): int(x["rev"]) for x in cur.fetchall()}
+            cur.execute(_SQL_MAX_REV)
+            return {"changed": changed, "deleted": deleted, "rev": int(cur.fetchone()["rev"])}
+
+
+@_timed
+def _db_fetch_launchsites(dsn: str | None = None) -> list[dict]:
+    with _db_conn(dsn=dsn) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(_SQL_LAUNCH_ALL)
+            return [_db_launch_row(r) for r in cur.fetchall()]
+
+
+@_timed
 def _db_seed_launchsites_if_empty() -> None:
     """Seed launch sites once from json or defaults."""
-    if not os.getenv("DATABASE_URL") or psycopg2 is None:
+    if _storage() != "postgres":
         return
-    _db_init()
     with _db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("select count(*) from pvls_launchsites;")
@@ -343,6 +1004,7 @@ def _db_seed_launchsites_if_empty() -> None:
             if n > 0:
                 return
 
+            _db_lock_revs(cur)
             items = []
             if LAUNCH_PATH.exists():
                 try:
@@ -359,50 +1021,876 @@ def _db_seed_launchsites_if_empty() -> None:
                     continue
                 cur.execute(
                     """
-                    insert into pvls_launchsites (name, lat, lng, active, updated_at)
-                    values (%s,%s,%s,%s, now())
+                    insert into pvls_launchsites (name, lat, lng, active, updated_at, rev)
+                    values (%s,%s,%s,%s, now(), nextval('pvls_rev_seq'))
                     on conflict (name) do nothing;
                     """,
                     (name, s.get("lat"), s.get("lng"), bool(s.get("active"))),
                 )
 
 
-def _db_upsert_launchsite(site: dict) -> None:
-    _db_init()
+@_timed
+def _db_upsert_launchsite(site: dict) -> dict:
     _db_seed_launchsites_if_empty()
     with _db_conn() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            _db_lock_revs(cur)
             cur.execute(
-                """
-                insert into pvls_launchsites (name, lat, lng, active, updated_at)
-                values (%s,%s,%s,%s, now())
+                f"""
+                insert into pvls_launchsites (name, lat, lng, active, updated_at, rev)
+                values (%s,%s,%s,%s, now(), nextval('pvls_rev_seq'))
                 on conflict (name) do update set
                     lat=excluded.lat,
                     lng=excluded.lng,
                     active=excluded.active,
-                    updated_at=now();
+                    updated_at=now(),
+                    rev=excluded.rev
+                returning {_LAUNCH_COLS};
                 """,
                 (site.get("name"), site.get("lat"), site.get("lng"), bool(site.get("active"))),
             )
+            row = _db_launch_row(cur.fetchone())
+            _db_notify(cur, "launchsites", "upsert", row["rev"], site=row)
+            return row
+
+
+@_timed
+def _db_fetch_zones() -> list[dict]:
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("select zone from pvls_zones order by id asc;")
+            return [r[0] if isinstance(r[0], dict) else json.loads(r[0]) for r in cur.fetchall()]
+
+
+@_timed
+def _db_upsert_zone(zone: dict) -> dict:
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                insert into pvls_zones (id, zone, updated_at) values (%s, %s::jsonb, now())
+                on conflict (id) do update set zone=excluded.zone, updated_at=now();
+                """,
+                (zone["id"], json.dumps(zone, ensure_ascii=False)),
+            )
+            _db_notify(cur, "zones", "changed", 0)
+            return zone
+
+
+@_timed
+def _db_delete_zone(zone_id: str) -> bool:
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("delete from pvls_zones where id=%s;", (zone_id,))
+            found = cur.rowcount > 0
+            if found:
+                _db_notify(cur, "zones", "changed", 0)
+            return found
+
+
+@_timed
+def _db_history_insert(rows: list[tuple]) -> None:
+    """rows: (target_id, epoch ts, lat, lng, direction, speed_kmh, type)."""
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                "insert into pvls_track (target_id, ts, lat, lng, direction, speed_kmh, type) values %s;",
+                rows,
+                template="(%s, to_timestamp(%s), %s, %s, %s, %s, %s)",
+                page_size=500,
+            )
+
+
+@_timed
+def _db_history_bounds(start: float, end: float) -> tuple[int, int] | None:
+    """Id range (exclusive low, inclusive high) of points in [start, end)."""
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "select min(id), max(id) from pvls_track where ts >= to_timestamp(%s) and ts < to_timestamp(%s);",
+                (start, end),
+            )
+            lo, hi = cur.fetchone()
+            return None if lo is None else (int(lo) - 1, int(hi))
+
+
+@_timed
+def _db_history_page(after_id: int, max_id: int, start: float, end: float, target_id: str | None, limit: int) -> list[dict]:
+    with _db_conn() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                select id, target_id, extract(epoch from ts)::float8 as ts, lat, lng, direction, speed_kmh, type
+                from pvls_track
+                where id > %s and id <= %s and ts >= to_timestamp(%s) and ts < to_timestamp(%s)
+                  and (%s::text is null or target_id = %s)
+                order by id limit %s;
+                """,
+                (after_id, max_id, start, end, target_id, target_id, limit),
+            )
+            return [dict(r) for r in cur.fetchall()]
+
+
+@_timed
+def _db_history_maintain(expire_before: float, thin_from: float, thin_to: float, step_s: int) -> tuple[int, int]:
+    """Drop points before `expire_before`; keep one point per target per `step_s` in [thin_from, thin_to)."""
+    with _db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("delete from pvls_track where ts < to_timestamp(%s);", (expire_before,))
+            expired = cur.rowcount
+            cur.execute(
+                """
+                delete from pvls_track t using (
+                    select id, row_number() over (
+                        partition by target_id, floor(extract(epoch from ts) / %s) order by ts, id
+                    ) as rn
+                    from pvls_track where ts >= to_timestamp(%s) and ts < to_timestamp(%s)
+                ) d
+                where t.id = d.id and d.rn > 1;
+                """,
+                (step_s, thin_from, thin_to),
+            )
+            return expired, cur.rowcount
+
+
+# -----------------------------
+# Async DB path (viewer routes)
+# -----------------------------
+# Viewer routes are `async def` and must never block the event loop. With asyncpg
+# installed they read through a native async pool using the same SQL and row
+# formatting as the psycopg2 helpers; otherwise blocking helpers run on a small
+# dedicated thread limiter so a slow database can't eat the shared threadpool
+# that sync routes (admin writes) run on.
+DB_ASYNC = os.getenv("DB_ASYNC", "1").lower() in ("1", "true", "yes")
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+# Sync routes run in anyio's default threadpool (40 threads); 0 keeps that default.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "0"))
+# Transaction-mode poolers (pgbouncer/Supabase :6543) need the statement cache off.
+DB_ASYNC_STMT_CACHE = int(os.getenv("DB_ASYNC_STMT_CACHE", "100"))
+
+_ADB: dict = {"pool": None, "loop": None, "lock": None, "limiter": None, "errors": 0}
+
+
+def _adb_enabled() -> bool:
+    # With read replicas, viewer reads take the replica router on the DB threads instead.
+    return DB_ASYNC and asyncpg is not None and _storage() == "postgres" and not DB_REPLICA_URLS
+
+
+def _adb_sql(q: str) -> str:
+    """psycopg2 `%s` placeholders -> asyncpg `$n`."""
+    n = 0
+
+    def sub(_):
+        nonlocal n
+        n += 1
+        return f"${n}"
+
+    return re.sub(r"%s", sub, q)
+
+
+async def _adb_pool():
+    loop = asyncio.get_running_loop()
+    if _ADB["pool"] is not None and _ADB["loop"] is loop:
+        return _ADB["pool"]
+    if _ADB["loop"] is not loop:
+        _ADB.update(pool=None, loop=loop, lock=asyncio.Lock())
+    async with _ADB["lock"]:
+        if _ADB["pool"] is None:
+            if _DB_SCHEMA["version"] is None:
+                await anyio.to_thread.run_sync(_db_init)
+            _ADB["pool"] = await asyncpg.create_pool(
+                os.getenv("DATABASE_URL"),
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                ssl=os.getenv("DB_SSLMODE", "require"),
+                timeout=DB_POOL_TIMEOUT,
+                statement_cache_size=DB_ASYNC_STMT_CACHE,
+            )
+        return _ADB["pool"]
+
+
+@asynccontextmanager
+async def _adb_acquire():
+    pool = await _adb_pool()
+    t0 = time.perf_counter()
+    async with pool.acquire() as conn:
+        _M_DB_ACQUIRE.observe(time.perf_counter() - t0, "asyncpg")
+        yield conn
+
+
+async def _adb_close() -> None:
+    pool, _ADB["pool"] = _ADB["pool"], None
+    if pool is not None:
+        await pool.close()
+
+
+@_timed
+async def _adb_fetch_targets() -> list[dict]:
+    async with _adb_acquire() as conn:
+        return [_db_target_row(r) for r in await conn.fetch(_SQL_TARGETS_ALL)]
+
+
+@_timed
+async def _adb_fetch_tombstones() -> tuple[dict[str, int], int]:
+    async with _adb_acquire() as conn:
+        async with conn.transaction(readonly=True):
+            tombs = {str(r["id"]): int(r["rev"]) for r in await conn.fetch(_SQL_TOMBSTONES_ALL)}
+            horizon = await conn.fetchval(_SQL_TOMBSTONE_HORIZON)
+    return tombs, int(horizon or 0)
+
+
+@_timed
+async def _adb_fetch_targets_since(rev: int) -> dict | None:
+    async with _adb_acquire() as conn:
+        async with conn.transaction(readonly=True):
+            horizon = await conn.fetchval(_SQL_TOMBSTONE_HORIZON)
+            if horizon is not None and rev < int(horizon):
+                return None
+            changed = [_db_target_row(x) for x in await conn.fetch(_adb_sql(_SQL_TARGETS_SINCE), rev)]
+            deleted = {str(x["id"]): int(x["rev"]) for x in await conn.fetch(_adb_sql(_SQL_TOMBSTONES_SINCE), rev)}
+            max_rev = await conn.fetchval(_SQL_MAX_REV)
+    return {"changed": changed, "deleted": deleted, "rev": int(max_rev or 0)}
+
+
+@_timed
+async def _adb_fetch_launchsites() -> list[dict]:
+    async with _adb_acquire() as conn:
+        return [_db_launch_row(r) for r in await conn.fetch(_SQL_LAUNCH_ALL)]
+
+
+async def _db_run(fn, *args):
+    """Run a blocking DB/file helper off the event loop, on the dedicated limiter."""
+    if _ADB["limiter"] is None:
+        _ADB["limiter"] = anyio.CapacityLimiter(DB_THREADS)
+    return await anyio.to_thread.run_sync(fn, *args, limiter=_ADB["limiter"])
+
+
+async def _adb_call(async_fn, sync_fn, *args):
+    """asyncpg when available, else the psycopg2 helper on the DB limiter."""
+    if _adb_enabled():
+        try:
+            return await async_fn(*args)
+        except Exception as e:
+            _ADB["errors"] += 1
+            print(f"[WARN] async DB read failed, using sync path: {e}")
+    return await _db_run(sync_fn, *args)
+
+
+def _adb_stats() -> dict:
+    pool = _ADB["pool"]
+    out = {
+        "driver": "asyncpg" if _adb_enabled() else "threads",
+        "errors": _ADB["errors"],
+        "db_threads": DB_THREADS,
+        "threadpool": THREADPOOL_SIZE or None,
+    }
+    if pool is not None:
+        out["size"] = pool.get_size()
+        out["idle"] = pool.get_idle_size()
+    if _ADB["limiter"] is not None:
+        out["db_threads_busy"] = _ADB["limiter"].borrowed_tokens
+    return out
+
+
+
+# -----------------------------
+# SQLite backend (single-node)
+# -----------------------------
+# STORAGE=sqlite keeps the same tables as _DB_MIGRATIONS in a local WAL-mode file: indexed,
+# incremental, crash-safe writes without a network hop. Revisions come from a counter
+# in pvls_meta (Postgres uses pvls_rev_seq); timestamps are stored as _now_iso() text.
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH") or (DATA_DIR / "pvls.sqlite3"))
+SQLITE_BUSY_S = float(os.getenv("SQLITE_BUSY_S", "5"))
+
+_SQ_LOCAL = threading.local()
+# SQLite has a single writer; serializing here avoids busy retries between our threads.
+_SQ_WRITE_LOCK = threading.Lock()
+_SQ_INIT = {"done": False, "lock": threading.Lock()}
+
+_SQ_TARGET_COLS = "id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, rev, created_at, updated_at"
+_SQ_LAUNCH_COLS = "name, lat, lng, active, rev, updated_at"
+
+
+def _sq_connect() -> sqlite3.Connection:
+    conn = getattr(_SQ_LOCAL, "conn", None)
+    if conn is None:
+        SQLITE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(SQLITE_PATH), timeout=SQLITE_BUSY_S, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("pragma journal_mode=wal;")
+        conn.execute("pragma synchronous=normal;")
+        _SQ_LOCAL.conn = conn
+    return conn
+
+
+@contextmanager
+def _sq_conn(write: bool = False):
+    """One transaction on this thread's connection (writes take the write lock)."""
+    _sq_init()
+    conn = _sq_connect()
+    if write:
+        _SQ_WRITE_LOCK.acquire()
+    try:
+        conn.execute("begin immediate;" if write else "begin;")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("rollback;")
+            raise
+        conn.execute("commit;")
+    finally:
+        if write:
+            _SQ_WRITE_LOCK.release()
+
+
+_SQ_MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "baseline", """
+        create table if not exists pvls_targets (
+            id text primary key,
+            type text not null,
+            lat real not null,
+            lng real not null,
+            direction integer not null,
+            note text,
+            speed_kmh real,
+            dest_lat real,
+            dest_lng real,
+            active integer default 1,
+            created_at text,
+            updated_at text,
+            rev integer
+        );
+        create index if not exists pvls_targets_rev_idx on pvls_targets (rev);
+        create table if not exists pvls_launchsites (
+            name text primary key,
+            lat real,
+            lng real,
+            active integer default 0,
+            updated_at text,
+            rev integer
+        );
+        create table if not exists pvls_tombstones (
+            entity text not null,
+            id text not null,
+            rev integer not null,
+            deleted_at real not null,
+            primary key (entity, id)
+        );
+        create index if not exists pvls_tombstones_rev_idx on pvls_tombstones (rev);
+        create table if not exists pvls_meta (
+            key text primary key,
+            value integer not null
+        );
+        insert or ignore into pvls_meta (key, value) values ('rev', 0);
+        create table if not exists pvls_track (
+            id integer primary key autoincrement,
+            target_id text not null,
+            ts real not null,
+            lat real not null,
+            lng real not null,
+            direction integer,
+            speed_kmh real,
+            type text
+        );
+        create index if not exists pvls_track_ts_idx on pvls_track (ts);
+        create table if not exists pvls_zones (
+            id text primary key,
+            zone text not null,
+            updated_at real
+        );
+    """),
+    (2, "read-path indexes", """
+        create index if not exists pvls_targets_updated_at_idx on pvls_targets (updated_at);
+        create index if not exists pvls_launchsites_rev_idx on pvls_launchsites (rev);
+        create index if not exists pvls_track_target_ts_idx on pvls_track (target_id, ts);
+    """),
+]
+
+
+def _sq_init() -> None:
+    """Apply pending schema migrations (once per process; see _DB_MIGRATIONS)."""
+    if _SQ_INIT["done"]:
+        return
+    with _SQ_INIT["lock"]:
+        if _SQ_INIT["done"]:
+            return
+        conn = _sq_connect()
+        # `begin immediate` takes the database write lock: other processes wait here.
+        with _SQ_WRITE_LOCK:
+            conn.execute("begin immediate;")
+            try:
+                conn.execute(
+                    "create table if not exists pvls_schema_version (version integer primary key, name text not null, applied_at real);"
+                )
+                version = conn.execute("select coalesce(max(version), 0) from pvls_schema_version;").fetchone()[0]
+                for step, name, script in _SQ_MIGRATIONS:
+                    if step <= version:
+                        continue
+                    for stmt in script.split(";"):
+                        if stmt.strip():
+                            conn.execute(stmt)
+                    conn.execute(
+                        "insert into pvls_schema_version (version, name, applied_at) values (?, ?, ?);",
+                        (step, name, time.time()),
+                    )
+                    version = step
+            except Exception:
+                conn.execute("rollback;")
+                raise
+            conn.execute("commit;")
+        _SQ_INIT["done"] = True
+
+
+def _sq_next_revs(conn, n: int = 1) -> list[int]:
+    conn.execute("update pvls_meta set value = value + ? where key='rev';", (n,))
+    last = int(conn.execute("select value from pvls_meta where key='rev';").fetchone()[0])
+    return list(range(last - n + 1, last + 1))
+
+
+def _sq_target_params(t: dict, rev: int, now: str) -> tuple:
+    return (
+        t.get("id"),
+        t.get("type"),
+        t.get("lat"),
+        t.get("lng"),
+        t.get("direction"),
+        t.get("note") or "",
+        t.get("speed_kmh") or 0,
+        t.get("dest_lat"),
+        t.get("dest_lng"),
+        1 if (t.get("active") is None or t.get("active")) else 0,
+        t.get("created_at") or now,
+        now,
+        rev,
+    )
+
+
+def _sq_prune_tombstones(conn) -> None:
+    cutoff = time.time() - TOMBSTONE_RETENTION_H * 3600.0
+    r = conn.execute("select max(rev) from pvls_tombstones where deleted_at < ?;", (cutoff,)).fetchone()
+    if r[0] is None:
+        return
+    conn.execute("delete from pvls_tombstones where deleted_at < ?;", (cutoff,))
+    conn.execute(
+        """
+        insert into pvls_meta (key, value) values ('tombstone_horizon', ?)
+        on conflict (key) do update set value = max(value, excluded.value);
+        """,
+        (int(r[0]),),
+    )
+
+
+@_timed
+def _sq_fetch_targets() -> list[dict]:
+    with _sq_conn() as conn:
+        rows = conn.execute(f"select {_SQ_TARGET_COLS} from pvls_targets order by updated_at desc;").fetchall()
+        return [_db_target_row(dict(r)) for r in rows]
+
+
+@_timed
+def _sq_apply_target_batch(upserts: list[dict], deletes: list[str], must_exist: set[str]) -> tuple[list[dict], dict[str, int], str]:
+    """Same contract as _db_apply_target_batch."""
+    now = _now_iso()
+    with _sq_conn(write=True) as conn:
+        if must_exist:
+            ids = list(must_exist)
+            found = {
+                r[0] for r in conn.execute(
+                    f"select id from pvls_targets where id in ({','.join('?' * len(ids))});", ids
+                )
+            }
+            missing = must_exist - found
+            if missing:
+                raise KeyError(sorted(missing))
+        rows: list[dict] = []
+        if upserts:
+            revs = _sq_next_revs(conn, len(upserts))
+            conn.executemany(
+                """
+                insert into pvls_targets (id, type, lat, lng, direction, note, speed_kmh, dest_lat, dest_lng, active, created_at, updated_at, rev)
+                values (?,?,?,?,?,?,?,?,?,?,?,?,?)
+                on conflict (id) do update set
+                    type=excluded.type,
+                    lat=excluded.lat,
+                    lng=excluded.lng,
+                    direction=excluded.direction,
+                    note=excluded.note,
+                    speed_kmh=excluded.speed_kmh,
+                    dest_lat=excluded.dest_lat,
+                    dest_lng=excluded.dest_lng,
+                    active=excluded.active,
+                    updated_at=excluded.updated_at,
+                    rev=excluded.rev;
+                """,
+                [_sq_target_params(t, rev, now) for t, rev in zip(upserts, revs)],
+            )
+            ids = [t.get("id") for t in upserts]
+            marks = ",".join("?" * len(ids))
+            conn.execute(f"delete from pvls_tombstones where entity='target' and id in ({marks});", ids)
+            rows = [
+                _db_target_row(dict(r))
+                for r in conn.execute(f"select {_SQ_TARGET_COLS} from pvls_targets where id in ({marks}) order by rev;", ids)
+            ]
+        deleted: dict[str, int] = {}
+        if deletes:
+            marks = ",".join("?" * len(deletes))
+            existing = [r[0] for r in conn.execute(f"select id from pvls_targets where id in ({marks});", list(deletes))]
+            if existing:
+                revs = _sq_next_revs(conn, len(existing))
+                deleted = dict(zip(existing, revs))
+                conn.execute(f"delete from pvls_targets where id in ({','.join('?' * len(existing))});", existing)
+                conn.executemany(
+                    "insert or replace into pvls_tombstones (entity, id, rev, deleted_at) values ('target', ?, ?, ?);",
+                    [(tid, rev, time.time()) for tid, rev in deleted.items()],
+                )
+            _sq_prune_tombstones(conn)
+        return rows, deleted, now
+
+
+# Single-row wrappers; not @_timed, the batch they delegate to records the write once.
+def _sq_upsert_target(t: dict) -> dict:
+    rows, _, _ = _sq_apply_target_batch([t], [], set())
+    return rows[0]
+
+
+def _sq_delete_target(target_id: str) -> tuple[str, int]:
+    _, deleted, changed_at = _sq_apply_target_batch([], [target_id], set())
+    return changed_at, deleted.get(target_id, 0)
+
+
+@_timed
+def _sq_clear_targets() -> tuple[str, int]:
+    now = _now_iso()
+    with _sq_conn(write=True) as conn:
+        rev = _sq_next_revs(conn)[0]
+        conn.execute(
+            """
+            insert or replace into pvls_tombstones (entity, id, rev, deleted_at)
+            select 'target', id, ?, ? from pvls_targets;
+            """,
+            (rev, time.time()),
+        )
+        conn.execute("delete from pvls_targets;")
+        _sq_prune_tombstones(conn)
+        return now, rev
+
+
+@_timed
+def _sq_fetch_tombstones() -> tuple[dict[str, int], int]:
+    with _sq_conn() as conn:
+        tombs = {str(r[0]): int(r[1]) for r in conn.execute(_SQL_TOMBSTONES_ALL)}
+        r = conn.execute(_SQL_TOMBSTONE_HORIZON).fetchone()
+        return tombs, (int(r[0]) if r else 0)
+
+
+@_timed
+def _sq_fetch_targets_since(rev: int) -> dict | None:
+    with _sq_conn() as conn:
+        r = conn.execute(_SQL_TOMBSTONE_HORIZON).fetchone()
+        if r and rev < int(r[0]):
+            return None
+        changed = [
+            _db_target_row(dict(x))
+            for x in conn.execute(f"select {_SQ_TARGET_COLS} from pvls_targets where rev > ? order by rev asc;", (rev,))
+        ]
+        deleted = {
+            str(x[0]): int(x[1])
+            for x in conn.execute("select id, rev from pvls_tombstones where entity='target' and rev > ? order by rev asc;", (rev,))
+        }
+        cur_rev = int(conn.execute("select value from pvls_meta where key='rev';").fetchone()[0])
+        return {"changed": changed, "deleted": deleted, "rev": cur_rev}
+
+
+@_timed
+def _sq_fetch_launchsites() -> list[dict]:
+    with _sq_conn() as conn:
+        rows = conn.execute(f"select {_SQ_LAUNCH_COLS} from pvls_launchsites order by name asc;").fetchall()
+        return [_db_launch_row(dict(r)) for r in rows]
+
+
+@_timed
+def _sq_upsert_launchsite(site: dict) -> dict:
+    now = _now_iso()
+    with _sq_conn(write=True) as conn:
+        rev = _sq_next_revs(conn)[0]
+        conn.execute(
+            """
+            insert into pvls_launchsites (name, lat, lng, active, updated_at, rev)
+            values (?,?,?,?,?,?)
+            on conflict (name) do update set
+                lat=excluded.lat,
+                lng=excluded.lng,
+                active=excluded.active,
+                updated_at=excluded.updated_at,
+                rev=excluded.rev;
+            """,
+            (site.get("name"), site.get("lat"), site.get("lng"), 1 if site.get("active") else 0, now, rev),
+        )
+        r = conn.execute(f"select {_SQ_LAUNCH_COLS} from pvls_launchsites where name=?;", (site.get("name"),)).fetchone()
+        return _db_launch_row(dict(r))
+
+
+@_timed
+def _sq_seed_launchsites_if_empty() -> None:
+    """Seed launch sites once from json or defaults."""
+    with _sq_conn(write=True) as conn:
+        if conn.execute("select count(*) from pvls_launchsites;").fetchone()[0]:
+            return
+        items = []
+        if LAUNCH_PATH.exists():
+            try:
+                items = json.load(open(LAUNCH_PATH, "r", encoding="utf-8")) or []
+            except Exception:
+                items = []
+        if not items:
+            items = [{"name": n, "lat": None, "lng": None, "active": False} for n in DEFAULT_LAUNCH_NAMES]
+        items = [s for s in items if (s.get("name") or "").strip()]
+        revs = _sq_next_revs(conn, len(items)) if items else []
+        now = _now_iso()
+        conn.executemany(
+            "insert or ignore into pvls_launchsites (name, lat, lng, active, updated_at, rev) values (?,?,?,?,?,?);",
+            [
+                ((s.get("name") or "").strip()[:80], s.get("lat"), s.get("lng"), 1 if s.get("active") else 0, now, rev)
+                for s, rev in zip(items, revs)
+            ],
+        )
+
+
+@_timed
+def _sq_fetch_zones() -> list[dict]:
+    with _sq_conn() as conn:
+        return [json.loads(r["zone"]) for r in conn.execute("select zone from pvls_zones order by id asc;").fetchall()]
+
+
+@_timed
+def _sq_upsert_zone(zone: dict) -> dict:
+    with _sq_conn(write=True) as conn:
+        conn.execute(
+            "insert or replace into pvls_zones (id, zone, updated_at) values (?,?,?);",
+            (zone["id"], json.dumps(zone, ensure_ascii=False), time.time()),
+        )
+        return zone
+
+
+@_timed
+def _sq_delete_zone(zone_id: str) -> bool:
+    with _sq_conn(write=True) as conn:
+        return conn.execute("delete from pvls_zones where id=?;", (zone_id,)).rowcount > 0
+
+
+@_timed
+def _sq_history_insert(rows: list[tuple]) -> None:
+    with _sq_conn(write=True) as conn:
+        conn.executemany(
+            "insert into pvls_track (target_id, ts, lat, lng, direction, speed_kmh, type) values (?,?,?,?,?,?,?);",
+            rows,
+        )
+
+
+@_timed
+def _sq_history_bounds(start: float, end: float) -> tuple[int, int] | None:
+    with _sq_conn() as conn:
+        lo, hi = conn.execute("select min(id), max(id) from pvls_track where ts >= ? and ts < ?;", (start, end)).fetchone()
+        return None if lo is None else (int(lo) - 1, int(hi))
+
+
+@_timed
+def _sq_history_page(after_id: int, max_id: int, start: float, end: float, target_id: str | None, limit: int) -> list[dict]:
+    with _sq_conn() as conn:
+        rows = conn.execute(
+            """
+            select id, target_id, ts, lat, lng, direction, speed_kmh, type
+            from pvls_track
+            where id > ? and id <= ? and ts >= ? and ts < ? and (? is null or target_id = ?)
+            order by id limit ?;
+            """,
+            (after_id, max_id, start, end, target_id, target_id, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+@_timed
+def _sq_history_maintain(expire_before: float, thin_from: float, thin_to: float, step_s: int) -> tuple[int, int]:
+    with _sq_conn(write=True) as conn:
+        expired = conn.execute("delete from pvls_track where ts < ?;", (expire_before,)).rowcount
+        thinned = conn.execute(
+            """
+            delete from pvls_track where id in (
+                select id from (
+                    select id, row_number() over (
+                        partition by target_id, cast(ts / ? as integer) order by ts, id
+                    ) as rn
+                    from pvls_track where ts >= ? and ts < ?
+                ) where rn > 1
+            );
+            """,
+            (step_s, thin_from, thin_to),
+        ).rowcount
+        return expired, thinned
+
+
+# -----------------------------
+# Read replicas (Postgres)
+# -----------------------------
+# With DATABASE_REPLICA_URLS (comma-separated) the viewer-side reads (snapshot loads,
+# tombstones, `since` catch-ups) go to a replica, round-robin; writes, migrations and
+# LISTEN stay on DATABASE_URL. A replica is used only when it has replayed at least the
+# newest revision this worker knows of (the floor: its snapshot revs, which include its
+# own writes and NOTIFY'd ones, and the primary's revision read once at the first
+# load, so a new worker does not start behind the others); 0 means no floor. Lagging
+# replicas are passed over for that read; failing ones are skipped for
+# REPLICA_RETRY_S. With no replica able to answer, the read goes to the primary.
+REPLICA_RETRY_S = float(os.getenv("REPLICA_RETRY_S", "30"))
+
+_REPLICA: dict = {"next": 0, "benched": {}, "seen": {}, "start_rev": None, "replica_reads": 0, "primary_reads": 0, "lagging": 0, "errors": 0}
+
+
+@_timed
+def _db_max_rev(dsn: str | None = None) -> int:
+    with _db_conn(dsn=dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute(_SQL_MAX_REV)
+            return int(cur.fetchone()[0] or 0)
+
+
+def _db_read_floor() -> int:
+    if _REPLICA["start_rev"] is None:
+        _REPLICA["start_rev"] = _db_max_rev()
+    return max(_TARGETS_SNAP["rev"], _LAUNCH_SNAP["rev"], _REPLICA["start_rev"])
+
+
+def _db_replica_read(fn, *args, floor: int):
+    """Run read helper `fn` on a replica that has reached `floor`, else on the primary."""
+    n = len(DB_REPLICA_URLS)
+    start = _REPLICA["next"] % n
+    _REPLICA["next"] = start + 1
+    now = time.monotonic()
+    for k in range(n):
+        dsn = DB_REPLICA_URLS[(start + k) % n]
+        if _REPLICA["benched"].get(dsn, 0.0) > now:
+            continue
+        try:
+            # Replicas only move forward, so a read after this check sees >= floor, and
+            # a revision seen once need not be asked for again.
+            if _REPLICA["seen"].get(dsn, 0) < floor:
+                _REPLICA["seen"][dsn] = _db_max_rev(dsn=dsn)
+                if _REPLICA["seen"][dsn] < floor:
+                    _REPLICA["lagging"] += 1
+                    continue
+            out = fn(*args, dsn=dsn)
+        except Exception as e:
+            _REPLICA["errors"] += 1
+            _REPLICA["benched"][dsn] = now + REPLICA_RETRY_S
+            print(f"[WARN] replica read failed, skipping it for {REPLICA_RETRY_S:g}s: {e}")
+            continue
+        _REPLICA["replica_reads"] += 1
+        return out
+    _REPLICA["primary_reads"] += 1
+    return fn(*args)
+
+
+def _db_read_targets() -> list[dict]:
+    if not DB_REPLICA_URLS:
+        return _db_fetch_targets()
+    return _db_replica_read(_db_fetch_targets, floor=_db_read_floor())
+
+
+def _db_read_tombstones() -> tuple[dict[str, int], int]:
+    if not DB_REPLICA_URLS:
+        return _db_fetch_tombstones()
+    return _db_replica_read(_db_fetch_tombstones, floor=_db_read_floor())
 
 
+def _db_read_targets_since(rev: int) -> dict | None:
+    if not DB_REPLICA_URLS:
+        return _db_fetch_targets_since(rev)
+    # The caller already holds `rev`: the answer must not be older than that either.
+    return _db_replica_read(_db_fetch_targets_since, rev, floor=max(rev, _db_read_floor()))
+
+
+def _db_read_launchsites() -> list[dict]:
+    if not DB_REPLICA_URLS:
+        return _db_fetch_launchsites()
+    return _db_replica_read(_db_fetch_launchsites, floor=_db_read_floor())
+
+
+def _replica_stats() -> dict | None:
+    if not DB_REPLICA_URLS:
+        return None
+    now = time.monotonic()
+    out = {k: v for k, v in _REPLICA.items() if k not in ("next", "benched", "seen", "start_rev")}
+    out["floor"] = max(_TARGETS_SNAP["rev"], _LAUNCH_SNAP["rev"], _REPLICA["start_rev"] or 0)
+    out["replicas"] = len(DB_REPLICA_URLS)
+    out["benched"] = sum(1 for t in _REPLICA["benched"].values() if t > now)
+    return out
+
+
+# Row-store operations per backend; JSON mode has none and uses the file helpers.
+_SQL_BACKENDS = {
+    "postgres": {
+        "init": _db_init,
+        "seed_launchsites": _db_seed_launchsites_if_empty,
+        "fetch_targets": _db_read_targets,
+        "fetch_targets_since": _db_read_targets_since,
+        "fetch_tombstones": _db_read_tombstones,
+        "upsert_target": _db_upsert_target,
+        "delete_target": _db_delete_target,
+        "clear_targets": _db_clear_targets,
+        "apply_target_batch": _db_apply_target_batch,
+        "fetch_launchsites": _db_read_launchsites,
+        "upsert_launchsite": _db_upsert_launchsite,
+        "history_insert": _db_history_insert,
+        "history_bounds": _db_history_bounds,
+        "history_page": _db_history_page,
+        "history_maintain": _db_history_maintain,
+        "fetch_zones": _db_fetch_zones,
+        "upsert_zone": _db_upsert_zone,
+        "delete_zone": _db_delete_zone,
+    },
+    "sqlite": {
+        "init": _sq_init,
+        "seed_launchsites": _sq_seed_launchsites_if_empty,
+        "fetch_targets": _sq_fetch_targets,
+        "fetch_targets_since": _sq_fetch_targets_since,
+        "fetch_tombstones": _sq_fetch_tombstones,
+        "upsert_target": _sq_upsert_target,
+        "delete_target": _sq_delete_target,
+        "clear_targets": _sq_clear_targets,
+        "apply_target_batch": _sq_apply_target_batch,
+        "fetch_launchsites": _sq_fetch_launchsites,
+        "upsert_launchsite": _sq_upsert_launchsite,
+        "history_insert": _sq_history_insert,
+        "history_bounds": _sq_history_bounds,
+        "history_page": _sq_history_page,
+        "history_maintain": _sq_history_maintain,
+        "fetch_zones": _sq_fetch_zones,
+        "upsert_zone": _sq_upsert_zone,
+        "delete_zone": _sq_delete_zone,
+    },
+}
+
+
+def _sql_backend() -> dict | None:
+    return _SQL_BACKENDS.get(_storage())
 
 
 # -----------------------------
 # Hot-path caches (reduce load under many viewers)
 # -----------------------------
-_TARGETS_RESP_CACHE: dict = {"ts": 0.0, "since": None, "updated_at": None, "payload": None}
-_LAUNCH_RESP_CACHE: dict = {"ts": 0.0, "since": None, "updated_at": None, "payload": None}
+# Pre-serialized GET bodies, swapped as a whole by the snapshot code below.
+_TARGETS_RESP_CACHE: dict = {"ts": 0.0, "updated_at": None, "payload": None}
+_LAUNCH_RESP_CACHE: dict = {"ts": 0.0, "updated_at": None, "payload": None}
 
 # JSON file parse cache (only for JSON fallback mode)
 _JSON_TARGETS_CACHE: dict = {"mtime": None, "items": []}
 _JSON_LAUNCH_CACHE: dict = {"mtime": None, "items": []}
 
-def _db_max_updated_at(table: str) -> str | None:
+@_timed
+def _db_max_updated_at(table: str, dsn: str | None = None) -> str | None:
     """Return max(updated_at) as ISO string for pvls_targets/pvls_launchsites."""
-    if not os.getenv("DATABASE_URL") or psycopg2 is None:
+    if _storage() != "postgres":
         return None
-    _db_init()
     q = None
     if table == "pvls_targets":
         q = "select to_char(max(updated_at), 'YYYY-MM-DD\"T\"HH24:MI:SS') as m from pvls_targets;"
@@ -411,7 +1899,7 @@ def _db_max_updated_at(table: str) -> str | None:
     else:
         return None
     try:
-        with _db_conn() as conn:
+        with _db_conn(dsn=dsn) as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(q)
                 r = cur.fetchone() or {}
@@ -427,7 +1915,9 @@ def _json_load_cached(path: Path, cache: dict) -> list[dict]:
             return []
         mtime = path.stat().st_mtime
         if cache.get("mtime") == mtime and isinstance(cache.get("items"), list):
+            _M_JSON_CACHE.inc(path.name, "hit")
             return cache["items"]
+        _M_JSON_CACHE.inc(path.name, "miss")
         with open(path, "r", encoding="utf-8") as f:
             items = json.load(f) or []
         cache["mtime"] = mtime
@@ -462,37 +1952,167 @@ def _since_not_changed(since: str | None, updated_at: str | None) -> bool:
 # -----------------------------
 # JSON fallback helpers
 # -----------------------------
+def _load_targets_strict() -> list[dict]:
+    be = _sql_backend()
+    if be:
+        return be["fetch_targets"]()
+    items = _json_load_cached(DATA_PATH, _JSON_TARGETS_CACHE) if DATA_PATH.exists() else []
+    return _journal_replay([dict(x) for x in items])
+
+
 def _load_targets() -> list[dict]:
     try:
-        if os.getenv("DATABASE_URL") and psycopg2 is not None:
-            return _db_fetch_targets()
-        if not DATA_PATH.exists():
-            return []
-        return _json_load_cached(DATA_PATH, _JSON_TARGETS_CACHE)
+        return _load_targets_strict()
     except Exception:
         return []
 
 
 def _save_targets(items: list[dict]) -> None:
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        for t in items:
-            _db_upsert_target(t)
+    be = _sql_backend()
+    if be:
+        if items:
+            be["apply_target_batch"](items, [], set())
         return
     tmp = str(DATA_PATH) + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
         json.dump(items, f, ensure_ascii=False, indent=2)
+        if JOURNAL_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
     os.replace(tmp, DATA_PATH)
 
 
-def _load_launch_sites() -> list[dict]:
-    # DB first
-    try:
-        if os.getenv("DATABASE_URL") and psycopg2 is not None:
-            _db_seed_launchsites_if_empty()
-            return _db_fetch_launchsites()
-    except Exception:
-        pass
-
+# JSON mode writes append one line per mutation to targets.journal.jsonl instead of
+# rewriting targets.json; a background thread folds the journal back into the
+# (still indented, human-readable) targets.json. Loading = targets.json + replay.
+# Compaction first renames the journal to .compacting, so a crash at any point
+# leaves snapshot + .compacting + journal, which replays to the same state.
+# Assumes a single writer process, like the whole-file format did.
+JOURNAL_PATH = DATA_DIR / "targets.journal.jsonl"
+JOURNAL_COMPACTING_PATH = DATA_DIR / "targets.journal.compacting.jsonl"
+JOURNAL_FSYNC = _truthy_env("JOURNAL_FSYNC", default="1")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(256 * 1024)))
+JOURNAL_COMPACT_IDLE_S = float(os.getenv("JOURNAL_COMPACT_IDLE_S", "30"))
+_JOURNAL_LOCK = threading.Lock()
+_JOURNAL_COMPACT_LOCK = threading.Lock()
+_JOURNAL: dict = {"thread": None, "stop": threading.Event(), "checked": False, "last_append": 0.0,
+                  "appended": 0, "compactions": 0, "errors": 0}
+
+
+def _journal_append(records: list[dict]) -> None:
+    """Append mutations ({"op": "upsert"|"delete"|"clear", ...}) as one write."""
+    if not records:
+        return
+    data = b"".join(_json_bytes(r) + b"\n" for r in records)
+    with _JOURNAL_LOCK:
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        with open(JOURNAL_PATH, "ab") as f:
+            if not _JOURNAL["checked"]:
+                # A crash mid-append can leave a torn last line; start ours on a fresh one.
+                if f.tell() > 0:
+                    with open(JOURNAL_PATH, "rb") as rf:
+                        rf.seek(-1, os.SEEK_END)
+                        if rf.read(1) != b"\n":
+                            f.write(b"\n")
+                _JOURNAL["checked"] = True
+            f.write(data)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        _JOURNAL["appended"] += len(records)
+        _JOURNAL["last_append"] = time.time()
+
+
+def _journal_replay(items: list[dict], paths=(JOURNAL_COMPACTING_PATH, JOURNAL_PATH)) -> list[dict]:
+    by_id = {str(x.get("id")): x for x in items if x.get("id")}
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue  # torn line from a crash
+                op = rec.get("op")
+                if op == "upsert" and isinstance(rec.get("target"), dict):
+                    t = rec["target"]
+                    cur = by_id.get(str(t.get("id")))
+                    if cur is None or int(cur.get("rev") or 0) <= int(t.get("rev") or 0):
+                        by_id[str(t.get("id"))] = t
+                elif op == "delete":
+                    by_id.pop(str(rec.get("id")), None)
+                elif op == "clear":
+                    by_id.clear()
+    return list(by_id.values())
+
+
+def _journal_compact() -> bool:
+    """Fold the journal into targets.json; returns True if there was anything to fold.
+
+    Works from the files, not the in-memory snapshot, so it never races the writers.
+    """
+    with _JOURNAL_COMPACT_LOCK:
+        with _JOURNAL_LOCK:
+            pending = JOURNAL_PATH.exists() and JOURNAL_PATH.stat().st_size > 0
+            if not pending and not JOURNAL_COMPACTING_PATH.exists():
+                return False
+            if pending:
+                if JOURNAL_COMPACTING_PATH.exists():
+                    # Leftover from an interrupted compaction: keep both, in order.
+                    with open(JOURNAL_COMPACTING_PATH, "ab") as dst, open(JOURNAL_PATH, "rb") as src:
+                        dst.write(src.read())
+                    JOURNAL_PATH.unlink()
+                else:
+                    os.replace(JOURNAL_PATH, JOURNAL_COMPACTING_PATH)
+                _JOURNAL["checked"] = False
+        base = []
+        if DATA_PATH.exists():
+            with open(DATA_PATH, "r", encoding="utf-8") as f:
+                base = json.load(f) or []
+        _save_targets(_journal_replay(base, (JOURNAL_COMPACTING_PATH,)))
+        JOURNAL_COMPACTING_PATH.unlink(missing_ok=True)
+        _JOURNAL["compactions"] += 1
+        return True
+
+
+def _journal_compact_loop(stop: threading.Event) -> None:
+    while not stop.wait(min(5.0, JOURNAL_COMPACT_IDLE_S)):
+        try:
+            size = JOURNAL_PATH.stat().st_size if JOURNAL_PATH.exists() else 0
+            idle = time.time() - _JOURNAL["last_append"] >= JOURNAL_COMPACT_IDLE_S
+            if size >= JOURNAL_COMPACT_BYTES or (idle and (size or JOURNAL_COMPACTING_PATH.exists())):
+                _journal_compact()
+        except Exception as e:
+            _JOURNAL["errors"] += 1
+            print(f"[WARN] journal compaction failed: {e}")
+
+
+def _start_journal_compactor() -> None:
+    if _storage() != "json" or _JOURNAL["thread"] is not None:
+        return
+    _JOURNAL["stop"].clear()
+    th = threading.Thread(target=_journal_compact_loop, args=(_JOURNAL["stop"],), name="pvls-journal", daemon=True)
+    _JOURNAL["thread"] = th
+    th.start()
+
+
+def _journal_stats() -> dict:
+    out = {k: v for k, v in _JOURNAL.items() if k not in ("thread", "stop", "checked")}
+    out["bytes"] = JOURNAL_PATH.stat().st_size if JOURNAL_PATH.exists() else 0
+    return out
+
+
+def _load_launch_sites() -> list[dict]:
+    # DB first
+    be = _sql_backend()
+    try:
+        if be:
+            be["seed_launchsites"]()
+            return be["fetch_launchsites"]()
+    except Exception:
+        pass
+
     # JSON fallback
     if not LAUNCH_PATH.exists():
         items = [{"name": n, "lat": None, "lng": None, "active": False} for n in DEFAULT_LAUNCH_NAMES]
@@ -506,9 +2126,10 @@ def _load_launch_sites() -> list[dict]:
 
 
 def _save_launch_sites(items: list[dict]) -> None:
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
+    be = _sql_backend()
+    if be:
         for s in items:
-            _db_upsert_launchsite(s)
+            be["upsert_launchsite"](s)
         return
     tmp = str(LAUNCH_PATH) + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
@@ -516,6 +2137,1327 @@ def _save_launch_sites(items: list[dict]) -> None:
     os.replace(tmp, LAUNCH_PATH)
 
 
+# -----------------------------
+# In-memory snapshot (viewer reads never touch storage)
+# -----------------------------
+# Targets and launch sites are loaded once per process and then updated in place by
+# the admin write endpoints; the serialized response body is rebuilt on each write
+# and kept in _TARGETS_RESP_CACHE/_LAUNCH_RESP_CACHE, so GET handlers only return bytes.
+#
+# Every write carries a revision (`rev`, shared by targets and launch sites). Deleted
+# target ids are kept as tombstones {id: rev} so `?since=<rev>` can answer with a delta;
+# clients older than `horizon` (tombstones dropped) get the full list instead.
+_SNAP_LOCK = threading.RLock()
+_TARGETS_SNAP: dict = {"loaded": False, "tried": 0.0, "items": {}, "marker": None, "rev": 0, "tombs": {}, "horizon": 0}
+_LAUNCH_SNAP: dict = {"loaded": False, "tried": 0.0, "items": {}, "marker": None, "rev": 0}
+# JSON mode: last revision handed out. A snapshot's own "rev" only moves when the row
+# carrying it is applied, so `?since=` never reports a rev whose change is missing.
+_REV_ALLOC: dict = {"last": 0}
+SNAPSHOT_RETRY_S = float(os.getenv("SNAPSHOT_RETRY_S", "2"))
+TOMBSTONE_MAX = max(100, int(os.getenv("TOMBSTONE_MAX", "10000")))
+
+
+def _json_bytes(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # e.g. ints beyond 64 bits; the stdlib copes
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class _FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return _json_bytes(content)
+
+
+def _snap_rebuild_targets() -> None:
+    global _TARGETS_RESP_CACHE
+    items = sorted(
+        _TARGETS_SNAP["items"].values(),
+        key=lambda x: (x.get("updated_at") or x.get("created_at") or ""),
+        reverse=True,
+    )
+    updated_at = _get_targets_updated_at(items)
+    marker = _TARGETS_SNAP.get("marker")
+    if marker and str(marker) > str(updated_at):
+        updated_at = marker
+    rev = _TARGETS_SNAP["rev"]
+    _TARGETS_RESP_CACHE = {
+        "ts": time.time(),
+        "rev": rev,
+        "updated_at": updated_at,
+        "payload": _json_bytes({"rev": rev, "updated_at": updated_at, "targets": items}),
+        "items": items,
+        "grid": _grid_build(items),
+    }
+    _geo_wake()
+    _publish_wake()
+
+
+def _snap_rebuild_launch() -> None:
+    global _LAUNCH_RESP_CACHE
+    items = sorted(_LAUNCH_SNAP["items"].values(), key=lambda x: x.get("name") or "")
+    updated_at = _get_launch_updated_at(items)
+    marker = _LAUNCH_SNAP.get("marker")
+    if marker and str(marker) > str(updated_at):
+        updated_at = marker
+    rev = _LAUNCH_SNAP["rev"]
+    _LAUNCH_RESP_CACHE = {
+        "ts": time.time(),
+        "rev": rev,
+        "updated_at": updated_at,
+        "payload": _json_bytes({"rev": rev, "updated_at": updated_at, "sites": items}),
+        "items": items,
+    }
+    _publish_wake()
+
+
+def _snap_load_tombstones(snap: dict) -> None:
+    be = _sql_backend()
+    if be:
+        tombs, horizon = be["fetch_tombstones"]()
+        snap["tombs"] = tombs
+        snap["horizon"] = horizon
+        snap["rev"] = max([snap["rev"], *tombs.values()])
+    else:
+        # JSON mode keeps no delete history across restarts: deltas start from here.
+        # Start above any published snapshot so /snapshots/<rev>.json stays immutable.
+        snap["rev"] = max(snap["rev"], _publish_floor())
+        snap["tombs"] = {}
+        snap["horizon"] = snap["rev"]
+
+
+def _snap_load(snap: dict, loader, key: str, rebuild, after=None) -> None:
+    with _SNAP_LOCK:
+        if snap["loaded"] or time.time() - snap["tried"] < SNAPSHOT_RETRY_S:
+            return
+        snap["tried"] = time.time()
+        try:
+            items = loader() or []
+            snap["items"] = {str(x.get(key)): dict(x) for x in items if x.get(key)}
+            snap["rev"] = max((int(x.get("rev") or 0) for x in items), default=0)
+            if after:
+                after(snap)
+        except Exception as e:
+            print(f"[WARN] snapshot load failed ({key}): {e}")
+            return
+        snap["marker"] = None
+        snap["loaded"] = True
+        rebuild()
+
+
+def _snap_targets() -> dict:
+    if not _TARGETS_SNAP["loaded"]:
+        _snap_load(_TARGETS_SNAP, _load_targets_strict, "id", _snap_rebuild_targets, _snap_load_tombstones)
+    return _TARGETS_RESP_CACHE
+
+
+def _snap_launch() -> dict:
+    if not _LAUNCH_SNAP["loaded"]:
+        _snap_load(_LAUNCH_SNAP, _load_launch_sites, "name", _snap_rebuild_launch)
+    return _LAUNCH_RESP_CACHE
+
+
+async def _asnap_targets() -> dict:
+    """_snap_targets() for async routes: never blocks the event loop on a cold load."""
+    snap = _TARGETS_SNAP
+    if snap["loaded"]:
+        return _TARGETS_RESP_CACHE
+    if not _adb_enabled():
+        return await _db_run(_snap_targets)
+    if time.time() - snap["tried"] < SNAPSHOT_RETRY_S:
+        return _TARGETS_RESP_CACHE
+    try:
+        items = await _adb_fetch_targets()
+        tombs, horizon = await _adb_fetch_tombstones()
+    except Exception as e:
+        _ADB["errors"] += 1
+        print(f"[WARN] async snapshot load failed, using sync path: {e}")
+        return await _db_run(_snap_targets)
+
+    def after(s: dict) -> None:
+        s["tombs"] = tombs
+        s["horizon"] = horizon
+        s["rev"] = max([s["rev"], *tombs.values()])
+
+    _snap_load(snap, lambda: items, "id", _snap_rebuild_targets, after)
+    return _TARGETS_RESP_CACHE
+
+
+async def _asnap_launch() -> dict:
+    snap = _LAUNCH_SNAP
+    if snap["loaded"]:
+        return _LAUNCH_RESP_CACHE
+    if not _adb_enabled():
+        return await _db_run(_snap_launch)
+    if time.time() - snap["tried"] < SNAPSHOT_RETRY_S:
+        return _LAUNCH_RESP_CACHE
+    try:
+        items = await _adb_fetch_launchsites()
+    except Exception as e:
+        _ADB["errors"] += 1
+        print(f"[WARN] async snapshot load failed, using sync path: {e}")
+        return await _db_run(_snap_launch)
+    _snap_load(snap, lambda: items, "name", _snap_rebuild_launch)
+    return _LAUNCH_RESP_CACHE
+
+
+def _snap_invalidate() -> None:
+    """Drop both snapshots; the next read reloads them from storage."""
+    with _SNAP_LOCK:
+        for snap in (_TARGETS_SNAP, _LAUNCH_SNAP):
+            snap["loaded"] = False
+            snap["tried"] = 0.0
+
+
+def _snap_next_rev() -> int:
+    """Allocate a revision locally (JSON mode; Postgres uses pvls_rev_seq). The caller
+    holds _SNAP_LOCK and applies its change to the snapshot before releasing it."""
+    _snap_targets()
+    _snap_launch()
+    with _SNAP_LOCK:
+        rev = max(_REV_ALLOC["last"], _TARGETS_SNAP["rev"], _LAUNCH_SNAP["rev"], _TARGETS_SNAP["horizon"]) + 1
+        _REV_ALLOC["last"] = rev
+        return rev
+
+
+def _snap_targets_get(target_id: str) -> dict | None:
+    _snap_targets()
+    with _SNAP_LOCK:
+        x = _TARGETS_SNAP["items"].get(str(target_id))
+        return dict(x) if x is not None else None
+
+
+def _snap_launch_list() -> list[dict]:
+    _snap_launch()
+    with _SNAP_LOCK:
+        return [dict(x) for x in _LAUNCH_SNAP["items"].values()]
+
+
+def _snap_targets_delta(since: int) -> dict | None:
+    """Changed rows + deleted ids after `since`, or None if only a full list can answer."""
+    _snap_targets()
+    with _SNAP_LOCK:
+        snap = _TARGETS_SNAP
+        if since > snap["rev"] or since < snap["horizon"]:
+            return None
+        changed = [dict(x) for x in snap["items"].values() if int(x.get("rev") or 0) > since]
+        deleted = [i for i, r in snap["tombs"].items() if r > since]
+        return {"changed": changed, "deleted": deleted, "rev": snap["rev"]}
+
+
+def _snap_add_tombstone(target_id: str, rev: int) -> None:
+    tombs = _TARGETS_SNAP["tombs"]
+    tombs[str(target_id)] = rev
+    if len(tombs) > TOMBSTONE_MAX:
+        drop = sorted(tombs.items(), key=lambda kv: kv[1])[: len(tombs) - TOMBSTONE_MAX]
+        for k, _ in drop:
+            tombs.pop(k, None)
+        _TARGETS_SNAP["horizon"] = max(_TARGETS_SNAP["horizon"], drop[-1][1])
+
+
+def _snap_target_stale(tid: str, rev: int) -> bool:
+    """True if the snapshot already reflects a change to `tid` at `rev` or later: a newer
+    row, or a delete that was applied before this (older) change arrived via NOTIFY."""
+    cur = _TARGETS_SNAP["items"].get(tid)
+    if cur is not None and int(cur.get("rev") or 0) > rev:
+        return True
+    return rev > 0 and _TARGETS_SNAP["tombs"].get(tid, 0) >= rev
+
+
+def _snap_targets_upsert(item: dict) -> bool:
+    with _SNAP_LOCK:
+        tid = str(item["id"])
+        if _snap_target_stale(tid, int(item.get("rev") or 0)):
+            return False  # an older change arriving late (e.g. via NOTIFY)
+        _TARGETS_SNAP["items"][tid] = dict(item)
+        _TARGETS_SNAP["tombs"].pop(tid, None)
+        _TARGETS_SNAP["rev"] = max(_TARGETS_SNAP["rev"], int(item.get("rev") or 0))
+        _snap_rebuild_targets()
+        return True
+
+
+def _snap_targets_delete(target_id: str, changed_at: str | None = None, rev: int = 0) -> None:
+    with _SNAP_LOCK:
+        tid = str(target_id)
+        if not (rev and _snap_target_stale(tid, rev)):
+            _TARGETS_SNAP["items"].pop(tid, None)
+            if rev:
+                # Also when the row has not arrived here yet, so its late upsert is dropped.
+                _snap_add_tombstone(tid, rev)
+        _TARGETS_SNAP["rev"] = max(_TARGETS_SNAP["rev"], rev)
+        _TARGETS_SNAP["marker"] = changed_at or _now_iso()
+        _snap_rebuild_targets()
+
+
+def _snap_targets_apply(rows: list[dict], deleted: dict[str, int], changed_at: str | None = None) -> list[dict]:
+    """Apply a batch with a single rebuild; returns the rows that were not stale."""
+    applied = []
+    with _SNAP_LOCK:
+        snap = _TARGETS_SNAP
+        for item in rows:
+            tid = str(item["id"])
+            if _snap_target_stale(tid, int(item.get("rev") or 0)):
+                continue
+            snap["items"][tid] = dict(item)
+            snap["tombs"].pop(tid, None)
+            snap["rev"] = max(snap["rev"], int(item.get("rev") or 0))
+            applied.append(item)
+        for tid, rev in deleted.items():
+            tid = str(tid)
+            if rev and _snap_target_stale(tid, rev):
+                continue
+            snap["items"].pop(tid, None)
+            if rev:
+                _snap_add_tombstone(tid, rev)
+            snap["rev"] = max(snap["rev"], rev)
+        if deleted:
+            snap["marker"] = changed_at or _now_iso()
+        _snap_rebuild_targets()
+    return applied
+
+
+def _snap_targets_clear(changed_at: str | None = None, rev: int = 0) -> None:
+    with _SNAP_LOCK:
+        if rev:
+            for tid in list(_TARGETS_SNAP["items"].keys()):
+                _snap_add_tombstone(tid, rev)
+        _TARGETS_SNAP["items"] = {}
+        _TARGETS_SNAP["rev"] = max(_TARGETS_SNAP["rev"], rev)
+        _TARGETS_SNAP["marker"] = changed_at or _now_iso()
+        _snap_rebuild_targets()
+
+
+def _snap_launch_upsert(site: dict) -> None:
+    with _SNAP_LOCK:
+        _LAUNCH_SNAP["items"][str(site["name"])] = dict(site)
+        _LAUNCH_SNAP["rev"] = max(_LAUNCH_SNAP["rev"], int(site.get("rev") or 0))
+        _snap_rebuild_launch()
+
+
+def _parse_rev(since: str | None) -> int | None:
+    """`since` is a revision when numeric; anything else is a legacy updated_at string."""
+    s = (since or "").strip()
+    return int(s) if s.isdigit() else None
+
+
+# -----------------------------
+# Trajectory extrapolation
+# -----------------------------
+# Moving targets (active, speed_kmh > 0) are extrapolated on the server from the
+# position stored at their updated_at: along the great circle to dest_lat/dest_lng
+# (stopping there) or along `direction` otherwise. All targets x all time steps are
+# computed in one vectorized pass (numpy when installed, plain math otherwise), and
+# every viewer gets the same samples for the same time slot.
+EARTH_R_M = 6371000.0
+TRAJ_DEFAULT_HORIZON_S = int(os.getenv("TRAJ_DEFAULT_HORIZON_S", "60"))
+TRAJ_MAX_HORIZON_S = int(os.getenv("TRAJ_MAX_HORIZON_S", "600"))
+TRAJ_DEFAULT_STEP_S = int(os.getenv("TRAJ_DEFAULT_STEP_S", "5"))
+TRAJ_MAX_STEPS = int(os.getenv("TRAJ_MAX_STEPS", "240"))
+# Without a destination a stale target would fly on forever; stop extrapolating after this.
+TRAJ_MAX_AGE_S = float(os.getenv("TRAJ_MAX_AGE_S", "3600"))
+# Postgres rows carry naive timestamps (to_char in the session zone, UTC on hosted DBs).
+TRAJ_NAIVE_TZ = os.getenv("TRAJ_NAIVE_TZ", "UTC")
+
+_TRAJ_CACHE: dict = {}
+
+
+def _parse_ts(value) -> float | None:
+    try:
+        dt = datetime.fromisoformat(str(value))
+    except Exception:
+        return None
+    if dt.tzinfo is None:
+        if ZoneInfo is None:
+            return None
+        dt = dt.replace(tzinfo=ZoneInfo(TRAJ_NAIVE_TZ))
+    return dt.timestamp()
+
+
+def _traj_inputs(items) -> list[tuple]:
+    """(id, lat, lng, m/s, bearing, dest_lat, dest_lng, anchor_ts) for targets that move."""
+    out = []
+    for t in items:
+        speed = float(t.get("speed_kmh") or 0)
+        if speed <= 0 or not t.get("active", True):
+            continue
+        anchor = _parse_ts(t.get("updated_at"))
+        if anchor is None:
+            continue
+        has_dest = t.get("dest_lat") is not None and t.get("dest_lng") is not None
+        out.append((
+            str(t["id"]), float(t["lat"]), float(t["lng"]), speed / 3.6, float(t.get("direction") or 0),
+            float(t["dest_lat"]) if has_dest else None, float(t["dest_lng"]) if has_dest else None, anchor,
+        ))
+    return out
+
+
+def _traj_np(rows: list[tuple], times: list[float]):
+    """Vectorized positions -> (lat[n,k], lng[n,k], remaining_m[n]) in degrees/metres."""
+    lat1 = np.radians([r[1] for r in rows])[:, None]
+    lng1 = np.radians([r[2] for r in rows])[:, None]
+    v = np.array([r[3] for r in rows])[:, None]
+    brg = np.radians([r[4] for r in rows])[:, None]
+    has_dest = np.array([r[5] is not None for r in rows])[:, None]
+    lat2 = np.radians([r[5] if r[5] is not None else r[1] for r in rows])[:, None]
+    lng2 = np.radians([r[6] if r[6] is not None else r[2] for r in rows])[:, None]
+    anchor = np.array([r[7] for r in rows])[:, None]
+    t = np.array(times)[None, :]
+    dist = v * np.clip(t - anchor, 0.0, TRAJ_MAX_AGE_S)  # metres travelled, [n,k]
+
+    # Along a bearing (destination-point formula).
+    d = dist / EARTH_R_M
+    lat_b = np.arcsin(np.sin(lat1) * np.cos(d) + np.cos(lat1) * np.sin(d) * np.cos(brg))
+    lng_b = lng1 + np.arctan2(np.sin(brg) * np.sin(d) * np.cos(lat1), np.cos(d) - np.sin(lat1) * np.sin(lat_b))
+
+    # Toward dest (great-circle interpolation, clamped at arrival).
+    hav = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    delta = 2 * np.arcsin(np.minimum(1.0, np.sqrt(hav)))  # [n,1]
+    sin_delta = np.sin(delta)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = np.where(delta > 1e-12, np.minimum(1.0, d / delta), 1.0)
+        a = np.where(sin_delta > 1e-12, np.sin((1 - f) * delta) / sin_delta, 1 - f)
+        b = np.where(sin_delta > 1e-12, np.sin(f * delta) / sin_delta, f)
+    x = a * np.cos(lat1) * np.cos(lng1) + b * np.cos(lat2) * np.cos(lng2)
+    y = a * np.cos(lat1) * np.sin(lng1) + b * np.cos(lat2) * np.sin(lng2)
+    z = a * np.sin(lat1) + b * np.sin(lat2)
+    lat_d = np.arctan2(z, np.sqrt(x * x + y * y))
+    lng_d = np.arctan2(y, x)
+
+    lat = np.degrees(np.where(has_dest, lat_d, lat_b))
+    lng = (np.degrees(np.where(has_dest, lng_d, lng_b)) + 540.0) % 360.0 - 180.0
+    remaining = np.where(has_dest[:, 0], np.maximum(0.0, delta[:, 0] * EARTH_R_M - dist[:, 0]), np.nan)
+    return lat, lng, remaining
+
+
+def _traj_py(rows: list[tuple], times: list[float]):
+    """Same as _traj_np without numpy (lists of lists)."""
+    lats, lngs, remaining = [], [], []
+    for _, la, ln, v, brg_deg, dla, dln, anchor in rows:
+        lat1, lng1, brg = math.radians(la), math.radians(ln), math.radians(brg_deg)
+        if dla is not None:
+            lat2, lng2 = math.radians(dla), math.radians(dln)
+            hav = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+            delta = 2 * math.asin(min(1.0, math.sqrt(hav)))
+        row_lat, row_lng = [], []
+        for t in times:
+            dist = v * min(max(t - anchor, 0.0), TRAJ_MAX_AGE_S)
+            d = dist / EARTH_R_M
+            if dla is None:
+                p_lat = math.asin(math.sin(lat1) * math.cos(d) + math.cos(lat1) * math.sin(d) * math.cos(brg))
+                p_lng = lng1 + math.atan2(math.sin(brg) * math.sin(d) * math.cos(lat1), math.cos(d) - math.sin(lat1) * math.sin(p_lat))
+            elif delta <= 1e-12 or d >= delta:
+                p_lat, p_lng = lat2, lng2
+            else:
+                f = d / delta
+                a = math.sin((1 - f) * delta) / math.sin(delta)
+                b = math.sin(f * delta) / math.sin(delta)
+                x = a * math.cos(lat1) * math.cos(lng1) + b * math.cos(lat2) * math.cos(lng2)
+                y = a * math.cos(lat1) * math.sin(lng1) + b * math.cos(lat2) * math.sin(lng2)
+                z = a * math.sin(lat1) + b * math.sin(lat2)
+                p_lat, p_lng = math.atan2(z, math.sqrt(x * x + y * y)), math.atan2(y, x)
+            row_lat.append(math.degrees(p_lat))
+            row_lng.append((math.degrees(p_lng) + 540.0) % 360.0 - 180.0)
+        lats.append(row_lat)
+        lngs.append(row_lng)
+        if dla is None:
+            remaining.append(float("nan"))
+        else:
+            remaining.append(max(0.0, delta * EARTH_R_M - v * min(max(times[0] - anchor, 0.0), TRAJ_MAX_AGE_S)))
+    return lats, lngs, remaining
+
+
+def _traj_payload(horizon_s: int, step_s: int) -> dict:
+    """{"body": serialized trajectories, "enc": compressed variants} for the current
+    time slot (t0 = now rounded down to step)."""
+    t0 = math.floor(time.time() / step_s) * step_s
+    with _SNAP_LOCK:
+        rev = _TARGETS_SNAP["rev"]
+        key = (rev, horizon_s, step_s, t0)
+        hit = _TRAJ_CACHE.get(key)
+        if hit is not None:
+            return hit
+        rows = _traj_inputs(_TARGETS_SNAP["items"].values())
+    times = [t0 + i * step_s for i in range(horizon_s // step_s + 1)]
+    targets = []
+    if rows:
+        lat, lng, remaining = (_traj_np if np is not None else _traj_py)(rows, times)
+        for i, r in enumerate(rows):
+            rem = float(remaining[i])
+            targets.append({
+                "id": r[0],
+                "pos": [[round(float(a), 6), round(float(b), 6)] for a, b in zip(lat[i], lng[i])],
+                "arrive_s": None if math.isnan(rem) else round(rem / r[3], 1),
+            })
+    entry = {"body": _json_bytes({"rev": rev, "t0": t0, "step_s": step_s, "targets": targets}), "enc": {}}
+    with _SNAP_LOCK:
+        if len(_TRAJ_CACHE) > 16:
+            _TRAJ_CACHE.clear()
+        _TRAJ_CACHE[key] = entry
+    return entry
+
+
+# -----------------------------
+# Viewport queries (grid index + clustering)
+# -----------------------------
+# `/api/targets?bbox=minLng,minLat,maxLng,maxLat&zoom=z` is answered from a uniform
+# lat/lng grid built alongside each snapshot rebuild. Below CLUSTER_MAX_ZOOM the
+# targets in view are aggregated per screen-sized cell (count, type mix, centroid);
+# a cell holding a single target is returned as that target.
+GRID_CELL_DEG = float(os.getenv("GRID_CELL_DEG", "0.25"))
+CLUSTER_MAX_ZOOM = int(os.getenv("CLUSTER_MAX_ZOOM", "9"))
+CLUSTER_CELL_PX = int(os.getenv("CLUSTER_CELL_PX", "80"))
+MERCATOR_MAX_LAT = 85.05112878
+
+
+def _parse_bbox(value: str | None) -> tuple | None:
+    if not value:
+        return None
+    try:
+        w, s, e, n = (float(x) for x in value.split(","))
+    except ValueError:
+        w = s = e = n = math.nan
+    if not all(math.isfinite(v) for v in (w, s, e, n)) or w > e or s > n:
+        raise HTTPException(status_code=422, detail="bbox must be minLng,minLat,maxLng,maxLat")
+    return (max(w, -180.0), max(s, -90.0), min(e, 180.0), min(n, 90.0))
+
+
+def _target_latlng(t: dict) -> tuple | None:
+    try:
+        lat, lng = float(t["lat"]), float(t["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (lat, lng) if math.isfinite(lat) and math.isfinite(lng) else None
+
+
+def _in_bbox(t: dict, bbox: tuple) -> bool:
+    p = _target_latlng(t)
+    return p is not None and bbox[0] <= p[1] <= bbox[2] and bbox[1] <= p[0] <= bbox[3]
+
+
+def _grid_build(items) -> dict:
+    """(lng cell, lat cell) -> targets in that cell, preserving the snapshot order."""
+    cells: dict = {}
+    for t in items:
+        p = _target_latlng(t)
+        if p is not None:
+            key = (math.floor(p[1] / GRID_CELL_DEG), math.floor(p[0] / GRID_CELL_DEG))
+            cells.setdefault(key, []).append(t)
+    return cells
+
+
+def _grid_query(cells: dict, bbox: tuple) -> list[dict]:
+    w, s, e, n = bbox
+    x0, y0 = math.floor(w / GRID_CELL_DEG), math.floor(s / GRID_CELL_DEG)
+    x1, y1 = math.floor(e / GRID_CELL_DEG), math.floor(n / GRID_CELL_DEG)
+    if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+        keys = [k for k in cells if x0 <= k[0] <= x1 and y0 <= k[1] <= y1]
+    else:
+        keys = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in cells]
+    out = [t for k in keys for t in cells[k] if _in_bbox(t, bbox)]
+    out.sort(key=lambda x: (x.get("updated_at") or x.get("created_at") or ""), reverse=True)
+    return out
+
+
+def _cluster(items: list[dict], zoom: int) -> tuple[list[dict], list[dict]]:
+    """Split into (single targets, clusters) on a CLUSTER_CELL_PX screen grid at `zoom`."""
+    size = CLUSTER_CELL_PX * 360.0 / (256 * 2 ** zoom)  # degrees of longitude (and Mercator y) per cell
+    buckets: dict = {}
+    for t in items:
+        lat, lng = _target_latlng(t)
+        lat_c = max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat))
+        y = math.degrees(math.log(math.tan(math.pi / 4 + math.radians(lat_c) / 2)))
+        buckets.setdefault((math.floor(lng / size), math.floor(y / size)), []).append(t)
+    singles, clusters = [], []
+    for group in buckets.values():
+        if len(group) == 1:
+            singles.append(group[0])
+            continue
+        types: dict = {}
+        sum_lat = sum_lng = 0.0
+        for t in group:
+            lat, lng = _target_latlng(t)
+            sum_lat += lat
+            sum_lng += lng
+            tp = t.get("type") or "unknown"
+            types[tp] = types.get(tp, 0) + 1
+        clusters.append({
+            "lat": round(sum_lat / len(group), 6),
+            "lng": round(sum_lng / len(group), 6),
+            "count": len(group),
+            "types": types,
+        })
+    clusters.sort(key=lambda c: c["count"], reverse=True)
+    return singles, clusters
+
+
+def _targets_view(cache: dict, bbox: tuple, zoom: int | None, fmt: str = "json") -> dict:
+    items = _grid_query(cache.get("grid") or {}, bbox)
+    clustered = zoom is not None and zoom < CLUSTER_MAX_ZOOM
+    body = {"rev": cache["rev"], "updated_at": cache.get("updated_at"), "bbox": list(bbox), "zoom": zoom, "clustered": clustered}
+    if clustered:
+        body["targets"], body["clusters"] = _cluster(items, zoom)
+    else:
+        body["targets"], body["clusters"] = items, []
+    if fmt == "col":
+        body["targets"] = _col_encode(body["targets"], _TARGET_WIRE)
+    return body
+
+
+# -----------------------------
+# Geofence zones (server-side proximity)
+# -----------------------------
+# Zones are circles or lat/lng polygons: the built-in city rings plus admin-defined
+# ones. After snapshot changes the geofence worker tests all active targets against
+# all zones in one vectorized pass (numpy when installed), together with their
+# extrapolated positions over the next GEO_ETA_MIN minutes. It works on a copy taken
+# under _SNAP_LOCK, so writes and reads never wait for it. Only changes are pushed to
+# viewers as "zone_alert" events: entered, left, or approaching (ETA under the zone's limit).
+GEO_CITY_NAME = os.getenv("GEO_CITY_NAME", "Павлоград")
+GEO_CITY_LAT = float(os.getenv("GEO_CITY_LAT", "48.5231"))
+GEO_CITY_LNG = float(os.getenv("GEO_CITY_LNG", "35.8707"))
+GEO_CITY_NEAR_M = float(os.getenv("GEO_CITY_NEAR_M", "7000"))
+GEO_CITY_DANGER_M = float(os.getenv("GEO_CITY_DANGER_M", "3000"))
+GEO_ETA_MIN = float(os.getenv("GEO_ETA_MIN", "5"))
+GEO_ETA_STEP_S = max(1, int(os.getenv("GEO_ETA_STEP_S", "15")))
+GEO_LEVELS = ("info", "near", "danger")
+ZONES_PATH = DATA_DIR / "zones.json"
+
+_GEO: dict = {
+    "admin": None,      # admin zones as stored (None = not loaded yet)
+    "state": {},        # (target id, zone id) -> ("inside" | "eta", eta_s)
+    "ready": False,     # first pass only records state (no alerts on startup)
+    "evaluations": 0,
+    "crossings": 0,
+    "errors": 0,
+    "last_ms": 0.0,
+    "zones_changed": False,  # push op=zones after the next pass
+    "resp": None,            # /api/zones body after the last pass: {"payload": bytes, "enc": {}}
+    "wake": threading.Event(),
+    "stop": threading.Event(),
+    "thread": None,
+}
+
+
+def _geo_builtin_zones() -> list[dict]:
+    base = {"kind": "circle", "lat": GEO_CITY_LAT, "lng": GEO_CITY_LNG, "builtin": True, "active": True}
+    return [
+        dict(base, id="city_near", name=GEO_CITY_NAME, radius_m=GEO_CITY_NEAR_M, level="near", eta_min=GEO_ETA_MIN),
+        dict(base, id="city_danger", name=GEO_CITY_NAME, radius_m=GEO_CITY_DANGER_M, level="danger", eta_min=GEO_ETA_MIN),
+    ]
+
+
+def _geo_load_admin() -> list[dict]:
+    be = _sql_backend()
+    if be:
+        return be["fetch_zones"]()
+    if not ZONES_PATH.exists():
+        return []
+    with open(ZONES_PATH, "r", encoding="utf-8") as f:
+        return json.load(f) or []
+
+
+def _geo_zones() -> list[dict]:
+    if _GEO["admin"] is None:
+        try:
+            _GEO["admin"] = _geo_load_admin()
+        except Exception as e:
+            _GEO["errors"] += 1
+            print(f"[WARN] geofence zones unavailable: {e}")
+            return _geo_builtin_zones()
+    return _geo_builtin_zones() + list(_GEO["admin"])
+
+
+def _haversine_np(lat, lng, lat0: float, lng0: float):
+    p1, p2 = np.radians(lat), math.radians(lat0)
+    h = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * math.cos(p2) * np.sin((math.radians(lng0) - np.radians(lng)) / 2) ** 2
+    return 2 * EARTH_R_M * np.arcsin(np.minimum(1.0, np.sqrt(h)))
+
+
+def _haversine_py(lat: float, lng: float, lat0: float, lng0: float) -> float:
+    p1, p2 = math.radians(lat), math.radians(lat0)
+    h = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng0 - lng) / 2) ** 2
+    return 2 * EARTH_R_M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _geo_inside_np(zone: dict, lat, lng):
+    """Boolean array: which of the points lie in the zone (polygons by ray casting)."""
+    if zone["kind"] == "circle":
+        return _haversine_np(lat, lng, zone["lat"], zone["lng"]) <= zone["radius_m"]
+    inside = np.zeros(lat.shape, dtype=bool)
+    pts = zone["points"]
+    for (a_lat, a_lng), (b_lat, b_lng) in zip(pts, pts[1:] + pts[:1]):
+        crosses = (a_lat > lat) != (b_lat > lat)
+        if a_lat == b_lat:
+            continue
+        x_at = a_lng + (lat - a_lat) * (b_lng - a_lng) / (b_lat - a_lat)
+        inside ^= crosses & (lng < x_at)
+    return inside
+
+
+def _geo_inside_py(zone: dict, lat: list, lng: list) -> list[bool]:
+    if zone["kind"] == "circle":
+        return [_haversine_py(a, b, zone["lat"], zone["lng"]) <= zone["radius_m"] for a, b in zip(lat, lng)]
+    pts = zone["points"]
+    edges = [e for e in zip(pts, pts[1:] + pts[:1]) if e[0][0] != e[1][0]]
+    out = []
+    for y, x in zip(lat, lng):
+        inside = False
+        for (a_lat, a_lng), (b_lat, b_lng) in edges:
+            if (a_lat > y) != (b_lat > y) and x < a_lng + (y - a_lat) * (b_lng - a_lng) / (b_lat - a_lat):
+                inside = not inside
+        out.append(inside)
+    return out
+
+
+def _geo_evaluate(items) -> None:
+    """Test targets against zones; publish the crossings since the previous pass."""
+    t_start = time.perf_counter()
+    zones = [z for z in _geo_zones() if z.get("active", True)]
+    targets = {}
+    for t in items:
+        p = _target_latlng(t)
+        if p is not None and t.get("active", True):
+            targets[str(t["id"])] = (t, p)
+    ids = list(targets)
+    # Points: current positions (extrapolated to now for moving targets), then K
+    # future positions per moving target.
+    lat = [targets[i][1][0] for i in ids]
+    lng = [targets[i][1][1] for i in ids]
+    now = time.time()
+    horizon = max([float(z.get("eta_min") or 0) for z in zones] + [0.0]) * 60
+    steps = [now + k * GEO_ETA_STEP_S for k in range(1, int(horizon // GEO_ETA_STEP_S) + 1)]
+    rows = _traj_inputs(targets[i][0] for i in ids)
+    if rows:
+        f_lat, f_lng, _ = (_traj_np if np is not None else _traj_py)(rows, [now] + steps)
+        pos = {i: j for j, i in enumerate(ids)}
+        for j, r in enumerate(rows):
+            i = pos[r[0]]
+            lat[i], lng[i] = float(f_lat[j][0]), float(f_lng[j][0])
+            targets[r[0]] = (targets[r[0]][0], (lat[i], lng[i]))
+        if np is not None:
+            lat = np.concatenate([np.array(lat, dtype=float), np.asarray(f_lat)[:, 1:].ravel()])
+            lng = np.concatenate([np.array(lng, dtype=float), np.asarray(f_lng)[:, 1:].ravel()])
+        else:
+            lat = lat + [x for r in f_lat for x in r[1:]]
+            lng = lng + [x for r in f_lng for x in r[1:]]
+    elif np is not None:
+        lat, lng = np.array(lat, dtype=float), np.array(lng, dtype=float)
+    n, k = len(ids), len(steps)
+
+    state: dict = {}
+    for z in zones:
+        hit = (_geo_inside_np if np is not None else _geo_inside_py)(z, lat, lng) if n else []
+        limit = float(z.get("eta_min") or 0) * 60
+        for i in range(n):
+            if hit[i]:
+                state[(ids[i], z["id"])] = ("inside", 0)
+        for j, r in enumerate(rows):
+            key = (r[0], z["id"])
+            if key in state:
+                continue
+            for s in range(k):
+                if (s + 1) * GEO_ETA_STEP_S > limit:
+                    break
+                if hit[n + j * k + s]:
+                    state[key] = ("eta", (s + 1) * GEO_ETA_STEP_S)
+                    break
+
+    crossings = []
+    if _GEO["ready"]:
+        by_id = {z["id"]: z for z in zones}
+        prev = _GEO["state"]
+        for key, (status, eta) in state.items():
+            old = prev.get(key, (None, 0))[0]
+            if status == "inside" and old != "inside":
+                crossings.append(_geo_crossing("entered", key, by_id, targets, None))
+            elif status == "eta" and old is None:
+                crossings.append(_geo_crossing("approaching", key, by_id, targets, eta))
+        for key, (old, _) in prev.items():
+            if old == "inside" and key not in state and key[0] in targets and key[1] in by_id:
+                crossings.append(_geo_crossing("left", key, by_id, targets, None))
+    _GEO["state"] = state
+    _GEO["ready"] = True
+    _GEO["evaluations"] += 1
+    _GEO["crossings"] += len(crossings)
+    _GEO["last_ms"] = round((time.perf_counter() - t_start) * 1000, 3)
+    if crossings:
+        _push_sse_event("zone_alert", "zones", op="crossings", crossings=crossings)
+
+
+def _geo_crossing(kind: str, key: tuple, zones: dict, targets: dict, eta_s) -> dict:
+    z = zones[key[1]]
+    t, (lat, lng) = targets[key[0]]
+    return {
+        "kind": kind,
+        "target_id": key[0],
+        "zone_id": z["id"],
+        "zone": z.get("name") or z["id"],
+        "level": z.get("level") or "near",
+        "type": t.get("type"),
+        "lat": lat,
+        "lng": lng,
+        "dist_m": round(_haversine_py(lat, lng, z["lat"], z["lng"])) if z["kind"] == "circle" else None,
+        "eta_s": eta_s,
+    }
+
+
+def _geo_wake() -> None:
+    _GEO["wake"].set()
+
+
+def _geo_loop(stop: threading.Event) -> None:
+    # Woken by snapshot rebuilds; moving targets also cross zones between writes, so
+    # they are re-tested once per ETA step.
+    wake = _GEO["wake"]
+    while True:
+        woken = wake.wait(GEO_ETA_STEP_S)
+        if stop.is_set():
+            return
+        wake.clear()
+        with _SNAP_LOCK:
+            if not _TARGETS_SNAP["loaded"]:
+                continue
+            items = list(_TARGETS_SNAP["items"].values())  # rows are replaced, never mutated
+        zones_changed, _GEO["zones_changed"] = _GEO["zones_changed"], False
+        if woken or any(float(t.get("speed_kmh") or 0) > 0 for t in items):
+            try:
+                _geo_evaluate(items)
+                _geo_build_resp()
+            except Exception as e:
+                _GEO["errors"] += 1
+                print(f"[WARN] geofence evaluation failed: {e}")
+        if zones_changed:
+            _push_sse_event("zone_alert", "zones", op="zones")
+
+
+def _start_geo_ticker() -> None:
+    if _GEO["thread"] is not None:
+        return
+    _GEO["stop"].clear()
+    th = threading.Thread(target=_geo_loop, args=(_GEO["stop"],), name="pvls-geofence", daemon=True)
+    _GEO["thread"] = th
+    th.start()
+
+
+def _geo_zones_changed() -> None:
+    """Reload admin zones; the worker re-evaluates, then tells viewers to refetch them."""
+    _GEO["admin"] = None
+    _GEO["resp"] = None  # the next GET rebuilds it with the new zone list
+    _GEO["zones_changed"] = True
+    _geo_wake()
+
+
+def _geo_payload() -> dict:
+    state = [
+        {"target_id": tid, "zone_id": zid, "status": st, "eta_s": eta}
+        for (tid, zid), (st, eta) in _GEO["state"].items()  # replaced whole by each pass
+    ]
+    return {"zones": _geo_zones(), "state": state}
+
+
+def _geo_build_resp() -> dict:
+    """Serialize /api/zones once per pass; the route only sends these bytes."""
+    resp = {"payload": _json_bytes(_geo_payload()), "enc": {}}
+    _GEO["resp"] = resp
+    return resp
+
+
+def _geo_stats() -> dict:
+    return {k: v for k, v in _GEO.items() if k not in ("admin", "state", "zones_changed", "resp", "wake", "stop", "thread")} | {"tracked": len(_GEO["state"])}
+
+
+# -----------------------------
+# Track history (append-only positions)
+# -----------------------------
+# Every accepted target write queues one position point; a background thread
+# writes the queue in batches, so the live upsert path only appends to a deque.
+# Points older than HISTORY_THIN_AFTER_H are thinned to one per target per
+# HISTORY_THIN_STEP_S, and points older than HISTORY_RETENTION_DAYS are dropped.
+# Postgres/SQLite keep them in pvls_track; JSON mode in one NDJSON file per UTC day.
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+HISTORY_FLUSH_S = float(os.getenv("HISTORY_FLUSH_S", "1"))
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "50000"))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_THIN_AFTER_H = float(os.getenv("HISTORY_THIN_AFTER_H", "24"))
+HISTORY_THIN_STEP_S = int(os.getenv("HISTORY_THIN_STEP_S", "60"))
+HISTORY_MAINTAIN_S = float(os.getenv("HISTORY_MAINTAIN_S", "600"))
+HISTORY_CHUNK = int(os.getenv("HISTORY_CHUNK", "2000"))
+HISTORY_DIR = DATA_DIR / "history"
+
+_HISTORY: dict = {
+    "queue": deque(),
+    "lock": threading.Lock(),
+    "stop": threading.Event(),
+    "thread": None,
+    "written": 0,
+    "dropped": 0,
+    "errors": 0,
+    "expired": 0,
+    "thinned": 0,
+    "thinned_to": None,
+    "last_maintain": 0.0,
+}
+_HISTORY_FIELDS = ("target_id", "ts", "lat", "lng", "direction", "speed_kmh", "type")
+
+
+def _history_record(items) -> None:
+    """Queue the current position of each written target (never blocks on storage)."""
+    if not HISTORY_ENABLED:
+        return
+    now = time.time()
+    with _HISTORY["lock"]:
+        q = _HISTORY["queue"]
+        for t in items:
+            p = _target_latlng(t)
+            if p is None:
+                continue
+            q.append((str(t["id"]), now, p[0], p[1], t.get("direction"), t.get("speed_kmh"), t.get("type")))
+        while len(q) > HISTORY_QUEUE_MAX:
+            q.popleft()
+            _HISTORY["dropped"] += 1
+
+
+def _history_day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _json_history_insert(rows: list[tuple]) -> None:
+    HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+    by_day: dict[str, list[str]] = {}
+    for r in rows:
+        by_day.setdefault(_history_day(r[1]), []).append(json.dumps(dict(zip(_HISTORY_FIELDS, r)), ensure_ascii=False))
+    for day, lines in by_day.items():
+        with open(HISTORY_DIR / f"{day}.jsonl", "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _json_history_files(start: float, end: float) -> list[Path]:
+    if not HISTORY_DIR.exists():
+        return []
+    first, last = _history_day(start), _history_day(max(start, end - 1e-3))
+    return sorted(p for p in HISTORY_DIR.glob("*.jsonl") if first <= p.stem <= last)
+
+
+def _json_history_rows(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # torn last line of a crashed append
+
+
+def _json_history_maintain(expire_before: float, thin_from: float, thin_to: float, step_s: int) -> tuple[int, int]:
+    """Day files are the unit here: expired days are deleted, fully-old days rewritten thinned."""
+    if not HISTORY_DIR.exists():
+        return 0, 0
+    expired = thinned = 0
+    for path in sorted(HISTORY_DIR.glob("*.jsonl")):
+        try:
+            day_start = datetime.strptime(path.stem, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            continue
+        day_end = day_start + 86400
+        if day_end <= expire_before:
+            expired += sum(1 for _ in _json_history_rows(path))
+            path.unlink()
+            continue
+        if day_end > thin_to or day_end <= thin_from:
+            continue
+        kept, seen, total = [], set(), 0
+        for r in _json_history_rows(path):
+            total += 1
+            key = (r.get("target_id"), math.floor(float(r.get("ts") or 0) / step_s))
+            if key not in seen:
+                seen.add(key)
+                kept.append(json.dumps(r, ensure_ascii=False))
+        if len(kept) < total:
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text("".join(x + "\n" for x in kept), encoding="utf-8")
+            os.replace(tmp, path)
+            thinned += total - len(kept)
+    return expired, thinned
+
+
+def _history_flush() -> None:
+    with _HISTORY["lock"]:
+        rows = list(_HISTORY["queue"])
+        _HISTORY["queue"].clear()
+    if not rows:
+        return
+    be = _sql_backend()
+    try:
+        (be["history_insert"] if be else _json_history_insert)(rows)
+        _HISTORY["written"] += len(rows)
+    except Exception as e:
+        _HISTORY["errors"] += 1
+        print(f"[WARN] history flush failed ({len(rows)} points requeued): {e}")
+        with _HISTORY["lock"]:
+            _HISTORY["queue"].extendleft(reversed(rows))
+            while len(_HISTORY["queue"]) > HISTORY_QUEUE_MAX:
+                _HISTORY["queue"].popleft()
+                _HISTORY["dropped"] += 1
+
+
+def _history_maintain() -> None:
+    now = time.time()
+    step = max(1, HISTORY_THIN_STEP_S)
+    expire_before = now - HISTORY_RETENTION_DAYS * 86400
+    # Whole buckets only, so a later pass never thins a bucket twice.
+    thin_to = math.floor((now - HISTORY_THIN_AFTER_H * 3600) / step) * step
+    thin_from = _HISTORY["thinned_to"] or math.floor(expire_before / step) * step
+    be = _sql_backend()
+    expired, thinned = (be["history_maintain"] if be else _json_history_maintain)(
+        expire_before, thin_from, max(thin_from, thin_to), step
+    )
+    _HISTORY["expired"] += expired
+    _HISTORY["thinned"] += thinned
+    _HISTORY["thinned_to"] = max(thin_from, thin_to)
+    _HISTORY["last_maintain"] = now
+
+
+def _history_loop(stop: threading.Event) -> None:
+    while not stop.wait(HISTORY_FLUSH_S):
+        _history_flush()
+        if time.time() - _HISTORY["last_maintain"] >= HISTORY_MAINTAIN_S:
+            try:
+                _history_maintain()
+            except Exception as e:
+                _HISTORY["errors"] += 1
+                _HISTORY["last_maintain"] = time.time()
+                print(f"[WARN] history maintenance failed: {e}")
+
+
+def _start_history_writer() -> None:
+    if not HISTORY_ENABLED or _HISTORY["thread"] is not None:
+        return
+    _HISTORY["stop"].clear()
+    th = threading.Thread(target=_history_loop, args=(_HISTORY["stop"],), name="pvls-history", daemon=True)
+    _HISTORY["thread"] = th
+    th.start()
+
+
+def _history_stats() -> dict:
+    out = {k: v for k, v in _HISTORY.items() if k not in ("queue", "lock", "stop", "thread")}
+    out["queued"] = len(_HISTORY["queue"])
+    return out
+
+
+def _history_chunks(start: float, end: float, target_id: str | None, chunk: int):
+    """Points in [start, end) in write order, `chunk` rows at a time (keyset paging, no big reads)."""
+    be = _sql_backend()
+    if be:
+        bounds = be["history_bounds"](start, end)
+        if bounds is None:
+            return
+        after, hi = bounds
+        while after < hi:
+            page = be["history_page"](after, hi, start, end, target_id, chunk)
+            if not page:
+                return
+            after = int(page[-1].pop("id"))
+            for r in page:
+                r.pop("id", None)
+            yield page
+        return
+    page = []
+    for path in _json_history_files(start, end):
+        for r in _json_history_rows(path):
+            ts = float(r.get("ts") or 0)
+            if start <= ts < end and (target_id is None or r.get("target_id") == target_id):
+                page.append(r)
+                if len(page) >= chunk:
+                    yield page
+                    page = []
+    if page:
+        yield page
+
+
+# -----------------------------
+# Compact wire format (columnar)
+# -----------------------------
+# Opt-in with `Accept: application/vnd.pvls.col+json` or `?fmt=col` (EventSource
+# cannot set headers). Row lists become one array per field: repeated strings are
+# indexes into a per-field dictionary, coordinates fixed-point integers
+# (1e-5 degree, ~1 m), timestamps whole seconds from a per-field base epoch.
+# Everything else in the body stays as it is; static/js/common.js decodes it.
+WIRE_COL_TYPE = "application/vnd.pvls.col+json"
+WIRE_COL_SCALE = 100000
+# Hot API bodies at least this big are sent gzip/brotli-compressed when accepted.
+API_COMPRESS_MIN = int(os.getenv("API_COMPRESS_MIN", "1024"))
+API_GZIP_LEVEL = int(os.getenv("API_GZIP_LEVEL", "6"))
+API_BROTLI_QUALITY = int(os.getenv("API_BROTLI_QUALITY", "5"))
+
+_WIRE_STATS: dict = {
+    "responses": 0,
+    "raw_bytes": 0,
+    "sent_bytes": 0,
+    "ser_ms": 0.0,
+    "comp_ms": 0.0,
+    "comp_hits": 0,
+    "by_encoding": {"identity": 0, "gzip": 0, "br": 0},
+}
+
+_TARGET_WIRE = (
+    ("id", "str"), ("type", "dict"), ("lat", "fixed"), ("lng", "fixed"), ("direction", "int"),
+    ("note", "dict"), ("speed_kmh", "num"), ("dest_lat", "fixed"), ("dest_lng", "fixed"),
+    ("active", "bool"), ("rev", "int"), ("created_at", "ts"), ("updated_at", "ts"),
+)
+_LAUNCH_WIRE = (("name", "str"), ("lat", "fixed"), ("lng", "fixed"), ("active", "bool"), ("rev", "int"), ("updated_at", "ts"))
+
+
+def _col_encode(rows: list[dict], spec: tuple) -> dict:
+    cols: dict = {}
+    enc: dict = {}
+    for key, kind in spec:
+        vals = [r.get(key) for r in rows]
+        if kind == "dict":
+            index: dict = {}
+            cols[key] = [None if v is None else index.setdefault(v, len(index)) for v in vals]
+            enc[key] = ["dict", list(index)]
+        elif kind == "fixed":
+            cols[key] = [None if v is None else round(float(v) * WIRE_COL_SCALE) for v in vals]
+            enc[key] = ["fixed", WIRE_COL_SCALE]
+        elif kind == "bool":
+            cols[key] = [None if v is None else int(bool(v)) for v in vals]
+            enc[key] = ["bool"]
+        elif kind == "ts":
+            secs = [_parse_ts(v) if v else None for v in vals]
+            base = int(min((x for x in secs if x is not None), default=0))
+            cols[key] = [None if x is None else round(x - base) for x in secs]
+            enc[key] = ["ts", base]
+        else:
+            cols[key] = vals
+    return {"n": len(rows), "cols": cols, "enc": enc}
+
+
+def _wire_fmt(request: Request, fmt: str | None = None) -> str:
+    if fmt:
+        return "col" if fmt == "col" else "json"
+    return "col" if WIRE_COL_TYPE in (request.headers.get("accept") or "") else "json"
+
+
+def _wire_encoding(request: Request) -> str | None:
+    if brotli is not None and _accepts_encoding(request, "br"):
+        return "br"
+    return "gzip" if _accepts_encoding(request, "gzip") else None
+
+
+def _wire_response(request: Request, body, fmt: str = "json", memo: dict | None = None) -> Response:
+    """Send a dict (serialized here) or pre-serialized bytes, compressed when it pays.
+
+    `memo` is a dict owned by a snapshot/cache entry: compressed variants of the
+    same bytes are kept there, so a full list is compressed once per change, not
+    once per viewer. Server-Timing reports what this response cost.
+    """
+    timing = []
+    if isinstance(body, bytes):
+        content = body
+    else:
+        t0 = time.perf_counter()
+        content = _json_bytes(body)
+        ser_ms = (time.perf_counter() - t0) * 1000
+        _WIRE_STATS["ser_ms"] += ser_ms
+        timing.append(f"ser;dur={ser_ms:.2f}")
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    enc = _wire_encoding(request) if len(content) >= API_COMPRESS_MIN else None
+    raw_len = len(content)
+    if enc:
+        packed = memo.get((fmt, enc)) if memo is not None else None
+        if packed is None:
+            t0 = time.perf_counter()
+            if enc == "br":
+                packed = brotli.compress(content, quality=API_BROTLI_QUALITY)
+            else:
+                packed = gzip.compress(content, compresslevel=API_GZIP_LEVEL, mtime=0)
+            comp_ms = (time.perf_counter() - t0) * 1000
+            _WIRE_STATS["comp_ms"] += comp_ms
+            timing.append(f'comp;dur={comp_ms:.2f};desc="{enc} {raw_len}>{len(packed)}"')
+            if memo is not None:
+                memo[(fmt, enc)] = packed
+        else:
+            _WIRE_STATS["comp_hits"] += 1
+            timing.append(f'comp;dur=0;desc="{enc} cached {raw_len}>{len(packed)}"')
+        content = packed
+        headers["Content-Encoding"] = enc
+    _WIRE_STATS["responses"] += 1
+    _WIRE_STATS["raw_bytes"] += raw_len
+    _WIRE_STATS["sent_bytes"] += len(content)
+    _WIRE_STATS["by_encoding"][enc or "identity"] += 1
+    if timing:
+        headers["Server-Timing"] = ", ".join(timing)
+    media = WIRE_COL_TYPE if fmt == "col" else "application/json"
+    return Response(content=content, media_type=media, headers=headers)
+
+
+def _wire_stats() -> dict:
+    out = dict(_WIRE_STATS, by_encoding=dict(_WIRE_STATS["by_encoding"]))
+    out["ratio"] = round(out["sent_bytes"] / out["raw_bytes"], 3) if out["raw_bytes"] else None
+    out["serializer"] = "orjson" if orjson is not None else "json"
+    return out
+
+
+def _wire_payload(cache: dict, key: str, spec: tuple, fmt: str) -> bytes:
+    """Full-list body for a snapshot cache; the columnar one is built once per rebuild."""
+    if fmt != "col":
+        return cache["payload"]
+    body = cache.get("payload_col")
+    if body is None:
+        body = _json_bytes({
+            "rev": cache.get("rev"),
+            "updated_at": cache.get("updated_at"),
+            key: _col_encode(cache.get("items") or [], spec),
+        })
+        cache["payload_col"] = body
+    return body
+
+
+def _wire_event(event: dict) -> dict:
+    if isinstance(event.get("targets"), list):
+        return dict(event, targets=_col_encode(event["targets"], _TARGET_WIRE))
+    return event
+
+
+# -----------------------------
+# Published snapshots (static, CDN-cacheable)
+# -----------------------------
+# After each committed change a background thread writes the whole map (targets and
+# launch sites, columnar) to SNAPSHOT_DIR/<rev>.json (+ .json.gz for nginx gzip_static),
+# then points latest.json at it. A revision never changes content, so <rev>.json is
+# served immutable; latest.json is tiny and cached for SNAPSHOT_LATEST_MAX_AGE_S. A CDN
+# or nginx can serve /snapshots/ straight from the directory; the routes below cover
+# deployments without one. Bursts of writes are coalesced (SNAPSHOT_DEBOUNCE_S) and
+# only the newest SNAPSHOT_KEEP revisions are kept on disk.
+SNAPSHOT_PUBLISH = _truthy_env("SNAPSHOT_PUBLISH", default="1")
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR") or (DATA_DIR / "snapshots"))
+SNAPSHOT_KEEP = max(2, int(os.getenv("SNAPSHOT_KEEP", "100")))
+SNAPSHOT_DEBOUNCE_S = float(os.getenv("SNAPSHOT_DEBOUNCE_S", "0.2"))
+SNAPSHOT_LATEST_MAX_AGE_S = int(os.getenv("SNAPSHOT_LATEST_MAX_AGE_S", "1"))
+_SNAPSHOT_NAME_RE = re.compile(r"^(\d+)\.json$")
+
+_PUBLISH: dict = {
+    "wake": threading.Event(),
+    "stop": threading.Event(),
+    "thread": None,
+    "floor": None,     # highest revision already on disk when this process started
+    "rev": None,       # revision latest.json points at
+    "latest": None,    # latest.json body
+    "written": 0,
+    "pruned": 0,
+    "errors": 0,
+    "last_ms": 0.0,
+}
+
+
+def _publish_floor() -> int:
+    """Highest published revision on disk (JSON mode starts its revisions above it)."""
+    if _PUBLISH["floor"] is None:
+        _PUBLISH["floor"] = max(_published_revs(), default=0) if SNAPSHOT_PUBLISH else 0
+    return _PUBLISH["floor"]
+
+
+def _published_revs() -> list[int]:
+    if not SNAPSHOT_DIR.exists():
+        return []
+    return sorted(int(m.group(1)) for m in map(_SNAPSHOT_NAME_RE.match, os.listdir(SNAPSHOT_DIR)) if m)
+
+
+def _publish_wake() -> None:
+    if SNAPSHOT_PUBLISH:
+        _PUBLISH["wake"].set()
+
+
+def _publish_write(path: Path, body: bytes) -> None:
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(body)
+    os.replace(tmp, path)
+
+
+def _publish_snapshot() -> None:
+    t0 = time.perf_counter()
+    with _SNAP_LOCK:
+        if not (_TARGETS_SNAP["loaded"] and _LAUNCH_SNAP["loaded"]):
+            return
+        # Rebuilds replace these dicts, so they can be read after the lock is released.
+        targets, sites = _TARGETS_RESP_CACHE, _LAUNCH_RESP_CACHE
+    rev = max(targets["rev"], sites["rev"])
+    if rev == _PUBLISH["rev"]:
+        return
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{rev}.json"
+    path = SNAPSHOT_DIR / name
+    updated_at = targets.get("updated_at")
+    # Another worker sharing the directory may have written this revision already.
+    if not path.exists():
+        body = _json_bytes({
+            "rev": rev,
+            "targets_rev": targets["rev"],
+            "sites_rev": sites["rev"],
+            "updated_at": updated_at,
+            "targets": _col_encode(targets["items"], _TARGET_WIRE),
+            "sites": _col_encode(sites["items"], _LAUNCH_WIRE),
+        })
+        _publish_write(path.with_name(name + ".gz"), gzip.compress(body, compresslevel=9, mtime=0))
+        _publish_write(path, body)
+        _PUBLISH["written"] += 1
+    latest = _json_bytes({
+        "rev": rev,
+        "targets_rev": targets["rev"],
+        "sites_rev": sites["rev"],
+        "updated_at": updated_at,
+        "url": f"/snapshots/{name}",
+    })
+    revs = _published_revs()
+    # Workers sharing the directory: one that is behind must not move the pointer back.
+    if not revs or revs[-1] <= rev:
+        _publish_write(SNAPSHOT_DIR / "latest.json", latest)
+    _PUBLISH["rev"], _PUBLISH["latest"] = rev, latest
+    _publish_prune(revs)
+    _PUBLISH["last_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+
+def _publish_prune(revs: list[int]) -> None:
+    for old in revs[:-SNAPSHOT_KEEP]:
+        for p in (SNAPSHOT_DIR / f"{old}.json", SNAPSHOT_DIR / f"{old}.json.gz"):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+        _PUBLISH["pruned"] += 1
+
+
+def _publish_loop(stop: threading.Event) -> None:
+    wake = _PUBLISH["wake"]
+    while True:
+        wake.wait()
+        if stop.is_set():
+            return
+        stop.wait(SNAPSHOT_DEBOUNCE_S)  # coalesce a burst of writes into one file
+        wake.clear()
+        try:
+            _publish_snapshot()
+        except Exception as e:
+            _PUBLISH["errors"] += 1
+            print(f"[WARN] snapshot publish failed: {e}")
+
+
+def _start_snapshot_publisher() -> None:
+    if not SNAPSHOT_PUBLISH or _PUBLISH["thread"] is not None:
+        return
+    _PUBLISH["stop"].clear()
+    th = threading.Thread(target=_publish_loop, args=(_PUBLISH["stop"],), name="pvls-snapshots", daemon=True)
+    _PUBLISH["thread"] = th
+    th.start()
+    _publish_wake()
+
+
+def _publish_stats() -> dict:
+    return {k: v for k, v in _PUBLISH.items() if k not in ("wake", "stop", "thread", "latest")}
+
+
 # -----------------------------
 # API models
 # -----------------------------
@@ -531,12 +3473,37 @@ class TargetIn(BaseModel):
     active: bool = True
 
 
+TARGET_BATCH_MAX = int(os.getenv("TARGET_BATCH_MAX", "500"))
+
+
+class TargetOpIn(BaseModel):
+    op: str = Field(..., pattern=r"^(create|update|delete)$")
+    id: Optional[str] = None
+    target: Optional[TargetIn] = None
+
+
+class TargetBatchIn(BaseModel):
+    ops: list[TargetOpIn] = Field(..., min_length=1, max_length=TARGET_BATCH_MAX)
+
+
 class LaunchSiteIn(BaseModel):
     name: str
     lat: Optional[float] = None
     lng: Optional[float] = None
     active: bool = False
 
+class ZoneIn(BaseModel):
+    id: Optional[str] = None
+    name: str = Field(min_length=1, max_length=80)
+    kind: str = "circle"  # circle | polygon
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    radius_m: Optional[float] = Field(default=None, gt=0, le=500000)
+    points: Optional[list[list[float]]] = None  # [[lat, lng], ...]
+    level: str = "near"
+    eta_min: Optional[float] = Field(default=None, ge=0, le=60)
+    active: bool = True
+
 class AdminLoginIn(BaseModel):
     username: str
     password: str
@@ -549,60 +3516,879 @@ app = FastAPI(title="Pavlograd Sky Tactical Map")
 @app.middleware("http")
 async def _no_cache_after_deploy(request: Request, call_next):
     resp = await call_next(request)
-    # Mobile browsers cache aggressively; keep HTML/CSS/JS always fresh.
-    if request.url.path.startswith("/static/") or request.url.path in {"/", "/admin", "/login", "/maintenance"}:
+    # Mobile browsers cache aggressively; keep HTML always fresh. Static assets
+    # and pre-rendered pages set their own caching (revalidate via ETag).
+    if request.url.path in {"/", "/admin", "/login", "/maintenance"} and "cache-control" not in resp.headers:
         resp.headers["Cache-Control"] = "no-store, max-age=0"
     return resp
 
+
+# -----------------------------
+# Admission control (rate limits + load shedding)
+# -----------------------------
+# Public API calls (viewer reads, presence pings, the SSE stream) are admitted by a
+# per-client token bucket: RATE_LIMIT_RPS sustained, RATE_LIMIT_BURST deep, 429 when
+# empty. While this worker is overloaded (SHED_MAX_INFLIGHT public requests in flight,
+# event-loop lag over SHED_LOOP_LAG_MS, or every DB connection checked out) public calls
+# are shed with 503 + Retry-After before anything else queues behind them. Admin pages,
+# /api/admin, writes and requests carrying a valid admin cookie are never limited.
+ADMISSION_ENABLED = _truthy_env("ADMISSION_ENABLED", default="1")
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "10"))
+RATE_LIMIT_BURST = max(1.0, float(os.getenv("RATE_LIMIT_BURST", "40")))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "50000"))
+SHED_MAX_INFLIGHT = int(os.getenv("SHED_MAX_INFLIGHT", "256"))
+SHED_LOOP_LAG_S = float(os.getenv("SHED_LOOP_LAG_MS", "500")) / 1000.0
+SHED_RETRY_AFTER_S = max(1, int(os.getenv("SHED_RETRY_AFTER_S", "5")))
+SSE_MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", "5000"))
+SSE_MAX_PER_CLIENT = int(os.getenv("SSE_MAX_PER_CLIENT", "20"))
+# Reverse proxies in front of the app that append to x-forwarded-for (e.g. 1 behind
+# nginx or a PaaS router). 0 keys clients by the peer address.
+TRUSTED_PROXY_HOPS = max(0, int(os.getenv("TRUSTED_PROXY_HOPS", "0")))
+
+_ADMISSION: dict = {"inflight": 0, "limited": 0, "shed": 0, "sse_rejected": 0, "sse_by_client": {}}
+_M_ADMISSION = _Counter("pvls_admission_rejected_total", "Public requests turned away, by reason.", ("reason",))
+
+
+def _client_ip(request: Request) -> str:
+    """Admission key. Only the x-forwarded-for entry appended by our outermost trusted
+    proxy is believed: anything left of it is whatever the client chose to send."""
+    peer = request.client.host if request.client else ""
+    if TRUSTED_PROXY_HOPS <= 0:
+        return peer
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    # Fewer hops than proxies: the request did not come through them.
+    return hops[-TRUSTED_PROXY_HOPS] if len(hops) >= TRUSTED_PROXY_HOPS else peer
+
+
+class _TokenBuckets:
+    """Per-client token buckets. Used from the event loop only, so no lock."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate, self.burst, self.max_keys = rate, burst, max_keys
+        self.buckets: dict[str, list[float]] = {}  # key -> [tokens, last refill]
+
+    def take(self, key: str, now: float) -> float:
+        """Spend one token: 0.0 if admitted, else seconds until the next one."""
+        b = self.buckets.get(key)
+        if b is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            b = self.buckets[key] = [self.burst, now]
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] >= 1.0:
+            b[0] -= 1.0
+            return 0.0
+        return (1.0 - b[0]) / self.rate
+
+    def _prune(self, now: float) -> None:
+        # A bucket idle long enough to refill carries no state; if that frees too
+        # little, drop the least recently seen half.
+        refill_s = self.burst / self.rate
+        self.buckets = {k: b for k, b in self.buckets.items() if now - b[1] < refill_s}
+        if len(self.buckets) >= self.max_keys:
+            keep = sorted(self.buckets.items(), key=lambda kv: kv[1][1])[len(self.buckets) // 2:]
+            self.buckets = dict(keep)
+
+
+_RATE_BUCKETS = _TokenBuckets(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+
+def _admission_public(method: str, path: str) -> bool:
+    if not path.startswith("/api/") or path.startswith("/api/admin"):
+        return False
+    return method in ("GET", "HEAD") or path == "/api/presence"
+
+
+def _overloaded() -> str | None:
+    if SHED_MAX_INFLIGHT > 0 and _ADMISSION["inflight"] >= SHED_MAX_INFLIGHT:
+        return "inflight"
+    if _LOOP_LAG.get("last_s", 0.0) >= SHED_LOOP_LAG_S:
+        return "loop_lag"
+    pool = _DB_POOLS.get(os.getenv("DATABASE_URL") or "")
+    if pool is not None and pool.stats["in_use"] >= pool.maxconn:
+        return "db_pool"
+    return None
+
+
+def _retry_after(base: float) -> str:
+    # Jitter spreads the retries of a crowd that was turned away together.
+    return str(int(math.ceil(base + random.uniform(0, base))))
+
+
+def _admission_reject(reason: str, status: int, retry_after: float) -> JSONResponse:
+    _ADMISSION["limited" if status == 429 else ("sse_rejected" if reason == "sse_cap" else "shed")] += 1
+    _M_ADMISSION.inc(reason)
+    detail = "rate limited" if status == 429 else "server busy, retry later"
+    return JSONResponse({"detail": detail}, status_code=status, headers={"Retry-After": _retry_after(retry_after)})
+
+
+class _AdmissionMiddleware:
+    """Plain ASGI: shed and rate-limit public API calls before they reach a route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED or not _admission_public(scope["method"], scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        if _is_admin(request):
+            await self.app(scope, receive, send)
+            return
+        reason = _overloaded()
+        if reason:
+            await _admission_reject(reason, 503, SHED_RETRY_AFTER_S)(scope, receive, send)
+            return
+        if RATE_LIMIT_RPS > 0:
+            wait = _RATE_BUCKETS.take(_client_ip(request), time.monotonic())
+            if wait:
+                await _admission_reject("rate", 429, wait)(scope, receive, send)
+                return
+        # The SSE stream is long-lived; it has its own cap (SSE_MAX_*) in api_events.
+        counted = scope["path"] != "/api/events"
+        if counted:
+            _ADMISSION["inflight"] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if counted:
+                _ADMISSION["inflight"] -= 1
+
+
+def _admission_stats() -> dict:
+    out = {k: v for k, v in _ADMISSION.items() if k != "sse_by_client"}
+    out["clients"] = len(_RATE_BUCKETS.buckets)
+    out["overloaded"] = _overloaded()
+    return out
+
+
+class _MetricsMiddleware:
+    """Plain ASGI wrapper (no body buffering): count and time each request by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                route = scope.get("route")
+                # Templates, not raw paths, so ids and hashed file names don't explode the label set.
+                name = getattr(route, "path", None) or "unmatched"
+                _M_HTTP_LATENCY.observe(time.perf_counter() - t0, name, scope["method"])
+                _M_HTTP_REQUESTS.inc(name, scope["method"], status[0])
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+app.add_middleware(_AdmissionMiddleware)
+# Added last = outermost, so rejected requests are counted too.
+app.add_middleware(_MetricsMiddleware)
+
+
+async def _loop_lag_monitor() -> None:
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(METRICS_LOOP_LAG_S)
+        lag = max(0.0, time.perf_counter() - t0 - METRICS_LOOP_LAG_S)
+        _LOOP_LAG["last_s"] = lag
+        _M_LOOP_LAG.observe(lag)
+
 @app.on_event("startup")
 def _startup():
+    be = _sql_backend()
     try:
-        _db_init()
-        _db_seed_launchsites_if_empty()
-    except Exception:
-        pass
+        if be:
+            be["init"]()
+            be["seed_launchsites"]()
+    except Exception as e:
+        # Not fatal: the first query retries the migrations.
+        print(f"[WARN] storage init failed: {e}")
+    _start_db_listener()
+    _start_presence_sync()
+    _start_journal_compactor()
+    _start_history_writer()
+    _start_geo_ticker()
+    _start_snapshot_publisher()
+    _snap_targets()
+    _snap_launch()
+    _static_ensure()
+    _preload_templates()
 
-_static_dir = APP_DIR / "static"
-if _static_dir.exists():
-    app.mount("/static", StaticFiles(directory=str(_static_dir)), name="static")
-else:
-    # Don't crash the whole app if someone deploys without static files.
-    # Viewer/admin pages will still work if templates inline everything.
-    print(f"[WARN] static/ folder not found at: {_static_dir} (skipping mount)")
 
+@app.on_event("startup")
+async def _startup_async():
+    if METRICS_ENABLED or ADMISSION_ENABLED:
+        _LOOP_LAG["task"] = asyncio.get_running_loop().create_task(_loop_lag_monitor())
+    if THREADPOOL_SIZE > 0:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    if DB_ASYNC and asyncpg is not None and _storage() == "postgres" and DB_REPLICA_URLS:
+        print("[WARN] DATABASE_REPLICA_URLS is set: viewer reads go through the replica router on DB threads, not asyncpg (DB_ASYNC has no effect)")
+    if _adb_enabled():
+        try:
+            await _adb_pool()
+        except Exception as e:
+            print(f"[WARN] asyncpg pool unavailable, viewer reads use threads: {e}")
+
+
+@app.on_event("shutdown")
+async def _shutdown_async():
+    if _LOOP_LAG["task"] is not None:
+        _LOOP_LAG["task"].cancel()
+        _LOOP_LAG["task"] = None
+    await _adb_close()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    _LISTENER["stop"].set()
+    _JOURNAL["stop"].set()
+    _HISTORY["stop"].set()
+    _GEO["stop"].set()
+    _GEO["wake"].set()
+    _PUBLISH["stop"].set()
+    _PUBLISH["wake"].set()
+    _history_flush()
+    if _storage() == "json":
+        try:
+            _journal_compact()
+        except Exception as e:
+            print(f"[WARN] journal compaction failed: {e}")
+    for pool in list(_DB_POOLS.values()):
+        pool.closeall()
+    _DB_POOLS.clear()
 
-# Presence (in-memory; enough for Render single instance)
-_presence: dict[str, float] = {}
+# -----------------------------
+# Static assets (content-hashed)
+# -----------------------------
+# At startup every file under static/ gets a fingerprinted name
+# (app.3f9c0a1b2d.css). Templates and text assets are rewritten to point at the
+# fingerprinted URLs, which are served as immutable for a year; a deploy that
+# changes a file changes its URL. Text assets are kept in memory pre-compressed
+# (gzip, and brotli when installed); images are streamed from disk.
+STATIC_DIR = APP_DIR / "static"
+STATIC_COMPRESS_MIN = int(os.getenv("STATIC_COMPRESS_MIN", "512"))
+_STATIC_TEXT_TYPES = {
+    ".js": "application/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".txt": "text/plain; charset=utf-8",
+}
+_STATIC_REF_RE = re.compile(r"/static/([A-Za-z0-9_./-]+)(\?v=[^\"'\s)]*)?")
+_STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+_STATIC_LOCK = threading.Lock()
+# manifest: logical path -> hashed path; hashed: hashed path -> logical path.
+_STATIC = {"built": False, "manifest": {}, "hashed": {}, "files": {}}
+
+
+def _accepts_encoding(request: Request, enc: str) -> bool:
+    for part in (request.headers.get("accept-encoding") or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() != enc:
+            continue
+        q = params.strip()
+        return not (q.startswith("q=") and q[2:].strip() in {"0", "0.0", "0.00", "0.000"})
+    return False
+
+
+def _compress_variants(body: bytes) -> dict:
+    out = {}
+    if len(body) < STATIC_COMPRESS_MIN:
+        return out
+    gz = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(gz) < len(body):
+        out["gzip"] = gz
+    if brotli is not None:
+        br = brotli.compress(body, quality=11)
+        if len(br) < len(body):
+            out["br"] = br
+    return out
+
+
+def _static_rewrite(text: str) -> str:
+    manifest = _static_manifest()
+
+    def sub(m):
+        hashed = manifest.get(m.group(1))
+        return f"/static/{hashed}" if hashed else m.group(0)
+
+    return _STATIC_REF_RE.sub(sub, text)
+
+
+def _static_hashed_name(rel: str, digest: str) -> str:
+    stem, dot, ext = rel.rpartition(".")
+    if not dot or "/" in ext:
+        return f"{rel}.{digest}"
+    return f"{stem}.{digest}.{ext}"
+
+
+def _static_build():
+    files, manifest = {}, {}
+    if not STATIC_DIR.exists():
+        # Don't crash the whole app if someone deploys without static files.
+        # Viewer/admin pages will still work if templates inline everything.
+        print(f"[WARN] static/ folder not found at: {STATIC_DIR} (serving no assets)")
+        return files, manifest
+    paths = sorted(p for p in STATIC_DIR.rglob("*") if p.is_file())
+    # Binaries first so text assets that reference them can be rewritten
+    # (and re-hashed) against their fingerprinted names.
+    paths.sort(key=lambda p: p.suffix.lower() in _STATIC_TEXT_TYPES)
+    for p in paths:
+        rel = p.relative_to(STATIC_DIR).as_posix()
+        ext = p.suffix.lower()
+        if ext in _STATIC_TEXT_TYPES:
+            text = p.read_text(encoding="utf-8")
+            body = _STATIC_REF_RE.sub(
+                lambda m: f"/static/{manifest[m.group(1)]}" if m.group(1) in manifest else m.group(0), text
+            ).encode("utf-8")
+            digest = hashlib.sha256(body).hexdigest()[:10]
+            entry = {"ctype": _STATIC_TEXT_TYPES[ext], "body": body, "encoded": _compress_variants(body)}
+        else:
+            h = hashlib.sha256()
+            with p.open("rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()[:10]
+            entry = {"ctype": None, "file": p}
+        entry["etag"] = f'"{digest}"'
+        manifest[rel] = _static_hashed_name(rel, digest)
+        files[rel] = entry
+    return files, manifest
+
+
+def _static_ensure():
+    if _STATIC["built"]:
+        return
+    with _STATIC_LOCK:
+        if _STATIC["built"]:
+            return
+        files, manifest = _static_build()
+        _STATIC["files"] = files
+        _STATIC["manifest"] = manifest
+        _STATIC["hashed"] = {v: k for k, v in manifest.items()}
+        _STATIC["built"] = True
+
+
+def _static_manifest() -> dict:
+    _static_ensure()
+    return _STATIC["manifest"]
+
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"])
+async def static_asset(path: str, request: Request):
+    _static_ensure()
+    rel = _STATIC["hashed"].get(path)
+    immutable = rel is not None
+    if rel is None:
+        rel = path
+    entry = _STATIC["files"].get(rel)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    # Unhashed URLs (old bookmarks, third-party embeds) still work but must revalidate.
+    headers = {"Cache-Control": _STATIC_IMMUTABLE if immutable else "no-cache"}
+    if "file" in entry:
+        headers["ETag"] = entry["etag"]
+        if request.headers.get("if-none-match") == entry["etag"]:
+            return Response(status_code=304, headers=headers)
+        return FileResponse(entry["file"], headers=headers)
+
+    body, etag = entry["body"], entry["etag"]
+    headers["Vary"] = "Accept-Encoding"
+    for enc in ("br", "gzip"):
+        if enc in entry["encoded"] and _accepts_encoding(request, enc):
+            body = entry["encoded"][enc]
+            etag = f'{etag[:-1]}-{enc}"'
+            headers["Content-Encoding"] = enc
+            break
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        return Response(status_code=200, headers=headers, media_type=entry["ctype"])
+    return Response(content=body, headers=headers, media_type=entry["ctype"])
+
+
+@app.api_route("/snapshots/{name}", methods=["GET", "HEAD"])
+async def published_snapshot(name: str, request: Request):
+    """Serve published snapshots when nothing in front of the app does."""
+    if not SNAPSHOT_PUBLISH:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if name == "latest.json":
+        body = _PUBLISH["latest"]
+        if body is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        max_age = SNAPSHOT_LATEST_MAX_AGE_S
+        headers = {"Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={max_age * 5}"}
+        return Response(content=body, headers=headers, media_type="application/json")
+    m = _SNAPSHOT_NAME_RE.match(name)
+    path = SNAPSHOT_DIR / name
+    if m is None or not path.exists():
+        raise HTTPException(status_code=404, detail="Not Found")
+    etag = f'"r{m.group(1)}"'
+    headers = {"Cache-Control": _STATIC_IMMUTABLE, "ETag": etag, "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    gz = path.with_name(name + ".gz")
+    if _accepts_encoding(request, "gzip") and gz.exists():
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(gz, headers=headers, media_type="application/json")
+    return FileResponse(path, headers=headers, media_type="application/json")
+
+
+# -----------------------------
+# Live events (SSE broadcaster)
+# -----------------------------
+# One hub per process. Writers publish once; the hub formats the frame once and
+# hands it to every subscriber's bounded queue. Idle connections just wait on their
+# queue, waking only for an event or the keepalive timeout.
+SSE_QUEUE_MAX = max(1, int(os.getenv("SSE_QUEUE_MAX", "32")))
+SSE_KEEPALIVE_S = float(os.getenv("SSE_KEEPALIVE_S", "15"))
+# What to do when a subscriber's queue is full (stalled client):
+#   disconnect  - drop its backlog and close the stream; EventSource reconnects and refetches
+#   drop_oldest - discard the oldest queued event and keep the connection
+SSE_SLOW_POLICY = (os.getenv("SSE_SLOW_POLICY", "disconnect") or "disconnect").strip().lower()
+
+
+class _Subscriber:
+    __slots__ = ("queue", "closed", "fmt")
+
+    def __init__(self, maxsize: int, fmt: str = "json"):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+        self.fmt = fmt
+
+
+class _EventHub:
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.subscribers: set[_Subscriber] = set()
+        self.seq = 0
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0, "disconnected": 0}
+        self._lock = threading.Lock()
+
+    def subscribe(self, fmt: str = "json") -> _Subscriber:
+        # Called from the event loop; remember it so threadpool writers can reach us.
+        self.loop = asyncio.get_running_loop()
+        sub = _Subscriber(SSE_QUEUE_MAX, fmt)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber) -> None:
+        sub.closed = True
+        self.subscribers.discard(sub)
+
+    def publish(self, event: dict) -> None:
+        """Thread-safe: assign seq, format the frame once per wire format, fan out on the loop."""
+        with self._lock:
+            self.seq += 1
+            event = dict(event, seq=self.seq)
+            name = event.get("type") or "message"
+            frame = f"event: {name}\ndata: {_json_bytes(event).decode('utf-8')}\n\n"
+            col = _wire_event(event)
+            frames = {"json": frame, "col": frame if col is event else f"event: {name}\ndata: {_json_bytes(col).decode('utf-8')}\n\n"}
+            self.stats["published"] += 1
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._fanout(frames)
+        else:
+            loop.call_soon_threadsafe(self._fanout, frames)
+
+    def _fanout(self, frames: dict) -> None:
+        for sub in list(self.subscribers):
+            if sub.closed:
+                continue
+            frame = frames[sub.fmt]
+            q = sub.queue
+            try:
+                q.put_nowait(frame)
+                self.stats["delivered"] += 1
+                continue
+            except asyncio.QueueFull:
+                pass
+            if SSE_SLOW_POLICY == "drop_oldest":
+                try:
+                    q.get_nowait()
+                    q.put_nowait(frame)
+                    self.stats["dropped"] += 1
+                    self.stats["delivered"] += 1
+                except (asyncio.QueueEmpty, asyncio.QueueFull):
+                    pass
+                continue
+            # disconnect: free the backlog now and leave only the close marker
+            while not q.empty():
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            q.put_nowait(None)
+            sub.closed = True
+            self.subscribers.discard(sub)
+            self.stats["disconnected"] += 1
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, subscribers=len(self.subscribers), seq=self.seq, policy=SSE_SLOW_POLICY)
+
+
+_HUB = _EventHub()
 
-_SSE_STATE: dict = {"seq": 0, "type": "init", "entity": "", "updated_at": _now_iso()}
 
-def _push_sse_event(ev_type: str, entity: str = "", updated_at: str | None = None) -> None:
-    global _SSE_STATE
-    _SSE_STATE = {
-        "seq": int((_SSE_STATE or {}).get("seq", 0)) + 1,
+def _push_sse_event(ev_type: str, entity: str = "", updated_at: str | None = None, **change) -> None:
+    """Publish a change. `change` carries the delta: op=upsert + target/site row,
+    op=delete + id, or op=clear, so viewers can apply it without refetching."""
+    _HUB.publish({
         "type": ev_type,
         "entity": entity,
         "updated_at": updated_at or _now_iso(),
-    }
+        **change,
+    })
+
+
+# -----------------------------
+# Presence (online counter)
+# -----------------------------
+# A ping moves the sid into the current time bucket (O(1)); expiry pops whole buckets
+# that left the window, so each sid is dropped exactly once (amortized O(1) per ping)
+# instead of scanning every viewer on every request.
+PRESENCE_WINDOW_S = float(os.getenv("PRESENCE_WINDOW_S", "60"))
+PRESENCE_BUCKET_S = max(1.0, float(os.getenv("PRESENCE_BUCKET_S", "5")))
+# Optional HyperLogLog sketches: a mergeable approximate count; in Postgres mode each
+# worker broadcasts its window sketch every PRESENCE_SYNC_S so every worker can report
+# the audience of the whole deployment.
+PRESENCE_HLL = _truthy_env("PRESENCE_HLL", default="0")
+PRESENCE_SYNC_S = float(os.getenv("PRESENCE_SYNC_S", "10"))
+HLL_P = 11
+
+
+class _HyperLogLog:
+    """HyperLogLog with 2**HLL_P one-byte registers (~2.3% standard error)."""
+
+    def __init__(self, registers: bytes | None = None):
+        m = 1 << HLL_P
+        self.registers = bytearray(registers) if registers and len(registers) == m else bytearray(m)
+
+    def add(self, value: str) -> None:
+        x = int.from_bytes(hashlib.blake2b(value.encode("utf-8", "ignore"), digest_size=8).digest(), "big")
+        idx = x >> (64 - HLL_P)
+        w = (x << HLL_P) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - HLL_P + 1, (64 - w.bit_length()) + 1)
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "_HyperLogLog") -> "_HyperLogLog":
+        regs = self.registers
+        for i, r in enumerate(other.registers):
+            if r > regs[i]:
+                regs[i] = r
+        return self
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(est))
+
+    def to_b64(self) -> str:
+        return _b64url_encode(bytes(self.registers))
+
+    @classmethod
+    def from_b64(cls, s: str) -> "_HyperLogLog":
+        return cls(_b64url_decode(s))
+
+
+class _Presence:
+    def __init__(self, window_s: float, bucket_s: float, with_hll: bool):
+        self.bucket_s = bucket_s
+        self.nbuckets = max(1, int(math.ceil(window_s / bucket_s)))
+        self.last: dict[str, int] = {}  # sid -> bucket of its latest ping
+        self.buckets: dict[int, set[str]] = {}
+        self.sketches: dict[int, _HyperLogLog] | None = {} if with_hll else None
+        self.remote: dict[str, tuple[float, _HyperLogLog]] = {}  # worker -> (received, sketch)
+        self.oldest: int | None = None
+        self._total_cache: tuple[float, int] = (0.0, 0)
+        self.lock = threading.Lock()
+
+    def _expire(self, b: int) -> None:
+        cutoff = b - self.nbuckets
+        if self.oldest is None:
+            self.oldest = b
+            return
+        if cutoff - self.oldest > len(self.buckets):
+            # Long idle gap: walk the few live buckets instead of every empty slot.
+            stale = [k for k in self.buckets if k <= cutoff]
+        else:
+            stale = range(self.oldest, cutoff + 1)
+        for k in stale:
+            for sid in self.buckets.pop(k, ()):
+                self.last.pop(sid, None)
+            if self.sketches is not None:
+                self.sketches.pop(k, None)
+        self.oldest = max(self.oldest, cutoff + 1)
+
+    def touch(self, sid: str, now: float | None = None) -> int:
+        b = int((now if now is not None else time.time()) // self.bucket_s)
+        with self.lock:
+            self._expire(b)
+            prev = self.last.get(sid)
+            if prev != b:
+                if prev is not None:
+                    s = self.buckets.get(prev)
+                    if s is not None:
+                        s.discard(sid)
+                self.buckets.setdefault(b, set()).add(sid)
+                self.last[sid] = b
+            if self.sketches is not None:
+                self.sketches.setdefault(b, _HyperLogLog()).add(sid)
+            return len(self.last)
+
+    def count(self, now: float | None = None) -> int:
+        b = int((now if now is not None else time.time()) // self.bucket_s)
+        with self.lock:
+            self._expire(b)
+            return len(self.last)
+
+    def sketch(self) -> _HyperLogLog | None:
+        """This worker's window as one sketch (None when HLL is off)."""
+        if self.sketches is None:
+            return None
+        self.count()
+        with self.lock:
+            out = _HyperLogLog()
+            for s in self.sketches.values():
+                out.merge(s)
+            return out
+
+    def add_remote(self, worker: str, sketch: _HyperLogLog) -> None:
+        with self.lock:
+            self.remote[worker] = (time.time(), sketch)
+
+    def approx_total(self) -> int | None:
+        """Approximate viewers across this and recently heard-from workers (cached ~1 s)."""
+        if self.sketches is None:
+            return None
+        ts, value = self._total_cache
+        if time.time() - ts < 1.0:
+            return value
+        total = self.sketch()
+        cutoff = time.time() - max(PRESENCE_WINDOW_S, 3 * PRESENCE_SYNC_S)
+        with self.lock:
+            for worker, (ts, s) in list(self.remote.items()):
+                if ts < cutoff:
+                    self.remote.pop(worker, None)
+                else:
+                    total.merge(s)
+        value = total.count()
+        self._total_cache = (time.time(), value)
+        return value
+
+
+_PRESENCE = _Presence(PRESENCE_WINDOW_S, PRESENCE_BUCKET_S, PRESENCE_HLL)
+
+
+def _presence_sync_loop(stop: threading.Event) -> None:
+    while not stop.wait(PRESENCE_SYNC_S):
+        try:
+            sk = _PRESENCE.sketch()
+            if sk is None:
+                return
+            with _db_conn() as conn:
+                with conn.cursor() as cur:
+                    _db_notify(cur, "presence", "sketch", 0, sketch=sk.to_b64())
+        except Exception as e:
+            print(f"[WARN] presence sketch broadcast failed: {e}")
+
+
+def _start_presence_sync() -> None:
+    if not PRESENCE_HLL or not DB_LISTEN or _storage() != "postgres":
+        return
+    threading.Thread(target=_presence_sync_loop, args=(_LISTENER["stop"],), name="pvls-presence-sync", daemon=True).start()
+
+
+# -----------------------------
+# Cross-process change listener (Postgres LISTEN)
+# -----------------------------
+# One thread per worker holds a dedicated (non-pooled) connection on NOTIFY_CHANNEL.
+# Changes made by other workers/instances are applied to this worker's snapshot and
+# fanned out to its SSE subscribers; after a (re)connect the snapshot is reloaded,
+# since notifications sent while we were away are lost.
+DB_LISTEN = _truthy_env("DB_LISTEN", default="1")
+_LISTENER: dict = {"thread": None, "stop": threading.Event(), "connected": False,
+                   "received": 0, "applied": 0, "resyncs": 0, "errors": 0}
+
+
+def _resync_from_db() -> None:
+    _LISTENER["resyncs"] += 1
+    _snap_invalidate()
+    _snap_targets()
+    _snap_launch()
+    # No `op`: viewers treat it as a gap and catch up with since=<rev>.
+    _push_sse_event("targets_changed", "targets")
+    _push_sse_event("launchsites_changed", "launchsites")
+
+
+def _apply_remote_change(msg: dict) -> None:
+    if msg.get("origin") == WORKER_ID:
+        return
+    entity = msg.get("entity")
+    op = msg.get("op")
+    rev = int(msg.get("rev") or 0)
+    if entity == "presence":
+        if op == "sketch" and msg.get("sketch"):
+            _PRESENCE.add_remote(str(msg.get("origin") or ""), _HyperLogLog.from_b64(msg["sketch"]))
+        return
+    if entity == "targets":
+        if not _TARGETS_SNAP["loaded"]:
+            return  # loads fresh on first read
+        if op == "upsert" and isinstance(msg.get("target"), dict):
+            t = msg["target"]
+            if _snap_targets_upsert(t):
+                _push_sse_event("targets_changed", "targets", t.get("updated_at"), op="upsert", target=t, rev=rev)
+            return
+        if op == "delete" and msg.get("id"):
+            _snap_targets_delete(str(msg["id"]), msg.get("updated_at"), rev)
+            _push_sse_event("targets_changed", "targets", msg.get("updated_at"), op="delete", id=str(msg["id"]), rev=rev)
+            return
+        if op == "batch":
+            deleted = {str(k): int(v) for k, v in (msg.get("deleted") or {}).items()}
+            rows = _snap_targets_apply(msg.get("targets") or [], deleted, msg.get("updated_at"))
+            _push_sse_event(
+                "targets_changed", "targets", msg.get("updated_at"),
+                op="batch", targets=rows, deleted=list(deleted), rev=rev,
+            )
+            return
+        if op == "clear":
+            _snap_targets_clear(msg.get("updated_at"), rev)
+            _push_sse_event("targets_changed", "targets", msg.get("updated_at"), op="clear", rev=rev)
+            return
+    elif entity == "zones":
+        _geo_zones_changed()
+        return
+    elif entity == "launchsites":
+        if not _LAUNCH_SNAP["loaded"]:
+            return
+        if op == "upsert" and isinstance(msg.get("site"), dict):
+            s = msg["site"]
+            _snap_launch_upsert(s)
+            _push_sse_event("launchsites_changed", "launchsites", s.get("updated_at"), op="upsert", site=s, rev=rev)
+            return
+    _resync_from_db()
+
+
+def _db_listen_loop(stop: threading.Event) -> None:
+    backoff = 1.0
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(os.getenv("DATABASE_URL"), sslmode=os.getenv("DB_SSLMODE", "require"))
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(psycopg2.sql.SQL("listen {};").format(psycopg2.sql.Identifier(NOTIFY_CHANNEL)))
+            _LISTENER["connected"] = True
+            backoff = 1.0
+            if _TARGETS_SNAP["loaded"] or _LAUNCH_SNAP["loaded"]:
+                _resync_from_db()
+            last_ping = time.monotonic()
+            while not stop.is_set():
+                if not select.select([conn], [], [], 5.0)[0]:
+                    if time.monotonic() - last_ping > 60:
+                        with conn.cursor() as cur:
+                            cur.execute("select 1;")
+                        last_ping = time.monotonic()
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    _LISTENER["received"] += 1
+                    try:
+                        _apply_remote_change(json.loads(n.payload or "{}"))
+                        _LISTENER["applied"] += 1
+                    except Exception as e:
+                        _LISTENER["errors"] += 1
+                        print(f"[WARN] change notification failed: {e}")
+        except Exception as e:
+            _LISTENER["errors"] += 1
+            print(f"[WARN] DB listener disconnected: {e}")
+        finally:
+            _LISTENER["connected"] = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        stop.wait(backoff)
+        backoff = min(30.0, backoff * 2)
+
+
+def _start_db_listener() -> None:
+    if not DB_LISTEN or _storage() != "postgres":
+        return
+    if _LISTENER["thread"] is not None and _LISTENER["thread"].is_alive():
+        return
+    _LISTENER["stop"].clear()
+    th = threading.Thread(target=_db_listen_loop, args=(_LISTENER["stop"],), name="pvls-db-listen", daemon=True)
+    _LISTENER["thread"] = th
+    th.start()
+
+
+def _listener_stats() -> dict:
+    return {k: v for k, v in _LISTENER.items() if k not in ("thread", "stop")}
 
 
 @app.get("/api/events")
-async def api_events(request: Request):
+async def api_events(request: Request, fmt: str | None = None):
+    ip = _client_ip(request)
+    per_client = _ADMISSION["sse_by_client"]
+    if ADMISSION_ENABLED and not _is_admin(request) and (
+        len(_HUB.subscribers) >= SSE_MAX_CLIENTS or per_client.get(ip, 0) >= SSE_MAX_PER_CLIENT
+    ):
+        return _admission_reject("sse_cap", 503, SHED_RETRY_AFTER_S)
+
     async def event_stream():
-        last_seq = 0
-        keepalive_at = time.time()
-        while True:
-            if await request.is_disconnected():
-                break
-            state = dict(_SSE_STATE)
-            if int(state.get("seq", 0)) != last_seq:
-                last_seq = int(state.get("seq", 0))
-                payload = json.dumps(state, ensure_ascii=False)
-                yield f"event: {state.get('type') or 'message'}\ndata: {payload}\n\n"
-            elif time.time() - keepalive_at >= 15:
-                keepalive_at = time.time()
-                yield ": keepalive\n\n"
-            await asyncio.sleep(0.05)
+        sub = _HUB.subscribe(_wire_fmt(request, fmt))
+        per_client[ip] = per_client.get(ip, 0) + 1
+        try:
+            # Tell a (re)connecting client where the stream starts; it refetches once
+            # (up to at least these revs) and then applies deltas with seq > this one
+            # (a jump in seq means a gap).
+            hello = {"seq": _HUB.seq, "targets_rev": _TARGETS_SNAP["rev"], "sites_rev": _LAUNCH_SNAP["rev"]}
+            yield f"event: hello\ndata: {_json_bytes(hello).decode('utf-8')}\n\n"
+            while True:
+                try:
+                    frame = await asyncio.wait_for(sub.queue.get(), timeout=SSE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            _HUB.unsubscribe(sub)
+            if per_client.get(ip, 0) <= 1:
+                per_client.pop(ip, None)
+            else:
+                per_client[ip] -= 1
 
     headers = {
         "Cache-Control": "no-cache",
@@ -613,7 +4399,7 @@ async def api_events(request: Request):
 
 
 @app.post("/api/presence")
-def presence_ping(payload: dict, request: Request):
+async def presence_ping(payload: dict, request: Request):
     """Online counter.
 
     Client normally sends a persistent random sid. Some mobile/in-app browsers
@@ -624,42 +4410,145 @@ def presence_ping(payload: dict, request: Request):
     if not sid:
         # Fallback: ip + user-agent hash
         try:
-            ip = request.headers.get("x-forwarded-for", "").split(",")[0].strip() or (request.client.host if request.client else "")
+            ip = _client_ip(request)  # same address admission control sees
         except Exception:
             ip = ""
         ua = (request.headers.get("user-agent") or "")[:200]
-        import hashlib
         sid = "f_" + hashlib.sha1(f"{ip}|{ua}".encode("utf-8", "ignore")).hexdigest()[:16]
-    now = datetime.now().timestamp()
-    _presence[sid] = now
-    cutoff = now - 60
-    for k in list(_presence.keys()):
-        if _presence.get(k, 0) < cutoff:
-            _presence.pop(k, None)
+    online = _PRESENCE.touch(sid)
     # Keep `online` for backwards compatibility, but also return `count`
-    # because the frontend expects it.
-    online = len(_presence)
-    return JSONResponse({"ok": True, "online": online, "count": online})
+    # because the frontend expects it (deployment-wide estimate when sketches are on).
+    total = _PRESENCE.approx_total()
+    return _FastJSONResponse({"ok": True, "online": online, "count": max(total or 0, online)})
 
 
 @app.get("/api/stats")
-def api_stats():
-    now = datetime.now().timestamp()
-    cutoff = now - 60
-    for k in list(_presence.keys()):
-        if _presence.get(k, 0) < cutoff:
-            _presence.pop(k, None)
-
-    last = None
+async def api_stats():
+    cache = await _asnap_targets()
+    last = cache.get("updated_at") if _TARGETS_SNAP["items"] else None
+
+    out = {"online": _PRESENCE.count(), "updated_at": last}
+    total = _PRESENCE.approx_total()
+    if total is not None:
+        out["online_total"] = max(total, out["online"])
+    return _FastJSONResponse(out)
+
+
+@app.get("/api/presence/sketch")
+async def presence_sketch():
+    """This worker's HyperLogLog window, for merging counts across workers."""
+    sk = _PRESENCE.sketch()
+    if sk is None:
+        raise HTTPException(status_code=404, detail="presence sketches disabled")
+    return JSONResponse({"worker": WORKER_ID, "p": HLL_P, "window_s": PRESENCE_WINDOW_S, "sketch": sk.to_b64()})
+
+
+@app.get("/api/admin/stats")
+def api_admin_stats(request: Request):
+    _require_admin(request)
+    return JSONResponse({
+        "worker": WORKER_ID,
+        "schema_version": _DB_SCHEMA["version"] if _storage() == "postgres" else None,
+        "db_pool": _db_pool_stats(),
+        "sse": _HUB.snapshot(),
+        "listener": _listener_stats(),
+        "db_async": _adb_stats(),
+        "journal": _journal_stats() if _storage() == "json" else None,
+        "history": _history_stats(),
+        "wire": _wire_stats(),
+        "geofence": _geo_stats(),
+        "admission": _admission_stats(),
+        "replicas": _replica_stats(),
+        "snapshots": _publish_stats(),
+    })
+
+
+def _metrics_gauges(out: list) -> None:
+    def gauge(name: str, help_text: str, samples: list) -> None:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} gauge")
+        for labels, v in samples:
+            out.append(f"{name}{{{labels}}} {v}" if labels else f"{name} {v}")
+
+    def counter(name: str, help_text: str, value) -> None:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} counter")
+        out.append(f"{name} {value}")
+
+    hub = _HUB.snapshot()
+    gauge("pvls_worker_info", "Worker identity.", [(f'worker="{WORKER_ID}",storage="{_storage()}"', 1)])
+    gauge("pvls_sse_subscribers", "Open event-stream connections on this worker.", [("", hub["subscribers"])])
+    counter("pvls_sse_events_published_total", "Events published to the hub.", hub["published"])
+    counter("pvls_sse_frames_delivered_total", "Event frames queued to subscribers (fan-out).", hub["delivered"])
+    counter("pvls_sse_frames_dropped_total", "Frames dropped for slow subscribers.", hub["dropped"])
+    counter("pvls_sse_disconnected_total", "Slow subscribers disconnected.", hub["disconnected"])
+    with _PRESENCE.lock:
+        sids = len(_PRESENCE.last)
+    gauge("pvls_presence_sids", "Viewer sids in the presence window on this worker.", [("", sids)])
+    gauge("pvls_targets", "Targets in the in-memory snapshot.", [("", len(_TARGETS_SNAP["items"]))])
+    gauge("pvls_snapshot_rev", "Revision of the in-memory snapshot.", [("", _TARGETS_SNAP["rev"])])
+    pools = _db_pool_stats()
+    gauge("pvls_db_pool_in_use", "Pooled connections checked out.", [(f'pool="{k}"', v["in_use"]) for k, v in pools.items()])
+    gauge("pvls_db_pool_open", "Pooled connections open.", [(f'pool="{k}"', v["open"]) for k, v in pools.items()])
+    wire = _wire_stats()
+    gauge("pvls_wire_bytes", "API body bytes before/after compression.", [('kind="raw"', wire["raw_bytes"]), ('kind="sent"', wire["sent_bytes"])])
+    gauge("pvls_wire_compress_seconds", "Time spent compressing API bodies.", [("", round(wire["comp_ms"] / 1000, 6))])
+    hist = _history_stats()
+    gauge("pvls_history_queued", "Track points waiting for the history writer.", [("", hist["queued"])])
+    counter("pvls_history_written_total", "Track points written.", hist["written"])
+    counter("pvls_history_dropped_total", "Track points dropped (queue full).", hist["dropped"])
+
+
+@app.get("/metrics")
+def metrics(request: Request):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="metrics disabled")
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("authorization") or "", f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="unauthorized")
+    out: list[str] = []
+    for m in _METRICS:
+        m.render(out)
+    _metrics_gauges(out)
+    return Response(content="\n".join(out) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _history_time(value: str | None, default: float) -> float:
+    """Epoch seconds or an ISO timestamp (naive = TRAJ_NAIVE_TZ)."""
+    if not value:
+        return default
     try:
-        targets = _load_targets()
-        if targets:
-            # updated_at is ISO string
-            last = max((t.get("updated_at") or t.get("created_at") or "") for t in targets)
-    except Exception:
-        last = None
+        return float(value)
+    except ValueError:
+        pass
+    ts = _parse_ts(value)
+    if ts is None:
+        raise HTTPException(status_code=422, detail=f"bad timestamp: {value}")
+    return ts
+
+
+@app.get("/api/admin/history")
+def api_admin_history(
+    request: Request,
+    start: str | None = None,
+    end: str | None = None,
+    target_id: str | None = None,
+    chunk: int = HISTORY_CHUNK,
+):
+    """Stream recorded positions in [start, end) as NDJSON (default: the last 12 hours)."""
+    _require_admin(request)
+    t1 = _history_time(end, time.time())
+    t0 = _history_time(start, t1 - 12 * 3600)
+    if t0 >= t1:
+        raise HTTPException(status_code=422, detail="start must be before end")
+    _history_flush()  # include points still waiting in the queue
+
+    def body():
+        for page in _history_chunks(t0, t1, target_id, max(1, min(chunk, 10000))):
+            yield b"".join(_json_bytes(r) + b"\n" for r in page)
 
-    return JSONResponse({"online": len(_presence), "updated_at": last})
+    return StreamingResponse(body(), media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -669,8 +4558,8 @@ def root(request: Request):
 @app.get("/viewer", response_class=HTMLResponse)
 def viewer(request: Request):
     if not _is_maintenance_ok(request):
-        return HTMLResponse(_read_template("maintenance.html"))
-    return HTMLResponse(_read_template("viewer.html"))
+        return _template_response(request, "maintenance.html")
+    return _template_response(request, "viewer.html")
 
 @app.post("/maintenance/login")
 def maintenance_login(payload: dict):
@@ -693,8 +4582,8 @@ def maintenance_login(payload: dict):
 @app.get("/admin", response_class=HTMLResponse)
 def admin(request: Request):
     if _is_admin(request):
-        return HTMLResponse(_read_template("admin.html"))
-    return HTMLResponse(_read_template("login.html"))
+        return _template_response(request, "admin.html")
+    return _template_response(request, "login.html")
 
 
 
@@ -724,39 +4613,145 @@ def admin_logout():
 
 
 @app.get("/api/targets")
-def get_targets(request: Request, since: str | None = None):
-    # Operator mode: no response micro-cache/cooldown. Return fresh DB/JSON state.
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        updated_at = _db_max_updated_at("pvls_targets")
-        if _since_not_changed(since, updated_at):
-            return JSONResponse({"updated_at": updated_at or _now_iso(), "targets": None})
-        items = _load_targets()
-        updated_at = _get_targets_updated_at(items)
+async def get_targets(
+    request: Request,
+    since: str | None = None,
+    bbox: str | None = None,
+    zoom: int | None = None,
+    fmt: str | None = None,
+):
+    # Served from the in-memory snapshot; admin writes keep it current.
+    # `since=<rev>` answers with a delta (changed rows + deleted ids) when it can.
+    # `bbox`/`zoom` limit the answer to the viewport (clustered below CLUSTER_MAX_ZOOM).
+    cache = await _asnap_targets()
+    wire = _wire_fmt(request, fmt)
+    updated_at = cache.get("updated_at") or _now_iso()
+    view = _parse_bbox(bbox)
+    if zoom is not None:
+        zoom = max(0, min(zoom, 22))
+    clustered = view is not None and zoom is not None and zoom < CLUSTER_MAX_ZOOM
+    since_rev = _parse_rev(since)
+    if since_rev is not None:
+        if since_rev == cache["rev"]:
+            return _wire_response(request, {"rev": since_rev, "updated_at": updated_at, "targets": None}, wire)
+        # Clusters are recomputed as a whole; only point views take deltas.
+        delta = None if clustered else _snap_targets_delta(since_rev)
+        be = _sql_backend()
+        if delta is None and not clustered and since_rev < cache["rev"] and be:
+            try:
+                delta = await _adb_call(_adb_fetch_targets_since, be["fetch_targets_since"], since_rev)
+            except Exception:
+                delta = None
+        if delta is not None:
+            body = {
+                "rev": delta["rev"],
+                "updated_at": updated_at,
+                "delta": True,
+                "targets": delta["changed"],
+                "deleted": list(delta["deleted"]),
+            }
+            if view is not None:
+                # Rows that moved out of the viewport are listed separately: they still exist.
+                body["left"] = [str(t["id"]) for t in body["targets"] if not _in_bbox(t, view)]
+                body["targets"] = [t for t in body["targets"] if _in_bbox(t, view)]
+            if wire == "col":
+                body["targets"] = _col_encode(body["targets"], _TARGET_WIRE)
+            return _wire_response(request, body, wire)
+    elif _since_not_changed(since, updated_at):
+        return _wire_response(request, {"rev": cache["rev"], "updated_at": updated_at, "targets": None}, wire)
+    if view is not None:
+        return _wire_response(request, _targets_view(cache, view, zoom, wire), wire)
+    return _wire_response(request, _wire_payload(cache, "targets", _TARGET_WIRE, wire), wire, cache.setdefault("enc", {}))
+
+
+@app.get("/api/trajectories")
+async def get_trajectories(request: Request, horizon: int = TRAJ_DEFAULT_HORIZON_S, step: int = TRAJ_DEFAULT_STEP_S):
+    """Predicted positions of moving targets from t0 to t0+horizon, every `step` seconds."""
+    step = max(1, min(step, TRAJ_MAX_HORIZON_S))
+    horizon = max(step, min(horizon, TRAJ_MAX_HORIZON_S, step * TRAJ_MAX_STEPS))
+    await _asnap_targets()
+    entry = _traj_payload(horizon, step)
+    resp = _wire_response(request, entry["body"], "json", entry["enc"])
+    resp.headers["X-Server-Time"] = f"{time.time():.3f}"
+    return resp
+
+
+@app.get("/api/zones")
+async def get_zones(request: Request):
+    """Geofence zones and which targets are inside / approaching each one."""
+    resp = _GEO["resp"]
+    if resp is None:  # before the worker's first pass
+        await _asnap_targets()
+        resp = await _db_run(_geo_build_resp)
+    return _wire_response(request, resp["payload"], "json", resp["enc"])
+
+
+@app.post("/api/zones")
+def upsert_zone(request: Request, z: ZoneIn):
+    _require_admin(request)
+    zone = {"id": (z.id or "").strip()[:40] or f"z{int(time.time() * 1000)}_{uuid.uuid4().hex[:6]}",
+            "name": z.name.strip(), "kind": z.kind, "level": z.level, "active": z.active,
+            "eta_min": z.eta_min if z.eta_min is not None else GEO_ETA_MIN}
+    if zone["id"] in {b["id"] for b in _geo_builtin_zones()}:
+        raise HTTPException(status_code=400, detail="built-in zone (configure via GEO_CITY_*)")
+    if z.level not in GEO_LEVELS:
+        raise HTTPException(status_code=422, detail=f"level must be one of {', '.join(GEO_LEVELS)}")
+    if z.kind == "circle":
+        if z.lat is None or z.lng is None or z.radius_m is None:
+            raise HTTPException(status_code=422, detail="circle needs lat, lng, radius_m")
+        zone.update(lat=float(z.lat), lng=float(z.lng), radius_m=float(z.radius_m))
+    elif z.kind == "polygon":
+        pts = [[float(p[0]), float(p[1])] for p in (z.points or []) if len(p) == 2]
+        if len(pts) < 3 or len(pts) != len(z.points or []) or len(pts) > 200:
+            raise HTTPException(status_code=422, detail="polygon needs 3-200 [lat, lng] points")
+        zone["points"] = pts
     else:
-        items = _load_targets()
-        updated_at = _get_targets_updated_at(items)
-        if _since_not_changed(since, updated_at):
-            return JSONResponse({"updated_at": updated_at, "targets": None})
+        raise HTTPException(status_code=422, detail="kind must be circle or polygon")
 
-    return JSONResponse({"updated_at": updated_at, "targets": items or []})
+    be = _sql_backend()
+    if be:
+        be["upsert_zone"](zone)
+    else:
+        items = [x for x in _geo_load_admin() if x.get("id") != zone["id"]] + [zone]
+        tmp = str(ZONES_PATH) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, ZONES_PATH)
+    _geo_zones_changed()
+    return JSONResponse(zone)
 
 
-@app.get("/api/launchsites")
-def get_launch_sites(request: Request, since: str | None = None):
-    # Same policy for launch sites: fresh state, no artificial response delay.
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        updated_at = _db_max_updated_at("pvls_launchsites")
-        if _since_not_changed(since, updated_at):
-            return JSONResponse({"updated_at": updated_at or _now_iso(), "sites": None})
-        items = _load_launch_sites()
-        updated_at = _get_launch_updated_at(items)
+@app.delete("/api/zones/{zone_id}")
+def delete_zone(request: Request, zone_id: str):
+    _require_admin(request)
+    be = _sql_backend()
+    if be:
+        found = be["delete_zone"](zone_id)
     else:
-        items = _load_launch_sites()
-        updated_at = _get_launch_updated_at(items)
-        if _since_not_changed(since, updated_at):
-            return JSONResponse({"updated_at": updated_at, "sites": None})
+        items = _geo_load_admin()
+        keep = [x for x in items if x.get("id") != zone_id]
+        found = len(keep) != len(items)
+        if found:
+            tmp = str(ZONES_PATH) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(keep, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, ZONES_PATH)
+    if not found:
+        raise HTTPException(status_code=404, detail="not found")
+    _geo_zones_changed()
+    return JSONResponse({"ok": True})
 
-    return JSONResponse({"updated_at": updated_at, "sites": items or []})
+
+@app.get("/api/launchsites")
+async def get_launch_sites(request: Request, since: str | None = None, fmt: str | None = None):
+    # Same policy for launch sites (small list: no deltas, just "unchanged" or full).
+    cache = await _asnap_launch()
+    wire = _wire_fmt(request, fmt)
+    updated_at = cache.get("updated_at") or _now_iso()
+    since_rev = _parse_rev(since)
+    if (since_rev is not None and since_rev == cache["rev"]) or (since_rev is None and _since_not_changed(since, updated_at)):
+        return _wire_response(request, {"rev": cache["rev"], "updated_at": updated_at, "sites": None}, wire)
+    return _wire_response(request, _wire_payload(cache, "sites", _LAUNCH_WIRE, wire), wire, cache.setdefault("enc", {}))
 
 
 @app.post("/api/launchsites")
@@ -773,41 +4768,35 @@ def upsert_launch_site(request: Request, s: LaunchSiteIn):
         "active": bool(s.active),
     }
 
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        _db_upsert_launchsite(site)
-        site["updated_at"] = _now_iso()
-        
-    try:
-        _LAUNCH_RESP_CACHE["ts"] = 0.0
-        _LAUNCH_RESP_CACHE["payload"] = None
-        _LAUNCH_RESP_CACHE["since"] = None
-        _LAUNCH_RESP_CACHE["updated_at"] = None
-    except Exception:
-        pass
-    _push_sse_event("launchsites_changed", "launchsites", site.get("updated_at"))
+    be = _sql_backend()
+    if be:
+        site = be["upsert_launchsite"](site)
+        _snap_launch_upsert(site)
+    else:
+        with _SNAP_LOCK:
+            items = _snap_launch_list()
+            found = None
+            for x in items:
+                if x.get("name") == name:
+                    found = x
+                    break
+            if not found:
+                found = {"name": name, "lat": None, "lng": None, "active": False}
+                items.append(found)
+            found.update(site)
+            found["updated_at"] = _now_iso()
+            found["rev"] = _snap_next_rev()
+            _save_launch_sites(items)
+            site = found
+            _snap_launch_upsert(site)  # still under the lock that allocated the rev
+
+    _push_sse_event("launchsites_changed", "launchsites", site.get("updated_at"), op="upsert", site=site, rev=site.get("rev"))
     return JSONResponse(site)
 
-    items = _load_launch_sites()
-    found = None
-    for x in items:
-        if x.get("name") == name:
-            found = x
-            break
-    if not found:
-        found = {"name": name, "lat": None, "lng": None, "active": False}
-        items.append(found)
-    found.update(site)
-    found["updated_at"] = _now_iso()
-    _save_launch_sites(items)
-    return JSONResponse(found)
-
 
-@app.post("/api/targets")
-def add_target(request: Request, t: TargetIn):
-    _require_admin(request)
-    new_id = f"t{int(datetime.now().timestamp()*1000)}_{uuid.uuid4().hex[:6]}"
+def _target_item(t: TargetIn, target_id: str | None = None) -> dict:
     item = {
-        "id": new_id,
+        "id": target_id or f"t{int(datetime.now().timestamp()*1000)}_{uuid.uuid4().hex[:6]}",
         "type": t.type,
         "lat": float(t.lat),
         "lng": float(t.lng),
@@ -817,113 +4806,178 @@ def add_target(request: Request, t: TargetIn):
         "dest_lat": float(t.dest_lat) if t.dest_lat is not None else None,
         "dest_lng": float(t.dest_lng) if t.dest_lng is not None else None,
         "active": bool(getattr(t, "active", True)),
-        "created_at": _now_iso(),
         "updated_at": _now_iso(),
     }
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        _db_upsert_target(item)
+    if target_id is None:
+        item["created_at"] = item["updated_at"]
+    return item
+
+
+@app.post("/api/targets")
+def add_target(request: Request, t: TargetIn):
+    _require_admin(request)
+    item = _target_item(t)
+    be = _sql_backend()
+    if be:
+        item = be["upsert_target"](item)
+        _snap_targets_upsert(item)
     else:
-        items = _load_targets()
-        items.append(item)
-        _save_targets(items)
-    
-    try:
-        _TARGETS_RESP_CACHE["ts"] = 0.0
-        _TARGETS_RESP_CACHE["payload"] = None
-        _TARGETS_RESP_CACHE["since"] = None
-        _TARGETS_RESP_CACHE["updated_at"] = None
-    except Exception:
-        pass
-    _push_sse_event("targets_changed", "targets", item.get("updated_at"))
+        with _SNAP_LOCK:
+            item["rev"] = _snap_next_rev()
+            _journal_append([{"op": "upsert", "target": item}])
+            _snap_targets_upsert(item)  # still under the lock that allocated the rev
+
+    _history_record([item])
+    _push_sse_event("targets_changed", "targets", item.get("updated_at"), op="upsert", target=item, rev=item.get("rev"))
     return JSONResponse(item)
 
 
+@app.post("/api/targets/batch")
+def batch_targets(request: Request, payload: TargetBatchIn):
+    """Apply create/update/delete ops atomically: one transaction (or file write), one event."""
+    _require_admin(request)
+    # Collapse to the final state per id, in op order.
+    final: dict[str, dict | None] = {}
+    must_exist: set[str] = set()
+    created: list[str] = []
+    for i, o in enumerate(payload.ops):
+        if o.op == "create":
+            if o.target is None:
+                raise HTTPException(status_code=422, detail=f"ops[{i}]: target required")
+            item = _target_item(o.target)
+            final[item["id"]] = item
+            created.append(item["id"])
+            continue
+        if not o.id:
+            raise HTTPException(status_code=422, detail=f"ops[{i}]: id required")
+        if o.op == "update":
+            if o.target is None:
+                raise HTTPException(status_code=422, detail=f"ops[{i}]: target required")
+            if o.id in final and final[o.id] is None:
+                raise HTTPException(status_code=409, detail=f"ops[{i}]: {o.id} deleted earlier in batch")
+            if o.id not in final:
+                must_exist.add(o.id)
+            final[o.id] = _target_item(o.target, o.id)
+        elif o.id in created:
+            final.pop(o.id, None)
+            created.remove(o.id)
+        else:
+            final[o.id] = None
+
+    upserts = [x for x in final.values() if x is not None]
+    deletes = [k for k, x in final.items() if x is None]
+    changed_at = None
+    be = _sql_backend()
+    if be:
+        try:
+            rows, deleted, changed_at = be["apply_target_batch"](upserts, deletes, must_exist)
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=f"not found: {', '.join(e.args[0])}")
+        if rows or deleted:
+            _snap_targets_apply(rows, deleted, changed_at)
+    else:
+        with _SNAP_LOCK:
+            missing = sorted(tid for tid in must_exist if _snap_targets_get(tid) is None)
+            if missing:
+                raise HTTPException(status_code=404, detail=f"not found: {', '.join(missing)}")
+            rows, deleted = [], {}
+            for item in upserts:
+                found = _snap_targets_get(item["id"])
+                if found is not None:
+                    found.update(item)
+                    item = found
+                item["rev"] = _snap_next_rev()
+                rows.append(item)
+            for tid in deletes:
+                if _snap_targets_get(tid) is not None:
+                    deleted[tid] = _snap_next_rev()
+            _journal_append(
+                [{"op": "upsert", "target": r} for r in rows]
+                + [{"op": "delete", "id": tid, "rev": rev} for tid, rev in deleted.items()]
+            )
+            if rows or deleted:
+                _snap_targets_apply(rows, deleted, changed_at)  # still under the lock that allocated the revs
+
+    rev = max([int(r.get("rev") or 0) for r in rows] + list(deleted.values()) + [0])
+    if rows or deleted:
+        _history_record(rows)
+        _push_sse_event(
+            "targets_changed", "targets", changed_at or _now_iso(),
+            op="batch", targets=rows, deleted=list(deleted), rev=rev,
+        )
+    return JSONResponse({
+        "ok": True,
+        "rev": rev,
+        "created": [r["id"] for r in rows if r["id"] in created],
+        "targets": rows,
+        "deleted": list(deleted),
+    })
+
+
 @app.delete("/api/targets")
 def clear_targets(request: Request):
     _require_admin(request)
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        _db_clear_targets()
-        
-    try:
-        _TARGETS_RESP_CACHE["ts"] = 0.0
-        _TARGETS_RESP_CACHE["payload"] = None
-        _TARGETS_RESP_CACHE["since"] = None
-        _TARGETS_RESP_CACHE["updated_at"] = None
-    except Exception:
-        pass
-    _push_sse_event("targets_changed", "targets", _now_iso())
-    return JSONResponse({"ok": True})
-    _save_targets([])
+    changed_at = None
+    be = _sql_backend()
+    if be:
+        changed_at, rev = be["clear_targets"]()
+        _snap_targets_clear(changed_at, rev)
+    else:
+        with _SNAP_LOCK:
+            rev = _snap_next_rev()
+            _journal_append([{"op": "clear", "rev": rev}])
+            _snap_targets_clear(changed_at, rev)  # still under the lock that allocated the rev
+
+    _push_sse_event("targets_changed", "targets", changed_at or _now_iso(), op="clear", rev=rev)
     return JSONResponse({"ok": True})
 
 
 @app.delete("/api/targets/{target_id}")
 def delete_target(request: Request, target_id: str):
     _require_admin(request)
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        _db_delete_target(target_id)
-        
-    try:
-        _TARGETS_RESP_CACHE["ts"] = 0.0
-        _TARGETS_RESP_CACHE["payload"] = None
-        _TARGETS_RESP_CACHE["since"] = None
-        _TARGETS_RESP_CACHE["updated_at"] = None
-    except Exception:
-        pass
-    _push_sse_event("targets_changed", "targets", _now_iso())
-    return JSONResponse({"ok": True})
-
-    items = _load_targets()
-    new_items = [x for x in items if x.get("id") != target_id]
-    if len(new_items) == len(items):
-        raise HTTPException(status_code=404, detail="not found")
-    _save_targets(new_items)
+    changed_at = None
+    be = _sql_backend()
+    if be:
+        changed_at, rev = be["delete_target"](target_id)
+        if not rev:  # no such row: nothing was written or tombstoned
+            raise HTTPException(status_code=404, detail="not found")
+        _snap_targets_delete(target_id, changed_at, rev)
+    else:
+        with _SNAP_LOCK:
+            if _snap_targets_get(target_id) is None:
+                raise HTTPException(status_code=404, detail="not found")
+            rev = _snap_next_rev()
+            _journal_append([{"op": "delete", "id": target_id, "rev": rev}])
+            _snap_targets_delete(target_id, changed_at, rev)  # still under the lock that allocated the rev
+
+    _push_sse_event("targets_changed", "targets", changed_at or _now_iso(), op="delete", id=target_id, rev=rev)
     return JSONResponse({"ok": True})
 
 
 @app.post("/api/targets/{target_id}")
 def update_target(request: Request, target_id: str, t: TargetIn):
     _require_admin(request)
-    item = {
-        "id": target_id,
-        "type": t.type,
-        "lat": float(t.lat),
-        "lng": float(t.lng),
-        "direction": int(t.direction),
-        "note": (t.note or "").strip()[:140] if t.note else "",
-        "speed_kmh": float(t.speed_kmh or 0),
-        "dest_lat": float(t.dest_lat) if t.dest_lat is not None else None,
-        "dest_lng": float(t.dest_lng) if t.dest_lng is not None else None,
-        "active": bool(getattr(t, "active", True)),
-        "updated_at": _now_iso(),
-    }
+    item = _target_item(t, target_id)
 
-    if os.getenv("DATABASE_URL") and psycopg2 is not None:
-        _db_upsert_target(item)
-        
-    try:
-        _TARGETS_RESP_CACHE["ts"] = 0.0
-        _TARGETS_RESP_CACHE["payload"] = None
-        _TARGETS_RESP_CACHE["since"] = None
-        _TARGETS_RESP_CACHE["updated_at"] = None
-    except Exception:
-        pass
-    _push_sse_event("targets_changed", "targets", item.get("updated_at"))
+    be = _sql_backend()
+    if be:
+        item = be["upsert_target"](item)
+        _snap_targets_upsert(item)
+    else:
+        with _SNAP_LOCK:
+            found = _snap_targets_get(target_id)
+            if not found:
+                raise HTTPException(status_code=404, detail="not found")
+            found.update(item)
+            found["rev"] = _snap_next_rev()
+            _journal_append([{"op": "upsert", "target": found}])
+            item = found
+            _snap_targets_upsert(item)  # still under the lock that allocated the rev
+
+    _history_record([item])
+    _push_sse_event("targets_changed", "targets", item.get("updated_at"), op="upsert", target=item, rev=item.get("rev"))
     return JSONResponse(item)
 
-    items = _load_targets()
-    found = None
-    for x in items:
-        if x.get("id") == target_id:
-            found = x
-            break
-    if not found:
-        raise HTTPException(status_code=404, detail="not found")
-
-    found.update(item)
-    _save_targets(items)
-    return JSONResponse(found)
-
 
 if __name__ == "__main__":
     import uvicorn
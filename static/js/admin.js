@@ -43,7 +43,7 @@ document.addEventListener("DOMContentLoaded", ()=>{
   if(back) back.addEventListener("click", (e)=>{ if(e.target === back) back.style.display="none"; });
 
   let selectedId = null;
-  let lastAdminUpdated = null;
+  let lastAdminRev = null;
   const liveMarkers = new Map();
   // ballistic destination helpers
   let ballisticLine = null;
@@ -395,13 +395,19 @@ document.addEventListener("DOMContentLoaded", ()=>{
   // compass handled by drag in setDir();
 
   async function reload(){
-    const url = lastAdminUpdated ? (`/api/targets?since=${encodeURIComponent(lastAdminUpdated)}`) : "/api/targets";
+    const url = (lastAdminRev!==null) ? (`/api/targets?since=${encodeURIComponent(lastAdminRev)}`) : "/api/targets";
     const data=await apiGet(url);
-    if(data && data.updated_at) lastAdminUpdated = data.updated_at;
+    if(data && typeof data.rev==="number") lastAdminRev = data.rev;
     if(!data.targets) return;
+    if(data.delta){
+      for(const t of data.targets){ upsertMarker(t); upsertRow(t, !listEls.has(t.id)); }
+      for(const id of (data.deleted||[])) removeTargetUI(id);
+      return;
+    }
     const list=(data.targets||[]);
     elList.innerHTML="";
-    list.slice().reverse().forEach(t=> elList.appendChild(itemRow(t)));
+    listEls.clear();
+    list.slice().reverse().forEach(t=> upsertRow(t));
     syncLive(list);
   }
 
@@ -55,10 +55,55 @@ function arrowPolyline(latlng, deg, lenMeters=1200){
   return [latlng, end];
 }
 
-async function apiGet(url){
-  const r = await fetch(url, {cache:"no-store"});
-  if(!r.ok) throw new Error("HTTP " + r.status);
-  return await r.json();
+// Compact wire format (see "Compact wire format" in main.py): row lists arrive as
+// {n, cols:{field:[...]}, enc:{field:[kind, arg]}} and are expanded back to objects.
+const PVLS_COL_TYPE = "application/vnd.pvls.col+json";
+
+function decodeColumnar(table){
+  const n = table.n|0, cols = table.cols || {}, enc = table.enc || {};
+  const rows = [];
+  for(let i=0;i<n;i++) rows.push({});
+  for(const key of Object.keys(cols)){
+    const col = cols[key];
+    const kind = (enc[key] || [])[0], arg = (enc[key] || [])[1];
+    for(let i=0;i<n;i++){
+      let v = col[i];
+      if(v===undefined) v = null;
+      if(v!==null){
+        if(kind==="dict") v = arg[v];
+        else if(kind==="fixed") v = v / arg;
+        else if(kind==="bool") v = !!v;
+        else if(kind==="ts") v = new Date((arg + v)*1000).toISOString();
+      }
+      rows[i][key] = v;
+    }
+  }
+  return rows;
+}
+
+function decodeWire(obj){
+  // Top-level fields only: that is where the server puts encoded lists.
+  if(!obj || typeof obj!=="object") return obj;
+  for(const k of Object.keys(obj)){
+    const v = obj[k];
+    if(v && typeof v==="object" && !Array.isArray(v) && v.cols && typeof v.n==="number") obj[k] = decodeColumnar(v);
+  }
+  return obj;
+}
+
+async function apiGet(url, opts){
+  const compact = !!(opts && opts.compact);
+  const headers = compact ? {"Accept": PVLS_COL_TYPE + ", application/json"} : {};
+  const r = await fetch(url, {cache:"no-store", headers});
+  if(!r.ok){
+    // 429/503 carry Retry-After (seconds) when the server is limiting or shedding load.
+    const err = new Error("HTTP " + r.status);
+    err.status = r.status;
+    err.retryAfter = parseFloat(r.headers.get("Retry-After")) || 0;
+    throw err;
+  }
+  const data = await r.json();
+  return (r.headers.get("Content-Type") || "").includes(PVLS_COL_TYPE) ? decodeWire(data) : data;
 }
 async function apiPost(url, body){
   const r = await fetch(url, {method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify(body)});
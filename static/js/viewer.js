@@ -1,15 +1,16 @@
 document.addEventListener("DOMContentLoaded", ()=>{
   const CENTER = [48.5231, 35.8707]; // Pavлоград (центр)
-  let lastTargetsUpdated = null;
-  let lastLaunchUpdated = null;
+  let lastTargetsRev = null;   // server revision our markers reflect (for ?since=)
+  let lastLaunchRev = null;
+  let lastUpdatedAt = null;    // shown as "Оновлено"
   let lastLaunchFetchMs = 0;
 
-  const CITY_NEAR_M = 15000;   // "підлітає"
-  const CITY_ALERT_M = 7000;   // "наближається"
-  const CITY_DANGER_M = 3000;  // "дуже близько"
-
   // MUST exist before applyTheme()/refreshIcons() is called
-  const markers = new Map(); // id -> {marker,line,trajLine,base,dest,dir,phase,prog,type,note,created_at,speed_kmh,last_anim_ms,active,prox}
+  const markers = new Map(); // id -> {marker,line,trajLine,base,pos,dest,dir,type,note,created_at,speed_kmh,active}
+  let traj = {t0: 0, step: 5, byId: new Map()}; // server-predicted positions (see fetchTrajectories)
+  let zones = new Map();      // zone id -> zone (/api/zones)
+  let zoneState = new Map();  // target id -> Map(zone id -> {status, eta_s}); computed on the server
+  let view = {key: null, bounds: null, clustered: false, clusterCount: 0}; // viewport the markers reflect (/api/targets?bbox=)
   function setIconIfChanged(o, icon, key){
     if(o._iconKey === key) return;
     o._iconKey = key;
@@ -26,14 +27,16 @@ document.addEventListener("DOMContentLoaded", ()=>{
   const isBallisticType = (tp)=> String(tp||'').toLowerCase()==='ballistic';
   const linesLayer   = L.layerGroup().addTo(map);
   const launchLayer  = L.layerGroup().addTo(map);
+  const clusterLayer = L.layerGroup().addTo(map);
+  const zonesLayer   = L.layerGroup().addTo(map);
 
   // Scale bar
   try{ L.control.scale({imperial:false, maxWidth:140}).addTo(map); }catch(_){}
 
   function refreshIcons(){
     // Rebuild icons to match theme / proximity / effects
-    for(const o of markers.values()){
-      const prox = getProxFlags(o.base);
+    for(const [id,o] of markers.entries()){
+      const prox = proxFlags(id);
       const effectsOn = !document.body.classList.contains("effects-off");
       const iconKey = `${o.type}|${o.dir}|${prox.near?1:0}|${prox.danger?1:0}`;
       setIconIfChanged(o, makeIconAnimated(o.type, o.dir, true, {
@@ -316,13 +319,20 @@ document.addEventListener("DOMContentLoaded", ()=>{
   schedulePresence();
 
   // ---------------- Targets render ----------------
-  function getProxFlags(latlng){
-    const d = haversineMetersLatLng(latlng, {lat:CENTER[0], lng:CENTER[1]});
-    return {
-      dist: d,
-      near: d<=CITY_ALERT_M && d> CITY_DANGER_M,
-      danger: d<=CITY_DANGER_M
-    };
+  function proxFlags(id){
+    // Inside a danger zone -> danger; inside a near zone, or due to reach any
+    // non-info zone within its ETA window -> near.
+    let near = false, danger = false;
+    const st = zoneState.get(id);
+    if(st){
+      for(const [zid, s] of st){
+        const level = (zones.get(zid) || {}).level || "near";
+        if(level==="info") continue;
+        if(s.status==="inside" && level==="danger") danger = true;
+        else near = true;
+      }
+    }
+    return {near: near && !danger, danger};
   }
 
   function makeTooltip(t){
@@ -392,6 +402,9 @@ document.addEventListener("DOMContentLoaded", ()=>{
     const lat = (typeof t.lat==="number" ? t.lat : t.latitude);
     const lng = (typeof t.lng==="number" ? t.lng : t.lon ?? t.longitude);
     if(typeof lat!=="number" || typeof lng!=="number") return;
+    // New base point: the old prediction no longer applies.
+    traj.byId.delete(id);
+    if((parseFloat(t.speed_kmh)||0) > 0) queueTrajectories();
 
     const dirRaw = (t.direction ?? t.dir ?? t.course ?? t.bearing ?? t.azimuth ?? 0);
 const dirNum = (typeof dirRaw==="number" ? dirRaw : parseFloat(dirRaw));
@@ -413,7 +426,7 @@ const dir = (Number.isFinite(dirNum) ? dirNum : 0);
       o.base = {lat, lng};
 
       // update icon (no pop)
-      const prox = getProxFlags(o.base);
+      const prox = proxFlags(id);
       const effectsOn = !document.body.classList.contains("effects-off");
       const iconKey = `${o.type}|${o.dir}|${prox.near?1:0}|${prox.danger?1:0}`;
       setIconIfChanged(o, makeIconAnimated(o.type, o.dir, true, {
@@ -442,7 +455,7 @@ const dir = (Number.isFinite(dirNum) ? dirNum : 0);
       setTimeout(()=>applyActiveClass(o.marker, o.active, o.type), 0);
 
     }else{
-      const prox = getProxFlags(base);
+      const prox = proxFlags(id);
       const effectsOn = !document.body.classList.contains("effects-off");
       const icon = makeIconAnimated(t.type || "unknown", normDeg(dir), true, {
         pop:false,
@@ -475,14 +488,11 @@ const dir = (Number.isFinite(dirNum) ? dirNum : 0);
         base,
         dest,
         dir:normDeg(dir),
-        phase:0,
         type: t.type || "unknown",
         note: t.note || "",
         created_at: t.created_at || "",
         speed_kmh: t.speed_kmh || 0,
-        last_anim_ms: Date.now(),
         active,
-        prox: null,
         _iconKey: null
       });
 
@@ -507,7 +517,7 @@ const dir = (Number.isFinite(dirNum) ? dirNum : 0);
     return map[type] || "Невідомо";
   }
 
-  function sync(list){
+  function sync(list, quiet=false){
     // Number targets in the order they were added (created_at oldest -> newest)
     const numById = new Map();
     try{
@@ -534,148 +544,142 @@ const dir = (Number.isFinite(dirNum) ? dirNum : 0);
     }
 
     // remove missing
-    for(const [id,o] of markers.entries()){
-      if(!alive.has(id)){
-        try{ targetsLayer.removeLayer(o.marker); }catch(_){}
-        try{ linesLayer.removeLayer(o.line); }catch(_){}
-        try{ if(o.trajLine) linesLayer.removeLayer(o.trajLine); }catch(_){}
-        markers.delete(id);
-        pushFeed("Ціль знято", "прибрано з мапи");
-      }
+    for(const id of Array.from(markers.keys())){
+      if(!alive.has(id)) removeMarker(id, quiet);
     }
 
-    const n = (list||[]).length;
+    updateCount();
+    applyFilters();
+  }
+
+  function removeMarker(id, quiet=false){
+    const o = markers.get(id);
+    if(!o) return;
+    try{ targetsLayer.removeLayer(o.marker); }catch(_){}
+    try{ linesLayer.removeLayer(o.line); }catch(_){}
+    try{ if(o.trajLine) linesLayer.removeLayer(o.trajLine); }catch(_){}
+    markers.delete(id);
+    traj.byId.delete(id);
+    if(!quiet) pushFeed("Ціль знято", "прибрано з мапи");
+  }
+
+  function updateCount(){
     const c1 = document.getElementById("count");
-    if(c1) c1.textContent = `Цілі: ${n}`;
+    if(c1) c1.textContent = `Цілі: ${markers.size + view.clusterCount}`;
+  }
 
-    applyFilters();
+  // ---------------- Viewport ----------------
+  // The server only sends what is inside the (padded) map bounds; below its cluster
+  // zoom it sends per-cell aggregates instead of points. Leaving the viewport is not
+  // a removal, so markers that scroll out are dropped quietly.
+  function viewParams(){
+    const b = map.getBounds().pad(0.25);
+    const r = (v)=>v.toFixed(3);
+    const bbox = [r(b.getWest()), r(b.getSouth()), r(b.getEast()), r(b.getNorth())].join(",");
+    const zoom = map.getZoom();
+    return {key: `${bbox}|${zoom}`, bbox, zoom};
+  }
+
+  function inView(t){
+    return !view.bounds || view.bounds.contains([t.lat, t.lng]);
+  }
+
+  function renderClusters(list){
+    clusterLayer.clearLayers();
+    let total = 0;
+    for(const c of (list||[])){
+      total += c.count;
+      const size = Math.round(Math.min(56, 28 + 6*Math.log10(c.count)));
+      const m = L.marker([c.lat, c.lng], {icon: L.divIcon({
+        className: "pvls-divicon",
+        html: `<div class="pvls-cluster" style="width:${size}px;height:${size}px">${c.count}</div>`,
+        iconSize: [size, size],
+        iconAnchor: [size/2, size/2]
+      })}).addTo(clusterLayer);
+      const mix = Object.entries(c.types || {}).sort((a,b)=>b[1]-a[1])
+        .map(([tp,n])=>`${escapeHtml(typeUa(tp))}: ${n}`).join("<br>");
+      m.bindTooltip(mix, {direction:"top", offset:[0,-size/2]});
+      m.on("click", ()=>map.setView([c.lat, c.lng], map.getZoom()+2));
+    }
+    view.clusterCount = total;
+  }
+
+  let viewTimer = null;
+  function queueViewRefresh(delay=300){
+    if(viewTimer) clearTimeout(viewTimer);
+    viewTimer = setTimeout(()=>{ viewTimer = null; refreshFromPush(); }, delay);
+  }
+  map.on("moveend", ()=>queueViewRefresh());
+
+  function setUpdated(ts){
+    const u = document.getElementById("updated");
+    if(u) u.textContent = ts ? `Оновлено: ${formatTs(ts)}` : "Оновлено: —";
+  }
+
+  // Launch sites (name -> site)
+  const launchSites = new Map();
+  function renderLaunch(){
+    launchLayer.clearLayers();
+    for(const s of launchSites.values()){
+      if(!s || !s.active) continue;
+      if(typeof s.lat!=="number" || typeof s.lng!=="number") continue;
+      const m=L.circleMarker([s.lat,s.lng],{radius:6,weight:2,opacity:0.9,fillOpacity:0.35,color:"#ff3b5b"}).addTo(launchLayer);
+      m.bindTooltip(`Пуск: ${escapeHtml(s.name||"")}`,{direction:"top",offset:[0,-6]});
+    }
   }
 
   async function tick(){
     try{
-      const url = lastTargetsUpdated ? ("/api/targets?since=" + encodeURIComponent(lastTargetsUpdated)) : "/api/targets";
-      const data = await apiGet(url);
-      if(data && data.updated_at) lastTargetsUpdated = data.updated_at;
-      const u = document.getElementById("updated");
-      if(u){
-        const ts = data.updated_at || "";
-        u.textContent = ts ? `Оновлено: ${formatTs(ts)}` : "Оновлено: —";
-      }
-      if(data.targets){
-        sync(data.targets || []);
+      // A moved/zoomed map needs the full viewport answer, not a delta.
+      const vp = viewParams();
+      let url = `/api/targets?bbox=${vp.bbox}&zoom=${vp.zoom}`;
+      if(lastTargetsRev!==null && vp.key===view.key) url += "&since=" + encodeURIComponent(lastTargetsRev);
+      const data = await apiGet(url, {compact:true});
+      if(data && typeof data.rev==="number") lastTargetsRev = data.rev;
+      if(data && data.updated_at) lastUpdatedAt = data.updated_at;
+      setUpdated(lastUpdatedAt || "");
+      if(data.delta){
+        // Only what changed since lastTargetsRev
+        for(const t of (data.targets||[])) upsert(t, !markers.has(String(t.id)));
+        for(const id of (data.deleted||[])) removeMarker(String(id));
+        for(const id of (data.left||[])) removeMarker(String(id), true);
+        updateCount();
+        applyFilters();
+      }else if(data.targets){
+        const [w, s, e, n] = data.bbox || [];
+        view = {
+          key: vp.key,
+          bounds: data.bbox ? L.latLngBounds([s, w], [n, e]) : null,
+          clustered: !!data.clustered,
+          clusterCount: 0
+        };
+        renderClusters(data.clusters);
+        sync(data.targets || [], true);
       }
 
 // Точки запуску: без штучного cooldown. `since` не дає тягнути повний список без змін.
 try{
   lastLaunchFetchMs = Date.now();
-  const lurl = lastLaunchUpdated ? ("/api/launchsites?since=" + encodeURIComponent(lastLaunchUpdated)) : "/api/launchsites";
-  const ls = await apiGet(lurl);
-  if(ls && ls.updated_at) lastLaunchUpdated = ls.updated_at;
+  const lurl = (lastLaunchRev!==null) ? ("/api/launchsites?since=" + encodeURIComponent(lastLaunchRev)) : "/api/launchsites";
+  const ls = await apiGet(lurl, {compact:true});
+  if(ls && typeof ls.rev==="number") lastLaunchRev = ls.rev;
   if(ls.sites){
-    launchLayer.clearLayers();
+    launchSites.clear();
     for(const s of (ls.sites||[])){
-      if(!s || !s.active) continue;
-      if(typeof s.lat!=="number" || typeof s.lng!=="number") continue;
-      const m=L.circleMarker([s.lat,s.lng],{radius:6,weight:2,opacity:0.9,fillOpacity:0.35,color:"#ff3b5b"}).addTo(launchLayer);
-      m.bindTooltip(`Пуск: ${escapeHtml(s.name||"")}`,{direction:"top",offset:[0,-6]});
+      if(s && s.name) launchSites.set(s.name, s);
     }
+    renderLaunch();
   }
 }catch(_){ /* ignore */ }
 
     }catch(err){
+      if(err && err.retryAfter) pollBackoffUntil = Date.now() + err.retryAfter*1000;
       console.error("tick failed", err);
       const u=document.getElementById("updated");
       if(u) u.textContent="Оновлено: помилка";
     }
   }
 
-  // Motion: drift forward by speed (km/h) from last update
-  let lastProxCheck = 0;
-  function animate(){
-    const now=Date.now();
-    for(const [id,o] of markers.entries()){
-      const speedKmh = parseFloat(o.speed_kmh||0) || 0;
-      const mps = (speedKmh>0 ? speedKmh*1000/3600 : 0);
-      let base = o.base;
-      let pos = base;
-
-      // Disable client-side motion for all targets except ballistic (prevents snap-back/flicker)
-      const allowMotion = false; // motion disabled (static markers)
-
-      // integrate in small steps so it never snaps back on refresh
-      const last = o.last_anim_ms || now;
-      if(!allowMotion){
-        // keep marker exactly at server position
-        o.last_anim_ms = now;
-      }
-
-      if(allowMotion){
-      const dt = Math.min(2.0, Math.max(0, (now-last)/1000.0));
-      o.last_anim_ms = now;
-
-      if(mps>0 && dt>0){
-        const step = mps*dt;
-        if(o.dest){
-          const remaining = haversineMetersLatLng(base, o.dest);
-          if(remaining <= step){
-            base = o.dest;
-          }else{
-            const br = bearingDeg(base, o.dest);
-            base = offset(base, br, step);
-          }
-        }else{
-          base = offset(base, o.dir, step); // no distance limit
-        }
-        o.base = base;
-        pos = base;
-      }
-
-      // small wobble for drones only
-      if(allowMotion && (o.type==="shahed" || o.type==="gerbera" || o.type==="recon" || o.type==="fpv")){
-        o.phase=(o.phase||0)+0.04;
-        const wobble=Math.sin(o.phase)*10;
-        pos = offset(pos,(o.dir+90)%360,wobble);
-      }
-
-      }
-
-      try{
-        o.marker.setLatLng(pos);
-        o.line.setLatLngs(arrowPolyline(pos,o.dir));
-        if(o.trajLine && o.dest){
-          o.trajLine.setLatLngs([pos, o.dest]);
-        }
-      }catch(_){}
-    }
-
-    // proximity check (1/sec)
-    if(now - lastProxCheck > 1000){
-      lastProxCheck = now;
-      for(const [id,o] of markers.entries()){
-        const prox = getProxFlags(o.base);
-        const level = prox.danger ? "danger" : (prox.near ? "near" : "ok");
-        if(o.prox !== level){
-          o.prox = level;
-
-          // update icon flags (static)
-          const effectsOn = !document.body.classList.contains("effects-off");
-          const iconKey = `${o.type}|${o.dir}|${prox.near?1:0}|${prox.danger?1:0}`;
-          setIconIfChanged(o, makeIconAnimated(o.type, o.dir, true, {
-            pop:false,
-            pulse:false,
-            near: prox.near,
-            danger: prox.danger
-          }), iconKey);
-
-          if(level==="near") pushFeed("Наближається до Павлограда", `${typeUa(o.type)} • ~${fmtDist(prox.dist)}`, [o.base.lat, o.base.lng], id);
-          if(level==="danger") pushFeed("Дуже близько до Павлограда", `${typeUa(o.type)} • ~${fmtDist(prox.dist)}`, [o.base.lat, o.base.lng], id);
-        }
-      }
-    }
-
-    // animation loop disabled (static markers)
-  }
-
   // ---------------- Measure tool ----------------
   const measureHud  = document.getElementById("measureHud");
   const measureText = document.getElementById("measureText");
@@ -791,12 +795,123 @@ try{
 
 let sse = null;
 let sseRetryTimer = null;
+let sseRetryMs = 5000;       // grows while reconnects fail, so a restart is not met by every viewer at once
+let pollBackoffUntil = 0;    // server asked us (Retry-After) to hold off polling
 let sseRefreshBusy = false;
 let sseRefreshPending = false;
+let sseSeq = null;        // seq of the last event reflected locally (null until "hello")
+let sseBuffered = [];     // deltas that arrived while a full refresh was in flight
+let sseWantRev = {targets:null, sites:null};  // newest revs the stream told us exist
+
+// ---------------- Published snapshots ----------------
+// Refreshes of an unchanged viewport read /snapshots/latest.json (tiny, cached ~1 s)
+// and the immutable /snapshots/<rev>.json it points at, both servable by a CDN/nginx.
+// The API is still used for the first load, moved/zoomed maps and clustered views.
+let snapshotsAvailable = true;
+
+async function refresh(){
+  if(!(await refreshFromSnapshot())) await tick();
+}
 
-async function refreshFromPush(entity){
-  // Push is authoritative for this operator-oriented map: always request fresh state.
-  // If another push arrives while a refresh is running, immediately do one more pass.
+async function refreshFromSnapshot(){
+  if(!snapshotsAvailable || view.clustered || view.key===null || viewParams().key!==view.key) return false;
+  try{
+    const r = await fetch("/snapshots/latest.json", {cache:"no-cache"});
+    if(r.status===404){ snapshotsAvailable = false; return false; }
+    if(!r.ok) return false;
+    const latest = await r.json();
+    if(typeof latest.targets_rev!=="number" || typeof latest.sites_rev!=="number") return false;
+    // Never step back behind what SSE deltas already gave us. latest.json also lags
+    // writes (debounced publish, max-age + stale-while-revalidate): if the stream has
+    // announced a newer rev, the API (?since=) answers instead.
+    if(lastTargetsRev!==null && latest.targets_rev < lastTargetsRev) return false;
+    if(lastLaunchRev!==null && latest.sites_rev < lastLaunchRev) return false;
+    if(sseWantRev.targets!==null && latest.targets_rev < sseWantRev.targets) return false;
+    if(sseWantRev.sites!==null && latest.sites_rev < sseWantRev.sites) return false;
+    if(latest.targets_rev===lastTargetsRev && latest.sites_rev===lastLaunchRev) return true;
+    const s = await fetch(latest.url);  // immutable: browser / CDN cache
+    if(!s.ok) return false;
+    const data = decodeWire(await s.json());
+    sync((data.targets || []).filter(inView), true);
+    launchSites.clear();
+    for(const x of (data.sites || [])){
+      if(x && x.name) launchSites.set(x.name, x);
+    }
+    renderLaunch();
+    lastTargetsRev = data.targets_rev;
+    lastLaunchRev = data.sites_rev;
+    lastUpdatedAt = laterTs(lastUpdatedAt, data.updated_at);
+    setUpdated(lastUpdatedAt);
+    updateCount();
+    applyFilters();
+    return true;
+  }catch(err){
+    console.error("snapshot refresh failed", err);
+    return false;
+  }
+}
+
+function laterTs(a, b){
+  if(!a) return b || null;
+  if(!b) return a;
+  return String(b) > String(a) ? b : a;
+}
+
+function laterRev(a, b){
+  if(typeof b!=="number") return a;
+  return (a===null || b>a) ? b : a;
+}
+
+function applyDelta(data){
+  if(data.type==="launchsites_changed"){
+    if(data.op==="upsert" && data.site && data.site.name){
+      launchSites.set(data.site.name, data.site);
+      renderLaunch();
+    }
+    lastLaunchRev = laterRev(lastLaunchRev, data.rev);
+    return;
+  }
+  const place = (t)=>{
+    if(inView(t)) upsert(t, !markers.has(String(t.id)));
+    else removeMarker(String(t.id), true);
+  };
+  if(view.clustered && data.op!=="clear"){
+    // Cluster counts are computed by the server; fetch the viewport again.
+    queueViewRefresh(1000);
+    return;
+  }
+  if(data.op==="upsert" && data.target){
+    place(data.target);
+  }else if(data.op==="delete"){
+    removeMarker(String(data.id));
+  }else if(data.op==="batch"){
+    for(const t of (data.targets || [])) place(t);
+    for(const id of (data.deleted || [])) removeMarker(String(id));
+  }else if(data.op==="clear"){
+    renderClusters([]);
+    for(const id of Array.from(markers.keys())) removeMarker(id);
+  }
+  lastTargetsRev = laterRev(lastTargetsRev, data.rev);
+  lastUpdatedAt = laterTs(lastUpdatedAt, data.updated_at);
+  setUpdated(lastUpdatedAt);
+  updateCount();
+  applyFilters();
+}
+
+function noteWantRev(data){
+  if(!data) return;
+  if(data.type==="targets_changed") sseWantRev.targets = laterRev(sseWantRev.targets, data.rev);
+  else if(data.type==="launchsites_changed") sseWantRev.sites = laterRev(sseWantRev.sites, data.rev);
+  sseWantRev.targets = laterRev(sseWantRev.targets, data.targets_rev);
+  sseWantRev.sites = laterRev(sseWantRev.sites, data.sites_rev);
+}
+
+async function refreshFromPush(trigger){
+  // Catch-up fetch on (re)connect and when a gap in seq shows we missed deltas.
+  // `since=<rev>` makes this a delta unless the server can no longer provide one.
+  // Deltas arriving meanwhile are buffered and re-applied afterwards (they are idempotent).
+  // `trigger` (the hello or gap event) carries the rev the refresh has to reach.
+  noteWantRev(trigger);
   if(sseRefreshBusy){
     sseRefreshPending = true;
     return;
@@ -805,18 +920,20 @@ async function refreshFromPush(entity){
   try{
     do{
       sseRefreshPending = false;
-      lastTargetsUpdated = null;
-      lastLaunchUpdated = null;
       lastLaunchFetchMs = 0;
-      await tick();
+      await refresh();
+      await loadZones();
     }while(sseRefreshPending);
   }catch(err){
     console.error("push refresh failed", err);
   }finally{
     sseRefreshBusy = false;
+    const buffered = sseBuffered;
+    sseBuffered = [];
+    for(const d of buffered) applyDelta(d);
     if(sseRefreshPending){
       sseRefreshPending = false;
-      refreshFromPush(entity);
+      refreshFromPush();
     }
   }
 }
@@ -824,22 +941,46 @@ async function refreshFromPush(entity){
 function connectSSE(){
   try{
     if(sse){ try{ sse.close(); }catch(_){ } sse = null; }
-    sse = new EventSource("/api/events");
-    const onPush = async (ev)=>{
+    sse = new EventSource("/api/events?fmt=col");
+    sseSeq = null;
+    sse.addEventListener("hello", (ev)=>{
+      let data = null;
       try{
-        const data = JSON.parse(ev.data || "{}");
-        await refreshFromPush(data.entity || "");
+        data = JSON.parse(ev.data || "{}");
+        sseSeq = Number(data.seq) || 0;
+      }catch(_){ sseSeq = 0; }
+      sseRetryMs = 5000;
+      refreshFromPush(data);
+    });
+    const onPush = (ev)=>{
+      try{
+        const data = decodeWire(JSON.parse(ev.data || "{}"));
+        const seq = Number(data.seq) || 0;
+        if(sseSeq!==null && seq<=sseSeq) return; // already covered by the last refresh
+        const gap = (sseSeq===null) || (seq!==sseSeq+1) || !data.op;
+        sseSeq = seq;
+        if(gap){ refreshFromPush(data); return; }
+        if(ev.type==="zone_alert"){
+          if(data.op==="zones") loadZones();
+          else applyZoneCrossings(data.crossings);
+          return;
+        }
+        if(sseRefreshBusy){ sseBuffered.push(data); return; }
+        applyDelta(data);
       }catch(err){
         console.error("sse parse failed", err);
       }
     };
     sse.addEventListener("targets_changed", onPush);
     sse.addEventListener("launchsites_changed", onPush);
+    sse.addEventListener("zone_alert", onPush);
     sse.onerror = ()=>{
       try{ if(sse) sse.close(); }catch(_){ }
       sse = null;
       if(sseRetryTimer) clearTimeout(sseRetryTimer);
-      sseRetryTimer = setTimeout(connectSSE, 5000);
+      // Jittered exponential backoff, capped at 60 s.
+      sseRetryTimer = setTimeout(connectSSE, sseRetryMs/2 + Math.random()*sseRetryMs/2);
+      sseRetryMs = Math.min(60000, sseRetryMs*2);
     };
   }catch(err){
     console.error("sse init failed", err);
@@ -847,17 +988,162 @@ function connectSSE(){
 }
 
 
+  // ---------------- Geofence zones ----------------
+  // The server tests every target (and its predicted track) against the zones and
+  // pushes `zone_alert` crossings; we only mirror its state for icons and the feed.
+  const ZONE_STYLE = {
+    info:   {color:"#3b82f6", weight:1, opacity:0.5, fillOpacity:0.05},
+    near:   {color:"#f59e0b", weight:1, opacity:0.6, fillOpacity:0.06},
+    danger: {color:"#ff3b5b", weight:1, opacity:0.7, fillOpacity:0.08},
+  };
+
+  function setZoneStatus(tid, zid, status, eta_s){
+    let st = zoneState.get(tid);
+    if(!status){
+      if(st){ st.delete(zid); if(!st.size) zoneState.delete(tid); }
+      return;
+    }
+    if(!st){ st = new Map(); zoneState.set(tid, st); }
+    st.set(zid, {status, eta_s});
+  }
+
+  function drawZones(){
+    zonesLayer.clearLayers();
+    for(const z of zones.values()){
+      if(z.builtin || z.active===false) continue;
+      const style = ZONE_STYLE[z.level] || ZONE_STYLE.near;
+      try{
+        const layer = (z.kind==="polygon")
+          ? L.polygon(z.points, style)
+          : L.circle([z.lat, z.lng], Object.assign({radius: z.radius_m}, style));
+        layer.bindTooltip(z.name || z.id, {sticky:true, opacity:0.9});
+        layer.addTo(zonesLayer);
+      }catch(_){ }
+    }
+  }
+
+  async function loadZones(){
+    try{
+      const data = await apiGet("/api/zones");
+      zones = new Map((data.zones || []).map(z=>[String(z.id), z]));
+      zoneState = new Map();
+      for(const s of (data.state || [])) setZoneStatus(String(s.target_id), String(s.zone_id), s.status, s.eta_s);
+      drawZones();
+      refreshIcons();
+    }catch(err){
+      console.error("zones failed", err);
+    }
+  }
+
+  function applyZoneCrossings(list){
+    const touched = new Set();
+    for(const c of (list || [])){
+      const tid = String(c.target_id), zid = String(c.zone_id);
+      touched.add(tid);
+      if(c.kind==="entered") setZoneStatus(tid, zid, "inside", 0);
+      else if(c.kind==="approaching") setZoneStatus(tid, zid, "eta", c.eta_s);
+      else setZoneStatus(tid, zid, null);
+
+      const parts = [typeUa(c.type || "unknown")];
+      if(typeof c.dist_m==="number") parts.push(`~${fmtDist(c.dist_m)}`);
+      if(c.kind==="approaching" && c.eta_s) parts.push(`за ~${Math.max(1, Math.round(c.eta_s/60))} хв`);
+      const title = (c.kind==="entered")
+        ? (c.level==="danger" ? `Дуже близько: ${c.zone}` : `У зоні: ${c.zone}`)
+        : (c.kind==="approaching" ? `Наближається: ${c.zone}` : `Вийшла із зони: ${c.zone}`);
+      pushFeed(title, parts.join(" • "), [c.lat, c.lng], tid);
+    }
+    for(const id of touched){
+      const o = markers.get(id);
+      if(!o) continue;
+      const prox = proxFlags(id);
+      setIconIfChanged(o, makeIconAnimated(o.type, o.dir, true, {
+        pop:false,
+        pulse:false,
+        near: prox.near,
+        danger: prox.danger
+      }), `${o.type}|${o.dir}|${prox.near?1:0}|${prox.danger?1:0}`);
+    }
+  }
+
+  // ---------------- Server-side motion ----------------
+  // Moving targets are extrapolated on the server (/api/trajectories: samples every
+  // TRAJ_STEP_S from t0, identical for every viewer). We only interpolate between
+  // samples, so a refresh never snaps markers back.
+  const TRAJ_HORIZON_S = 60;
+  const TRAJ_STEP_S = 5;
+  let trajClockOffset = 0;  // server clock - local clock, seconds
+  let trajBusy = false;
+  let trajQueued = null;
+
+  async function fetchTrajectories(){
+    if(trajBusy) return;
+    trajBusy = true;
+    try{
+      const res = await fetch(`/api/trajectories?horizon=${TRAJ_HORIZON_S}&step=${TRAJ_STEP_S}`, {cache:"no-store"});
+      if(!res.ok) return;
+      const serverNow = parseFloat(res.headers.get("X-Server-Time"));
+      if(Number.isFinite(serverNow)) trajClockOffset = serverNow - Date.now()/1000;
+      const data = await res.json();
+      const byId = new Map();
+      for(const t of (data.targets || [])) byId.set(String(t.id), t.pos || []);
+      traj = {t0: data.t0, step: data.step_s, byId};
+    }catch(err){
+      console.error("trajectories failed", err);
+    }finally{
+      trajBusy = false;
+    }
+  }
+
+  function queueTrajectories(){
+    if(trajQueued) return;
+    trajQueued = setTimeout(()=>{ trajQueued = null; fetchTrajectories(); }, 300);
+  }
+
+  function predictedPos(id){
+    const pos = traj.byId.get(id);
+    if(!pos || !pos.length) return null;
+    const x = (Date.now()/1000 + trajClockOffset - traj.t0) / traj.step;
+    if(x <= 0) return {lat: pos[0][0], lng: pos[0][1]};
+    const i = Math.floor(x);
+    if(i >= pos.length-1){
+      queueTrajectories(); // ran past the horizon
+      const last = pos[pos.length-1];
+      return {lat: last[0], lng: last[1]};
+    }
+    const f = x - i;
+    return {
+      lat: pos[i][0] + (pos[i+1][0]-pos[i][0])*f,
+      lng: pos[i][1] + (pos[i+1][1]-pos[i][1])*f,
+    };
+  }
+
+  function stepMotion(){
+    for(const [id,o] of markers.entries()){
+      const p = predictedPos(id);
+      if(!p && !o.pos) continue;
+      const pos = p || o.base;  // stopped moving: back to the server position
+      o.pos = p;
+      try{
+        o.marker.setLatLng(pos);
+        o.line.setLatLngs(arrowPolyline(pos, o.dir));
+        if(o.trajLine && o.dest) o.trajLine.setLatLngs([pos, o.dest]);
+      }catch(_){}
+    }
+  }
+
   // ---------------- Start loops ----------------
   function scheduleTick(){
-    // Fast fallback in case SSE is temporarily unavailable. With the operator workflow
-    // there is normally only one viewer, so a 2-second safety poll is inexpensive.
-    const delay = 2000;
-    setTimeout(async ()=>{ try{ await tick(); }catch(err){ console.error('tick outer', err); } scheduleTick(); }, delay);
+    // Fast fallback while SSE is unavailable; with a live stream deltas arrive by push,
+    // so the safety poll only needs to catch the rare silent failure.
+    const delay = Math.max((sse && sse.readyState===1) ? 15000 : 2000, pollBackoffUntil - Date.now());
+    setTimeout(async ()=>{ try{ await refresh(); }catch(err){ console.error('tick outer', err); } scheduleTick(); }, delay);
   }
   tick();
   scheduleTick();
   connectSSE();
-  // animation loop disabled (static markers)
+  fetchTrajectories();
+  setInterval(fetchTrajectories, TRAJ_HORIZON_S*1000/2);
+  setInterval(stepMotion, 250);
 
   // ---------------- helpers ----------------
   function formatClock(d){
@@ -894,24 +1180,6 @@ function connectSSE(){
     return 2*R*Math.asin(Math.min(1,Math.sqrt(x)));
   }
 
-  function bearingDeg(a,b){
-    const lat1=a.lat*Math.PI/180, lon1=a.lng*Math.PI/180;
-    const lat2=b.lat*Math.PI/180, lon2=b.lng*Math.PI/180;
-    const y = Math.sin(lon2-lon1)*Math.cos(lat2);
-    const x = Math.cos(lat1)*Math.sin(lat2) - Math.sin(lat1)*Math.cos(lat2)*Math.cos(lon2-lon1);
-    return (Math.atan2(y,x)*180/Math.PI + 360) % 360;
-  }
-
-  function offset(p, bearing, meters){
-    const R=6371000;
-    const br = bearing*Math.PI/180;
-    const lat1=p.lat*Math.PI/180;
-    const lon1=p.lng*Math.PI/180;
-    const lat2 = Math.asin(Math.sin(lat1)*Math.cos(meters/R) + Math.cos(lat1)*Math.sin(meters/R)*Math.cos(br));
-    const lon2 = lon1 + Math.atan2(Math.sin(br)*Math.sin(meters/R)*Math.cos(lat1), Math.cos(meters/R)-Math.sin(lat1)*Math.sin(lat2));
-    return {lat: lat2*180/Math.PI, lng: lon2*180/Math.PI};
-  }
-
   function escapeHtml(s){
     return String(s||"").replace(/[&<>"']/g, (c)=>({ "&":"&amp;","<":"&lt;",">":"&gt;",'"':"&quot;","'":"&#39;" }[c]));
   }